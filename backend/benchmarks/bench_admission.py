@@ -0,0 +1,332 @@
+"""
+Checks the per-user and per-model rate limits and the throttling retries of the streaming routes.
+
+The token buckets (see assistant_common.admission) live in a moto DynamoDB table and run on a
+simulated clock, so minutes of traffic take seconds:
+- concurrent requests on one bucket never take more than its burst;
+- over --minutes of steady traffic a user is admitted at its rate, plus its burst;
+- with one user flooding a model, the per-user limits keep the other users' requests going through,
+  where a model-wide limit alone lets the flooding user take most of the model throughput;
+- a request over its limit is queued with "queued" status frames, or rejected past the maximum wait.
+
+The sendmessage, compare and native chat paths then run against a fake Bedrock throttling on a
+schedule: throttled calls are retried with backoff behind "retrying" frames, a model that keeps
+being throttled falls back to FALLBACK_MODEL_ID (and the history records the model that answered),
+and without a fallback the client gets an error frame once the attempts are used up. The LangChain
+chat engine is checked the same way with a fake chat model in place of ChatBedrock.
+
+Usage:
+    python backend/benchmarks/bench_admission.py [--minutes 3] [--light-users 5]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from moto import mock_aws
+
+from fakes import BACKEND_DIR, FakeManagementApi, FakeThrottlingBedrock, add_source_path, client_error
+
+add_source_path()
+
+# Short backoff so the retries of the handler checks take milliseconds, read when the module is imported
+os.environ['BEDROCK_THROTTLE_BASE_DELAY'] = '0.01'
+os.environ['BEDROCK_THROTTLE_MAX_DELAY'] = '0.05'
+os.environ['BEDROCK_THROTTLE_ATTEMPTS'] = '4'
+
+from assistant_common import admission as admission_module
+from assistant_common.admission import Admission, TokenBucket
+from assistant_common.clients import get_table
+
+ADMISSION_TABLE = 'bench-admission'
+HISTORY_TABLE = 'bench-admission-history'
+CHAT_TABLE = 'bench-admission-chat'
+MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
+FALLBACK_MODEL_ID = 'anthropic.claude-3-5-sonnet-20240620-v1:0'
+
+
+class SimulatedClock:
+    """Wall clock advanced by the simulated sleeps instead of real time."""
+
+    def __init__(self, start=1700000000.0):
+        self.now = start
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+
+class SerializedTable:
+    """
+    Table wrapper applying the UpdateItem calls one at a time.
+
+    DynamoDB serializes the writes of an item, so concurrent conditional updates of a bucket never
+    both see the same token count. moto does not, and two threads can pass the same condition; the
+    lock models the per-item serialization of DynamoDB.
+    """
+
+    def __init__(self, table):
+        self._table = table
+        self._lock = threading.Lock()
+
+    def update_item(self, **kwargs):
+        with self._lock:
+            return self._table.update_item(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._table, name)
+
+
+def load_handler(alias, relative_dir, module_name='app'):
+    """Imports a handler module under a unique name, its folder on the path like in its Lambda function."""
+    path = os.path.join(BACKEND_DIR, relative_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(alias, os.path.join(path, f'{module_name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def websocket_event(request_id, body, request_time, user='bench@example.com'):
+    return {
+        'requestContext': {
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': request_id,
+            'authorizer': {'principalId': user},
+            'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'bench'},
+            'requestId': request_id,
+            'requestTimeEpoch': request_time
+        },
+        'body': json.dumps({'data': 'Write a haiku about serverless.', **body})
+    }
+
+
+def create_tables():
+    dynamodb = boto3.client('dynamodb')
+    strings = lambda *names: [{'AttributeName': name, 'AttributeType': 'S'} for name in names]
+    key = lambda *names: [{'AttributeName': name, 'KeyType': kind} for name, kind in zip(names, ('HASH', 'RANGE'))]
+    dynamodb.create_table(TableName=ADMISSION_TABLE, KeySchema=key('bucketKey'), AttributeDefinitions=strings('bucketKey'), BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(TableName=HISTORY_TABLE, KeySchema=key('email', 'timestamp'), AttributeDefinitions=strings('email', 'timestamp'), BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(TableName=CHAT_TABLE, KeySchema=key('SessionId', 'Email'), AttributeDefinitions=strings('SessionId', 'Email'), BillingMode='PAY_PER_REQUEST')
+
+
+def statuses(api, connection_id):
+    return [frame['status'] for frame in api.messages(connection_id) if frame.get('action') == 'status']
+
+
+def check_buckets(table, minutes):
+    clock = SimulatedClock()
+    bucket = TokenBucket(table, rate_per_minute=30, burst=5, clock=clock)
+
+    # Concurrent takes at the same instant: only the burst goes through, the conditional updates are atomic
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        waits = list(executor.map(lambda i: bucket.take('user#concurrent'), range(64)))
+    admitted = waits.count(0)
+    print(f"    64 concurrent requests on a bucket of burst 5: {admitted} admitted, next token in {min(w for w in waits if w):.2f} s")
+    assert admitted == 5, waits
+
+    # Steady traffic above the rate: admitted at the rate, plus the burst
+    admitted = 0
+    for step in range(minutes * 60 * 4):
+        if bucket.take('user#steady') == 0:
+            admitted += 1
+        clock.sleep(0.25)
+    expected = 5 + 30 * minutes
+    print(f"    {minutes} min at 240 requests/min on a bucket of 30/min, burst 5: {admitted} admitted (expected about {expected})")
+    assert abs(admitted - expected) <= 1, admitted
+
+
+def simulate_fairness(table, light_users, minutes, user_rate):
+    """One user sends 5 requests/s, the light users one every 5 s each; returns the requests admitted per user."""
+    clock = SimulatedClock()
+    limits = Admission(table, user_rate_per_minute=user_rate, user_burst=5, model_rate_per_minute=120, model_burst=10, clock=clock)
+    prefix = f'{user_rate}-'
+    sent, admitted = Counter(), Counter()
+    for tick in range(minutes * 60 * 5):
+        users = [f'{prefix}heavy']
+        if tick % 25 == 0:
+            users += [f'{prefix}light{i}' for i in range(light_users)]
+        for user in users:
+            sent[user] += 1
+            if limits.try_admit(user, f'{prefix}{MODEL_ID}')[0] == 0:
+                admitted[user] += 1
+        clock.sleep(0.2)
+    light_sent = sum(count for user, count in sent.items() if 'light' in user)
+    light_admitted = sum(count for user, count in admitted.items() if 'light' in user)
+    return admitted[f'{prefix}heavy'], light_admitted, light_sent
+
+
+def check_fairness(table, light_users, minutes):
+    print(f"    one user flooding a model of 120 requests/min, {light_users} users sending 12 requests/min each, {minutes} min:")
+    for label, user_rate in (('model limit only', 100000), ('per-user limits (20/min)', 20)):
+        heavy, light, light_sent = simulate_fairness(table, light_users, minutes, user_rate)
+        print(f"        {label:26s} flooding user {heavy:4d} admitted, other users {light:4d} of {light_sent} admitted ({light / light_sent:.0%})")
+    assert light == light_sent, (light, light_sent)
+
+
+def check_queueing(table):
+    clock = SimulatedClock()
+    frames = []
+    limits = Admission(table, user_rate_per_minute=600, user_burst=2, clock=clock, sleep=clock.sleep)
+    models = [limits.admit('queued@example.com', MODEL_ID, frames.append, max_wait=1) for _ in range(5)]
+    assert models == [MODEL_ID] * 5, models
+    queued = [frame for frame in frames if frame['status'] == 'queued']
+    print(f"    5 back-to-back requests, burst 2 at 600/min: all admitted, {len(queued)} queued frames, "
+          f"waits {[frame['retryAfterMs'] for frame in queued]} ms")
+    assert len(queued) == 3, frames
+
+    limits = Admission(table, user_rate_per_minute=6, user_burst=1, clock=clock, sleep=clock.sleep)
+    assert limits.admit('rejected@example.com', MODEL_ID, frames.append, max_wait=1) == MODEL_ID
+    assert limits.admit('rejected@example.com', MODEL_ID, frames.append, max_wait=1) is None
+    print("    a request that would wait longer than the maximum wait is rejected")
+
+    # The model bucket is exhausted: the fallback model is admitted instead of queueing
+    frames.clear()
+    limits = Admission(table, model_rate_per_minute=6, model_burst=1, clock=clock, sleep=clock.sleep)
+    assert limits.admit('a@example.com', 'model-busy', frames.append, fallback='model-spare') == 'model-busy'
+    assert limits.admit('b@example.com', 'model-busy', frames.append, fallback='model-spare') == 'model-spare'
+    assert frames == [{'status': 'fallback', 'modelId': 'model-spare', 'reason': 'rateLimited'}], frames
+    print("    a request to a rate limited model is admitted on the fallback model")
+
+
+def check_sendmessage(request_times):
+    app = load_handler('sendmessage_app', 'src/websocket/sendmessage')
+    api = FakeManagementApi()
+    app.get_management_api = lambda domain_name, stage: api
+    history = get_table(HISTORY_TABLE)
+
+    def run(request_id, schedule, body=None, fallback=None):
+        bedrock = FakeThrottlingBedrock(schedule, tokens=20)
+        app.get_client = lambda service_name, endpoint_url=None: bedrock
+        if fallback:
+            os.environ['FALLBACK_MODEL_ID'] = fallback
+        else:
+            os.environ.pop('FALLBACK_MODEL_ID', None)
+        response = app.handler(websocket_event(request_id, {'action': 'sendmessage', 'modelId': MODEL_ID, **(body or {})}, next(request_times)), None)
+        return response, bedrock
+
+    response, bedrock = run('retried', {'*': [True, True]})
+    assert response['statusCode'] == 200, response
+    assert statuses(api, 'retried') == ['retrying', 'retrying'] and api.text('retried'), api.messages('retried')
+    print(f"    sendmessage, throttled twice: {sum(bedrock.attempts.values())} calls, frames {statuses(api, 'retried')}, then the answer")
+
+    response, bedrock = run('fallback', {MODEL_ID: [True] * 10}, fallback=FALLBACK_MODEL_ID)
+    assert response['statusCode'] == 200, response
+    assert statuses(api, 'fallback') == ['retrying'] * 3 + ['fallback'], api.messages('fallback')
+    assert [call['modelId'] for call in bedrock.calls] == [FALLBACK_MODEL_ID], bedrock.calls
+    items = history.scan()['Items']
+    answered_by = {item['requestId']: item['modelId'] for item in items}
+    assert answered_by['fallback'] == FALLBACK_MODEL_ID and answered_by['retried'] == MODEL_ID, answered_by
+    print(f"    sendmessage, model always throttled: {Counter(bedrock.throttled)[MODEL_ID]} throttled calls, frames "
+          f"{statuses(api, 'fallback')}, answered and stored as {answered_by['fallback']}")
+
+    response, bedrock = run('failed', {'*': [True] * 10})
+    frames = api.messages('failed')
+    assert response['statusCode'] == 500 and frames[-1]['action'] == 'error', frames
+    print(f"    sendmessage, always throttled without fallback: {len(bedrock.throttled)} attempts, then an error frame")
+
+    response, bedrock = run('compare', {MODEL_ID: [True]}, {'action': 'compare', 'modelIds': [MODEL_ID, FALLBACK_MODEL_ID]})
+    assert response['statusCode'] == 200, response
+    status_frames = [frame for frame in api.messages('compare') if frame.get('action') == 'status']
+    assert [(frame['modelId'], frame['status']) for frame in status_frames] == [(MODEL_ID, 'retrying')], status_frames
+    print("    compare, one model throttled once: its retry frame carries its model ID, no fallback")
+
+    # Rate limits through the handler: burst 2 per user, the third request is rejected
+    admission_module._admission = Admission(get_table(ADMISSION_TABLE), user_rate_per_minute=1, user_burst=2)
+    os.environ['ADMISSION_TABLE'] = ADMISSION_TABLE
+    codes = []
+    for i in range(3):
+        response, bedrock = run(f'limited-{i}', {})
+        codes.append(response['statusCode'])
+    assert codes == [200, 200, 429] and api.messages('limited-2')[-1]['action'] == 'error', codes
+    print(f"    sendmessage with per-user limits of burst 2: status codes {codes}")
+    admission_module._admission = None
+    os.environ.pop('ADMISSION_TABLE')
+
+
+def check_chat():
+    os.environ['DYNAMODB_TABLE'] = CHAT_TABLE
+    os.environ['FALLBACK_MODEL_ID'] = FALLBACK_MODEL_ID
+    app = load_handler('chat_app', 'src/websocket/chat')
+    api = FakeManagementApi()
+    bedrock = FakeThrottlingBedrock({MODEL_ID: [True] * 10}, tokens=20)
+    app.get_management_api = lambda domain_name, stage: api
+    app.get_client = lambda service_name, endpoint_url=None: bedrock
+    body = {'action': 'chat', 'engine': 'native', 'session_id': 'session-1', 'modelId': MODEL_ID}
+    response = app.handler(websocket_event('chat', body, 1700000000000), None)
+    assert response['statusCode'] == 200, response
+    assert statuses(api, 'chat') == ['retrying'] * 3 + ['fallback'] and api.text('chat'), api.messages('chat')
+    print(f"    chat (native engine), model always throttled: frames {statuses(api, 'chat')}, answered by {bedrock.calls[-1]['modelId']}")
+
+    # The LangChain engine only calls Bedrock on the first read of the chain, every attempt builds a new chain
+    import langchain_aws
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.runnables import RunnableLambda
+
+    def throttled(prompt):
+        raise client_error('ThrottlingException', 'Too many requests, please wait before trying again.', 'InvokeModelWithResponseStream')
+
+    models = []
+
+    def chat_bedrock(model_id, **kwargs):
+        models.append(model_id)
+        if model_id == MODEL_ID:
+            return RunnableLambda(throttled)
+        return GenericFakeChatModel(messages=iter([AIMessage(content='Answer of the fallback model.')]))
+
+    langchain_aws.ChatBedrock = chat_bedrock
+    body = dict(body, engine='langchain', session_id='session-2')
+    response = app.handler(websocket_event('chat-langchain', body, 1700000001000), None)
+    assert response['statusCode'] == 200, response
+    assert statuses(api, 'chat-langchain') == ['retrying'] * 3 + ['fallback'], api.messages('chat-langchain')
+    assert api.text('chat-langchain') == 'Answer of the fallback model.', api.messages('chat-langchain')
+    assert models == [MODEL_ID] * 4 + [FALLBACK_MODEL_ID], models
+    print(f"    chat (LangChain engine), model always throttled: frames {statuses(api, 'chat-langchain')}, answered by {models[-1]}")
+
+    os.environ.pop('FALLBACK_MODEL_ID')
+    models.clear()
+    response = app.handler(websocket_event('chat-langchain-error', dict(body, session_id='session-3'), 1700000002000), None)
+    assert response['statusCode'] == 500 and len(models) == 4, (response, models)
+    assert statuses(api, 'chat-langchain-error') == ['retrying'] * 3 and api.messages('chat-langchain-error')[-1]['action'] == 'error'
+    print("    chat (LangChain engine), always throttled without fallback: 4 attempts, then an error frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=int, default=3)
+    parser.add_argument('--light-users', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['TRACING_ENABLED'] = 'false'
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+    for name in ('ADMISSION_TABLE', 'FALLBACK_MODEL_ID', 'HISTORY_BODY_BUCKET', 'RESPONSE_CACHE_TABLE'):
+        os.environ.pop(name, None)
+
+    with mock_aws():
+        create_tables()
+        table = SerializedTable(get_table(ADMISSION_TABLE))
+        print("Token buckets (moto DynamoDB, simulated clock)")
+        check_buckets(table, args.minutes)
+        check_fairness(table, args.light_users, args.minutes)
+        check_queueing(table)
+
+        print("Throttling (fake Bedrock throttling on a schedule)")
+        check_sendmessage(iter(range(1700000000000, 1800000000000, 1000)))
+        check_chat()
+
+
+if __name__ == '__main__':
+    main()
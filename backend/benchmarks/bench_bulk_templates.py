@@ -0,0 +1,101 @@
+"""
+Compares importing templates one POST at a time against the bulk import of the templates function.
+
+Both modes drive the real handler against a moto DynamoDB table with the listing indexes, with a
+fixed latency added to every DynamoDB call to stand in for the network round trip moto does not have.
+The one-by-one mode is measured on a sample and extrapolated to the full count.
+
+Usage:
+    python backend/benchmarks/bench_bulk_templates.py [--templates 10000] [--sample 500] [--call-latency-ms 8] [--workers 4]
+"""
+import argparse
+import json
+import os
+import time
+
+import boto3
+from moto import mock_aws
+
+from fakes import add_source_path
+
+add_source_path('src/templates')
+
+from bench_templates_listing import TABLE_NAME, create_table
+
+USER = 'bench@example.com'
+
+
+def template_event(method, body):
+    return {
+        'httpMethod': method,
+        'body': json.dumps(body),
+        'requestContext': {'authorizer': {'claims': {'email': USER}}}
+    }
+
+
+def sample_template(i):
+    return {
+        'createdBy': USER,
+        'templateName': f'Imported template {i}',
+        'templateDescription': 'Template imported by the bulk benchmark.',
+        'modelversion': 'anthropic.claude-3-haiku-20240307-v1:0',
+        'templatePrompt': 'Translate the following text to French: ${INPUT_DATA}',
+        'templateGuidance': 'Paste the text to translate.',
+        'visibility': 'private',
+        'systemPrompt': ''
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--templates', type=int, default=10000)
+    parser.add_argument('--sample', type=int, default=500, help='Templates created one by one before extrapolating')
+    parser.add_argument('--call-latency-ms', type=float, default=8.0)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['TEMPLATES_TABLE'] = TABLE_NAME
+    os.environ['BATCH_WRITE_WORKERS'] = str(args.workers)
+
+    with mock_aws():
+        create_table()
+        import templates
+
+        calls = {}
+
+        def add_latency(event_name, **kwargs):
+            operation = event_name.rsplit('.', 1)[-1]
+            calls[operation] = calls.get(operation, 0) + 1
+            time.sleep(args.call_latency_ms / 1000)
+
+        templates.table.meta.client.meta.events.register('before-call.dynamodb', add_latency)
+
+        sample = min(args.sample, args.templates)
+        started = time.perf_counter()
+        for i in range(sample):
+            response = templates.handler(template_event('POST', sample_template(i)), None)
+            assert response['statusCode'] == 201, response
+        one_by_one = (time.perf_counter() - started) * args.templates / sample
+        one_by_one_calls = sum(calls.values()) * args.templates / sample
+
+        calls.clear()
+        started = time.perf_counter()
+        response = templates.handler(template_event('POST', {
+            'createdBy': USER,
+            'templates': [sample_template(i) for i in range(args.templates)]
+        }), None)
+        bulk = time.perf_counter() - started
+        bulk_calls = dict(calls)
+        result = json.loads(response['body'])
+        assert result['imported'] == args.templates, result
+
+        stored = templates.table.meta.client.describe_table(TableName=TABLE_NAME)['Table']['ItemCount']
+        print(f"Importing {args.templates} templates, {args.call_latency_ms:.0f} ms per DynamoDB call, {args.workers} workers")
+        print(f"    one by one  {one_by_one:8.1f} s  {one_by_one_calls:8.0f} calls (extrapolated from {sample})")
+        print(f"    bulk        {bulk:8.1f} s  {sum(bulk_calls.values()):8.0f} calls {bulk_calls}")
+        print(f"    items in table: {stored} (including the listing version marker)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+Measures how quickly and how cheaply WebSocket generations stop once the client cancels or leaves.
+
+The real onconnect, ondisconnect, cancel, sendmessage and chat handlers run against a moto
+connections table, a fake API Gateway management API and a slow fake ConverseStream
+(--tokens tokens at --tokens-per-second). While a generation streams on its own thread, the
+client sends the cancel action, or disconnects, or its connection starts returning GoneException.
+For each case the report gives:
+- the time from the cancel or disconnection to the end of the model stream (bounded by
+  CANCEL_CHECK_INTERVAL_SECONDS), and right away on GoneException;
+- the output tokens the fake model did not generate, next to the estimate the trace reports;
+- the partial completion stored in the history (or chat session), marked as truncated.
+
+It also checks that a request sent on the connection after a cancel streams in full, that a compare
+request stops every model, and counts the flag reads per second of streaming (nothing per token).
+
+Usage:
+    python backend/benchmarks/bench_cancellation.py [--tokens 2000] [--tokens-per-second 400] [--check-interval 0.1]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+
+import boto3
+from moto import mock_aws
+
+from fakes import BACKEND_DIR, FakeBedrockRuntime, FakeManagementApi, add_source_path
+
+add_source_path()
+
+from assistant_common.clients import get_table
+from assistant_common.tracing import LocalCollector
+
+CONNECTIONS_TABLE = 'bench-connections'
+HISTORY_TABLE = 'bench-cancel-history'
+CHAT_TABLE = 'bench-cancel-chat'
+USER = 'bench@example.com'
+MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
+OTHER_MODEL_ID = 'amazon.nova-pro-v1:0'
+
+
+def load_handler(alias, relative_dir, module_name='app'):
+    """Imports a handler module under a unique name, its folder on the path like in its Lambda function."""
+    path = os.path.join(BACKEND_DIR, relative_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(alias, os.path.join(path, f'{module_name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def websocket_event(connection_id, request_id, body=None):
+    return {
+        'requestContext': {
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': connection_id,
+            'authorizer': {'principalId': USER},
+            'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'bench'},
+            'requestId': request_id,
+            'requestTimeEpoch': now_ms()
+        },
+        'body': json.dumps(body) if body is not None else None
+    }
+
+
+def create_tables():
+    dynamodb = boto3.client('dynamodb')
+    strings = lambda *names: [{'AttributeName': name, 'AttributeType': 'S'} for name in names]
+    key = lambda *names: [{'AttributeName': name, 'KeyType': kind} for name, kind in zip(names, ('HASH', 'RANGE'))]
+    dynamodb.create_table(TableName=CONNECTIONS_TABLE, KeySchema=key('connectionId'), AttributeDefinitions=strings('connectionId'), BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(TableName=HISTORY_TABLE, KeySchema=key('email', 'timestamp'), AttributeDefinitions=strings('email', 'timestamp'), BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(TableName=CHAT_TABLE, KeySchema=key('SessionId', 'Email'), AttributeDefinitions=strings('SessionId', 'Email'), BillingMode='PAY_PER_REQUEST')
+
+
+class Generation:
+    """Runs a streaming handler on its own thread, recording when it returns."""
+
+    def __init__(self, handler, event):
+        self.response = None
+        self.ended_at = None
+        self._thread = threading.Thread(target=self._run, args=(handler, event))
+        self._thread.start()
+
+    def _run(self, handler, event):
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            self.response = handler(event, None)
+        self.ended_at = time.perf_counter()
+
+    def join(self):
+        self._thread.join()
+        return self.response
+
+
+class Routes:
+    def __init__(self, args):
+        self.args = args
+        self.onconnect = load_handler('onconnect_app', 'src/websocket/onconnect')
+        self.ondisconnect = load_handler('ondisconnect_app', 'src/websocket/ondisconnect')
+        self.cancel = load_handler('cancel_app', 'src/websocket/cancel')
+        self.sendmessage = load_handler('sendmessage_app', 'src/websocket/sendmessage')
+        self.chat = load_handler('chat_app', 'src/websocket/chat')
+        self.api = FakeManagementApi()
+        self.bedrock = None
+        for module in (self.sendmessage, self.chat):
+            module.get_management_api = lambda domain_name, stage: self.api
+            module.get_client = lambda service_name, endpoint_url=None: self.bedrock
+
+    def connect(self, connection_id):
+        assert self.onconnect.handler(websocket_event(connection_id, f'{connection_id}-connect'), None)['statusCode'] == 200
+
+    def start(self, module, connection_id, request_id, body, **stream_kwargs):
+        self.bedrock = FakeBedrockRuntime(tokens=self.args.tokens, token_delay=1 / self.args.tokens_per_second, **stream_kwargs)
+        bedrock = self.bedrock
+        generation = Generation(module.handler, websocket_event(connection_id, request_id, {'data': 'Write a long story.', 'max_tokens_to_sample': self.args.tokens, **body}))
+        # Wait for the first tokens so the stop lands mid-stream
+        while generation.ended_at is None and (not bedrock.streams or bedrock.streams[-1].emitted < self.args.tokens // 10):
+            time.sleep(0.005)
+        return generation, bedrock
+
+    def frames(self, connection_id):
+        return self.api.messages(connection_id)
+
+
+def report(label, generation, bedrock, stopped_at, collector):
+    emitted = sum(stream.emitted for stream in bedrock.streams)
+    total = sum(stream.tokens for stream in bedrock.streams)
+    stopped = f"stopped {(generation.ended_at - stopped_at) * 1000:6.0f} ms after the stop" if stopped_at else "stopped on the failed post        "
+    bound = sum(collector.values('maxTokensAvoided'))
+    print(f"    {label:36s} {stopped}, {emitted:5d} of {total} tokens generated, "
+          f"{total - emitted:5d} saved (reported upper bound {bound})")
+    assert all(stream.closed for stream in bedrock.streams), 'the model stream was not closed'
+    return total - emitted
+
+
+def history_item(request_id):
+    items = get_table(HISTORY_TABLE).scan()['Items']
+    return next(item for item in items if item['requestId'] == request_id)
+
+
+def check_sendmessage(routes, interval):
+    routes.connect('conn-cancel')
+    with LocalCollector() as collector:
+        generation, bedrock = routes.start(routes.sendmessage, 'conn-cancel', 'req-cancel', {'action': 'sendmessage'})
+        stopped_at = time.perf_counter()
+        cancel = routes.cancel.handler(websocket_event('conn-cancel', 'req-cancel-action', {'action': 'cancel'}), None)
+        assert json.loads(cancel['body'])['cancelled'] == ['req-cancel'], cancel
+        assert generation.join()['statusCode'] == 200, generation.response
+    saved = report('sendmessage, cancel action', generation, bedrock, stopped_at, collector)
+    assert saved > 0 and (generation.ended_at - stopped_at) < interval + 0.5
+    end = routes.frames('conn-cancel')[-1]
+    assert end == {'endOfMessage': True, 'offset': len(routes.api.text('conn-cancel')), 'truncated': True, 'reason': 'cancelled'}, end
+    item = history_item('req-cancel')
+    assert item['truncated'] and item['truncationReason'] == 'cancelled' and item['completion'], item
+    assert item['completion'] == routes.api.text('conn-cancel')
+    print(f"        stored {len(item['completion'])} characters marked truncated, the text the client received")
+
+    # A request sent after the cancel on the same connection is not affected by the flag
+    generation, bedrock = routes.start(routes.sendmessage, 'conn-cancel', 'req-after', {'action': 'sendmessage'})
+    assert generation.join()['statusCode'] == 200 and bedrock.streams[-1].emitted == routes.args.tokens
+    assert 'truncated' not in history_item('req-after')
+    connection = get_table(CONNECTIONS_TABLE).get_item(Key={'connectionId': 'conn-cancel'})['Item']
+    assert not connection.get('activeRequests'), connection
+    print("        the next request on the connection streams in full, no generation left registered")
+
+    routes.connect('conn-leave')
+    with LocalCollector() as collector:
+        generation, bedrock = routes.start(routes.sendmessage, 'conn-leave', 'req-leave', {'action': 'sendmessage'})
+        stopped_at = time.perf_counter()
+        routes.ondisconnect.handler(websocket_event('conn-leave', 'req-leave-disconnect'), None)
+        assert generation.join()['statusCode'] == 410, generation.response
+    report('sendmessage, disconnect', generation, bedrock, stopped_at, collector)
+    assert history_item('req-leave')['truncationReason'] == 'disconnected'
+
+    # GoneException on a post stops the stream right away, without waiting for the flag
+    routes.connect('conn-gone')
+    routes.api.gone_after = len(routes.api.posts) + 5
+    with LocalCollector() as collector:
+        generation, bedrock = routes.start(routes.sendmessage, 'conn-gone', 'req-gone', {'action': 'sendmessage'})
+        assert generation.join()['statusCode'] == 410, generation.response
+    routes.api.gone_after = None
+    report('sendmessage, GoneException', generation, bedrock, None, collector)
+    assert history_item('req-gone')['truncationReason'] == 'disconnected'
+
+
+def check_compare(routes):
+    routes.connect('conn-compare')
+    with LocalCollector() as collector:
+        generation, bedrock = routes.start(routes.sendmessage, 'conn-compare', 'req-compare', {'action': 'compare', 'modelIds': [MODEL_ID, OTHER_MODEL_ID]})
+        stopped_at = time.perf_counter()
+        routes.cancel.handler(websocket_event('conn-compare', 'req-compare-cancel', {'action': 'cancel'}), None)
+        assert generation.join()['statusCode'] == 200, generation.response
+    report('compare (2 models), cancel action', generation, bedrock, stopped_at, collector)
+    frames = routes.frames('conn-compare')
+    assert [frame['modelId'] for frame in frames if frame.get('modelEnd') and frame.get('truncated')] != [], frames
+    assert frames[-1].get('endOfMessage') and frames[-1].get('truncated'), frames[-1]
+    items = [item for item in get_table(HISTORY_TABLE).scan()['Items'] if item.get('compareId') == 'req-compare']
+    assert len(items) == 2 and all(item['truncated'] for item in items), items
+
+
+def check_chat(routes):
+    routes.connect('conn-chat')
+    body = {'action': 'chat', 'engine': 'native', 'session_id': 'session-cancel', 'modelId': MODEL_ID}
+    os.environ['DYNAMODB_TABLE'] = CHAT_TABLE
+    with LocalCollector() as collector:
+        generation, bedrock = routes.start(routes.chat, 'conn-chat', 'req-chat', body)
+        stopped_at = time.perf_counter()
+        routes.cancel.handler(websocket_event('conn-chat', 'req-chat-cancel', {'action': 'cancel'}), None)
+        assert generation.join()['statusCode'] == 200, generation.response
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+    report('chat (native engine), cancel action', generation, bedrock, stopped_at, collector)
+    session = get_table(CHAT_TABLE).get_item(Key={'SessionId': 'session-cancel', 'Email': USER})['Item']
+    answer = session['History'][-1]['data']
+    assert answer['response_metadata'] == {'truncated': True, 'truncationReason': 'cancelled'} and answer['content'], answer
+    print(f"        session history ends with the partial answer ({len(answer['content'])} characters) marked truncated")
+
+
+def check_chat_pipeline(routes):
+    """In pipeline mode the reader thread can finish the engine, which stores the turn, before the handler sees a cancel."""
+    routes.connect('conn-chat-pipeline')
+    key = {'SessionId': 'session-cancel-pipeline', 'Email': USER}
+    body = {'action': 'chat', 'engine': 'native', 'session_id': key['SessionId'], 'modelId': MODEL_ID, 'data': 'Write a short story.'}
+    os.environ['DYNAMODB_TABLE'] = CHAT_TABLE
+    os.environ['STREAM_PIPELINE'] = 'true'
+    # A fast model and a slow client: the engine is done long before the deltas are posted
+    routes.bedrock = FakeBedrockRuntime(tokens=200)
+    routes.api.post_latency = 0.3
+    generation = Generation(routes.chat.handler, websocket_event('conn-chat-pipeline', 'req-chat-pipeline', body))
+    while generation.ended_at is None and 'Item' not in get_table(CHAT_TABLE).get_item(Key=key):
+        time.sleep(0.005)
+    routes.cancel.handler(websocket_event('conn-chat-pipeline', 'req-chat-pipeline-cancel', {'action': 'cancel'}), None)
+    assert generation.join()['statusCode'] == 200, generation.response
+    routes.api.post_latency = 0
+    os.environ.pop('STREAM_PIPELINE')
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+
+    frames = routes.frames('conn-chat-pipeline')
+    assert frames[-1].get('endOfMessage') and frames[-1].get('truncated'), frames[-1]
+    history = get_table(CHAT_TABLE).get_item(Key=key)['Item']['History']
+    assert [message['type'] for message in history] == ['human', 'ai'], history
+    assert history[-1]['data']['content'] == ''.join(f'token{i} ' for i in range(200)), history[-1]
+    print("    chat (native engine, pipeline), cancel after the engine stored the turn: the turn is stored once, complete")
+
+
+def check_reads(routes, interval):
+    """Counts the connection table calls of an uncancelled generation."""
+    calls = Counter()
+    client = get_table(CONNECTIONS_TABLE).meta.client
+    count = lambda params, model, **kwargs: calls.update([model.name]) if params.get('TableName') == CONNECTIONS_TABLE else None
+    client.meta.events.register('provide-client-params.dynamodb', count)
+    routes.connect('conn-reads')
+    started = time.perf_counter()
+    generation, bedrock = routes.start(routes.sendmessage, 'conn-reads', 'req-reads', {'action': 'sendmessage'})
+    generation.join()
+    seconds = generation.ended_at - started
+    client.meta.events.unregister('provide-client-params.dynamodb', count)
+    print(f"    uncancelled generation of {routes.args.tokens} tokens over {seconds:.1f} s: connection table calls {dict(calls)} "
+          f"(about one GetItem per {interval} s, none per token)")
+    assert calls['GetItem'] <= seconds / interval + 1, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=2000)
+    parser.add_argument('--tokens-per-second', type=float, default=400)
+    parser.add_argument('--check-interval', type=float, default=0.1)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['TRACING_ENABLED'] = 'true'
+    os.environ['CONNECTIONS_TABLE'] = CONNECTIONS_TABLE
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+    os.environ['CANCEL_CHECK_INTERVAL_SECONDS'] = str(args.check_interval)
+    os.environ['HISTORY_WRITE_BEHIND'] = 'false'
+    for name in ('ADMISSION_TABLE', 'FALLBACK_MODEL_ID', 'HISTORY_BODY_BUCKET', 'RESPONSE_CACHE_TABLE', 'STREAM_BUFFER_TABLE'):
+        os.environ.pop(name, None)
+
+    with mock_aws():
+        create_tables()
+        routes = Routes(args)
+        print(f"{args.tokens} tokens at {args.tokens_per_second:.0f} tokens/s, flag read every {args.check_interval} s")
+        check_sendmessage(routes, args.check_interval)
+        check_compare(routes)
+        check_chat(routes)
+        check_chat_pipeline(routes)
+        check_reads(routes, args.check_interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Compares the LangChain and native chat engines of the chat route.
+
+Both engines run the real chat handler against a moto DynamoDB table and a fake API Gateway
+management API. The native engine gets a fake ConverseStream; for the LangChain engine ChatBedrock
+is replaced with a LangChain fake chat model streaming the same number of tokens, so the numbers
+include the chain, history and per-token framework overhead but not the network.
+
+A last LangChain session runs with HISTORY_SUMMARY on a small HISTORY_TOKEN_BUDGET, and checks that
+the summary of dropped turns reaches the model inside the leading system message: like ChatBedrock
+with Anthropic models, the fake model rejects a system message anywhere else.
+
+Usage:
+    python backend/benchmarks/bench_chat_engines.py [--turns 20] [--tokens 300] [--summary-budget 2500]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from collections import Counter
+
+import boto3
+from moto import mock_aws
+
+from fakes import FakeBedrockRuntime, FakeManagementApi, add_source_path
+
+add_source_path('src/websocket/chat')
+
+TABLE_NAME = 'bench-chat-table'
+
+
+def chat_event(session_id, question, engine, **fields):
+    return {
+        'requestContext': {
+            'authorizer': {'principalId': 'bench@example.com'},
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': 'bench-connection',
+            'requestId': f'{session_id}-{question}'
+        },
+        'body': json.dumps({'action': 'chat', 'data': question, 'session_id': session_id, 'engine': engine, **fields})
+    }
+
+
+def install_fakes(clients, args):
+    """Installs the fake clients and chat model, returns the list the prompts of the LangChain engine are recorded in."""
+    api = FakeManagementApi()
+    bedrock = FakeBedrockRuntime(tokens=args.tokens)
+    clients.get_management_api = lambda domain_name, stage: api
+    get_client = clients.get_client
+    clients.get_client = lambda service_name, endpoint_url=None: bedrock if service_name == 'bedrock-runtime' else get_client(service_name, endpoint_url)
+
+    # The LangChain engine streams from a fake chat model instead of ChatBedrock
+    import langchain_aws
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage, SystemMessage
+    from langchain_core.runnables import RunnableLambda
+
+    prompts = []
+
+    def check_prompt(prompt):
+        messages = prompt.to_messages()
+        if any(isinstance(message, SystemMessage) for message in messages[1:]):
+            raise ValueError('A system message must be the first message of the conversation')
+        prompts.append(messages)
+        return prompt
+
+    answer = ''.join(f'token{i} ' for i in range(args.tokens))
+    langchain_aws.ChatBedrock = lambda **kwargs: RunnableLambda(check_prompt) | GenericFakeChatModel(messages=iter(lambda: AIMessage(content=answer), None))
+    return prompts
+
+
+def run_engine(app, engine, turns, calls):
+    latencies = []
+    calls.clear()
+    for turn in range(turns):
+        started = time.perf_counter()
+        response = app.handler(chat_event(f'session-{engine}', f'question {turn}', engine), None)
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response['statusCode'] == 200, response
+    return latencies, dict(calls)
+
+
+def check_summary(app, args, prompts):
+    """Runs LangChain turns past the token budget with HISTORY_SUMMARY and checks where the summary is sent."""
+    from langchain_core.messages import SystemMessage
+    from windowing import SUMMARY_PREFIX
+
+    os.environ['HISTORY_TOKEN_BUDGET'] = str(args.summary_budget)
+    app.HISTORY_SUMMARY = True
+    prompts.clear()
+    try:
+        for turn in range(6):
+            response = app.handler(chat_event('session-summary', f'question {turn}', 'langchain', system_prompt='Answer briefly.'), None)
+            assert response['statusCode'] == 200, response
+    finally:
+        os.environ.pop('HISTORY_TOKEN_BUDGET')
+        app.HISTORY_SUMMARY = False
+    summarized = [messages for messages in prompts if isinstance(messages[0], SystemMessage) and SUMMARY_PREFIX in messages[0].content]
+    assert all(messages[0].content.startswith('Answer briefly.') for messages in prompts), 'the system prompt is not leading'
+    assert summarized, 'no turn sent a summary of the dropped turns'
+    print(f"langchain  HISTORY_SUMMARY with a budget of {args.summary_budget} tokens: {len(summarized)} of {len(prompts)} turns "
+          f"sent the summary in the leading system message, followed by {len(summarized[-1]) - 1} messages")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--tokens', type=int, default=300)
+    parser.add_argument('--summary-budget', type=int, default=2500)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_TABLE'] = TABLE_NAME
+
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'SessionId', 'KeyType': 'HASH'}, {'AttributeName': 'Email', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'SessionId', 'AttributeType': 'S'}, {'AttributeName': 'Email', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+        import app
+        from assistant_common import clients
+
+        prompts = install_fakes(clients, args)
+        app.get_client = clients.get_client
+        app.get_management_api = clients.get_management_api
+
+        # Count every DynamoDB API call made by the handler
+        calls = Counter()
+        clients.get_table(TABLE_NAME).meta.client.meta.events.register(
+            'before-call.dynamodb', lambda model, **kwargs: calls.update([model.name])
+        )
+
+        for engine in ('langchain', 'native'):
+            latencies, engine_calls = run_engine(app, engine, args.turns, calls)
+            per_turn = {name: round(count / args.turns, 2) for name, count in sorted(engine_calls.items())}
+            print(f"{engine:9}  median {statistics.median(latencies):7.1f} ms  p95 {sorted(latencies)[int(len(latencies) * 0.95) - 1]:7.1f} ms  "
+                  f"DynamoDB calls per turn {per_turn}")
+
+        check_summary(app, args, prompts)
+
+
+if __name__ == '__main__':
+    main()
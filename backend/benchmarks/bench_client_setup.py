@@ -0,0 +1,68 @@
+"""
+Measures the per-invocation AWS client setup cost of the WebSocket handlers.
+
+"per-invocation" rebuilds the DynamoDB resource, the Bedrock client and the API Gateway management
+client on every call, as the handlers used to. "registry" goes through assistant_common.clients:
+the first call pays the cold cost, warm calls reuse the cached clients.
+
+Usage:
+    python backend/benchmarks/bench_client_setup.py [--invocations 50]
+"""
+import argparse
+import os
+import statistics
+import time
+
+import boto3
+
+from fakes import add_source_path
+
+add_source_path()
+
+from assistant_common import clients
+
+
+def per_invocation_setup():
+    table = boto3.resource('dynamodb').Table('bench-table')
+    bedrock = boto3.client('bedrock-runtime')
+    api = boto3.client('apigatewaymanagementapi', endpoint_url='https://example.execute-api.us-east-1.amazonaws.com/Prod')
+    return table, bedrock, api
+
+
+def registry_setup():
+    table = clients.get_table('bench-table')
+    bedrock = clients.get_client('bedrock-runtime')
+    api = clients.get_management_api('example.execute-api.us-east-1.amazonaws.com', 'Prod')
+    return table, bedrock, api
+
+
+def measure(setup, invocations):
+    timings = []
+    for _ in range(invocations):
+        started = time.perf_counter()
+        setup()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--invocations', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+    # Both modes start from a fresh session, like a new Lambda container
+    boto3.DEFAULT_SESSION = None
+    before = measure(per_invocation_setup, args.invocations)
+    clients.reset()
+    after = measure(registry_setup, args.invocations)
+
+    print(f"per-invocation  cold {before[0]:7.2f} ms  warm median {statistics.median(before[1:]):7.3f} ms")
+    print(f"registry        cold {after[0]:7.2f} ms  warm median {statistics.median(after[1:]):7.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
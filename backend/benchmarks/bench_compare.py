@@ -0,0 +1,150 @@
+"""
+Compares the wall time of the compare action with sending the same prompt to each model in turn.
+
+The real sendmessage handler runs against fake ConverseStreams with a different time-to-first-token
+and token rate per model, a fake API Gateway management API and a moto DynamoDB history table. The
+compare request should take about as long as its slowest model, where sequential requests take the
+sum. The frames are checked (deltas tagged with their model, one modelEnd per model, then one
+endOfMessage), as are the history writes: one TransactWriteItems call storing one item per model, a
+replay of the request storing nothing new, and a failing model leaving the others unaffected.
+
+Usage:
+    python backend/benchmarks/bench_compare.py [--tokens 200] [--runs 3]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from collections import Counter
+
+import boto3
+from moto import mock_aws
+
+from fakes import FakeBedrockRuntime, FakeManagementApi, add_source_path, client_error
+
+add_source_path('src/websocket/sendmessage')
+
+TABLE_NAME = 'bench-compare-history'
+USER = 'bench@example.com'
+# Time-to-first-token and delay between tokens of each fake model
+MODELS = {
+    'anthropic.claude-3-haiku-20240307-v1:0': (0.05, 0.0005),
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': (0.15, 0.001),
+    'amazon.nova-pro-v1:0': (0.10, 0.0008),
+}
+
+
+class PerModelBedrock:
+    """Routes each ConverseStream call to the fake of its model, failing for unknown models."""
+
+    def __init__(self, tokens):
+        self.models = {
+            model_id: FakeBedrockRuntime(tokens=tokens, first_token_delay=first, token_delay=delay, text=f'{model_id[:6]}{{}} ')
+            for model_id, (first, delay) in MODELS.items()
+        }
+
+    def converse_stream(self, **kwargs):
+        if kwargs['modelId'] not in self.models:
+            raise client_error('ValidationException', 'The provided model identifier is invalid.', 'ConverseStream')
+        return self.models[kwargs['modelId']].converse_stream(**kwargs)
+
+
+def message_event(request_id, body, request_time=1700000000000):
+    return {
+        'requestContext': {
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': request_id,
+            'authorizer': {'principalId': USER},
+            'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'bench'},
+            'requestId': request_id,
+            'requestTimeEpoch': request_time
+        },
+        'body': json.dumps({'data': 'Write a haiku about serverless.', **body})
+    }
+
+
+def check_frames(api, connection_id, model_ids):
+    frames = api.messages(connection_id)
+    for model_id in model_ids:
+        ends = [frame for frame in frames if frame.get('modelEnd') and frame['modelId'] == model_id]
+        assert len(ends) == 1, ends
+    assert all('modelId' in frame for frame in frames if 'messages' in frame)
+    assert frames[-1].get('endOfMessage') and len(frames[-1]['stats']) == len(model_ids), frames[-1]
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_TABLE'] = TABLE_NAME
+    os.environ['TRACING_ENABLED'] = 'false'
+    os.environ.pop('HISTORY_BODY_BUCKET', None)
+    os.environ.pop('RESPONSE_CACHE_TABLE', None)
+
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}, {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}, {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+        import app
+        from assistant_common import clients
+
+        api = FakeManagementApi()
+        bedrock = PerModelBedrock(args.tokens)
+        get_client = clients.get_client
+        app.get_client = lambda service_name, endpoint_url=None: bedrock if service_name == 'bedrock-runtime' else get_client(service_name, endpoint_url)
+        app.get_management_api = lambda domain_name, stage: api
+
+        table = clients.get_table(TABLE_NAME)
+        calls = Counter()
+        table.meta.client.meta.events.register('before-call.dynamodb', lambda model, **kwargs: calls.update([model.name]))
+
+        model_ids = list(MODELS)
+        sequential, compared = [], []
+        for run in range(args.runs):
+            started = time.perf_counter()
+            for index, model_id in enumerate(model_ids):
+                request_time = 1600000000000 + (run * len(model_ids) + index) * 1000
+                response = app.handler(message_event(f'seq-{run}-{index}', {'action': 'sendmessage', 'modelId': model_id}, request_time), None)
+                assert response['statusCode'] == 200, response
+            sequential.append((time.perf_counter() - started) * 1000)
+
+            calls.clear()
+            started = time.perf_counter()
+            response = app.handler(message_event(f'compare-{run}', {'action': 'compare', 'modelIds': model_ids}, 1700000000000 + run * 1000), None)
+            compared.append((time.perf_counter() - started) * 1000)
+            assert response['statusCode'] == 200, response
+            assert calls['TransactWriteItems'] == 1 and calls['PutItem'] == 0, calls
+            frames = check_frames(api, f'compare-{run}', model_ids)
+
+        stats = frames[-1]['stats']
+        print(f"{len(model_ids)} models, {args.tokens} tokens each, median of {args.runs} runs")
+        for model_stats in stats:
+            print(f"    {model_stats['modelId']:42s} latency {model_stats['latencyMs']:6.1f} ms, "
+                  f"first token {model_stats['timeToFirstTokenMs']:6.1f} ms, {model_stats['outputTokens']} tokens")
+        print(f"    one after another {statistics.median(sequential):7.1f} ms, compare {statistics.median(compared):7.1f} ms "
+              f"(slowest model {max(model_stats['latencyMs'] for model_stats in stats):.1f} ms)")
+
+        # A replayed request stores nothing new, a failing model does not stop the others
+        app.handler(message_event('compare-0', {'action': 'compare', 'modelIds': model_ids}, 1700000000000), None)
+        failing = ['unknown.model-v1:0'] + model_ids[:1]
+        app.handler(message_event('compare-failing', {'action': 'compare', 'modelIds': failing}, 1800000000000), None)
+        frames = check_frames(api, 'compare-failing', failing)
+        assert [frame.get('error') is not None for frame in frames if frame.get('modelEnd')] == [True, False], frames
+        items = table.scan()['Items']
+        by_compare = Counter(item['compareId'] for item in items if 'compareId' in item)
+        assert by_compare['compare-0'] == len(model_ids) and by_compare['compare-failing'] == 1, by_compare
+        print(f"    history items per compare request: {dict(by_compare)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Measures the memory and round trips of the history export as the history grows.
+
+The export reads a stand-in table that generates history items page by page (like DynamoDB, at most
+1 MB per page) and uploads to an S3 stand-in that discards the parts, so the peak memory reported by
+tracemalloc is the export's own: it should stay flat whatever the number of items. The requests
+needed to page through the same history with the default page size of 10 are shown for comparison.
+
+Usage:
+    python backend/benchmarks/bench_history_export.py [--items 1000 10000 100000] [--completion-bytes 2000]
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from fakes import FakeMultipartS3, add_source_path
+
+add_source_path('src/history')
+
+USER = 'bench@example.com'
+PAGE_BYTES = 1024 * 1024
+
+
+class SyntheticHistoryTable:
+    """Stand-in for the history table serving `count` generated items in 1 MB query pages."""
+
+    def __init__(self, count, completion_bytes):
+        self.count = count
+        self.prompt = 'Summarize the following meeting notes. ' * 20
+        self.completion = ('The meeting covered the roadmap and the hiring plan. ' * (completion_bytes // 52 + 1))[:completion_bytes]
+        self.queries = 0
+
+    def item(self, i):
+        return {
+            'timestamp': str(1700000000 + i),
+            'requestId': f'request-{i}',
+            'promptData': self.prompt,
+            'modelId': 'anthropic.claude-3-haiku-20240307-v1:0',
+            'completion': self.completion
+        }
+
+    def query(self, **kwargs):
+        self.queries += 1
+        start = int(kwargs['ExclusiveStartKey']['timestamp']) - 1700000000 + 1 if 'ExclusiveStartKey' in kwargs else 0
+        per_page = max(1, PAGE_BYTES // (len(self.prompt) + len(self.completion) + 100))
+        end = min(self.count, start + per_page)
+        response = {'Items': [self.item(i) for i in range(start, end)]}
+        if end < self.count:
+            response['LastEvaluatedKey'] = {'email': USER, 'timestamp': str(1700000000 + end - 1)}
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--completion-bytes', type=int, default=2000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_TABLE'] = 'bench-history-table'
+    os.environ['HISTORY_EXPORT_BUCKET'] = 'bench-exports'
+
+    import history
+    from assistant_common import clients
+
+    clients._clients[('s3', None)] = FakeMultipartS3()
+    for count in args.items:
+        history.table = SyntheticHistoryTable(count, args.completion_bytes)
+        tracemalloc.start()
+        started = time.perf_counter()
+        response = history.export_history(USER)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = json.loads(response['body'])
+        assert result['items'] == count, result
+
+        print(f"{count:7d} items: export {elapsed * 1000:7.0f} ms, {history.table.queries:4d} queries, "
+              f"{result['bytes'] / 1024:7.0f} KiB gzip, peak {peak / 1024 / 1024:5.1f} MiB; "
+              f"paging 10 per page takes {-(-count // 10)} requests")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Measures history item size, read capacity per page and response size of the history list modes.
+
+Two moto DynamoDB tables (with the summary index of template.yaml) are filled with the same synthetic
+requests: one with items written the previous way (the whole request re-serialized in 'requestBody',
+no previews), one with items written the current way by sendmessage. Pages are then read through the
+history handler in full mode and in summary mode. moto does not report real capacity, so read capacity
+is estimated from the bytes read: 0.5 RCU per started 4 KB of a query page (eventually consistent).
+
+Usage:
+    python backend/benchmarks/bench_history_payloads.py [--items 200] [--page 10] [--prompt-bytes 3000] [--completion-bytes 4000]
+"""
+import argparse
+import json
+import math
+import os
+
+import boto3
+from moto import mock_aws
+
+from fakes import add_source_path
+
+add_source_path('src/history')
+
+from assistant_common.history_items import SUMMARY_ATTRIBUTES, SUMMARY_INDEX, request_parameters, summary_fields
+
+USER = 'bench@example.com'
+
+
+def create_table(name):
+    boto3.client('dynamodb').create_table(
+        TableName=name,
+        KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}, {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}, {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': SUMMARY_INDEX,
+            'KeySchema': [{'AttributeName': 'email', 'KeyType': 'HASH'}, {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+            'Projection': {
+                'ProjectionType': 'INCLUDE',
+                'NonKeyAttributes': [name for name in SUMMARY_ATTRIBUTES if name not in ('email', 'timestamp')]
+            }
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    return boto3.resource('dynamodb').Table(name)
+
+
+def history_item(i, prompt_bytes, completion_bytes, lean):
+    prompt = (f'Request {i}: review the following paragraph and suggest improvements. ' * (prompt_bytes // 60 + 1))[:prompt_bytes]
+    completion = ('Here are some suggestions to make the paragraph clearer and more concise. ' * (completion_bytes // 70 + 1))[:completion_bytes]
+    system = 'You are a helpful writing assistant. Answer in a professional tone. ' * 6
+    body = {
+        'action': 'sendmessage', 'data': prompt, 'modelId': 'anthropic.claude-3-haiku-20240307-v1:0', 'system': system,
+        'max_tokens_to_sample': 4000, 'temperature': 0, 'top_k': 250, 'top_p': 0.999, 'imageS3Keys': []
+    }
+    item = {
+        'email': USER,
+        'timestamp': str(1700000000 + i),
+        'requestId': f'request-{i}',
+        'promptData': prompt,
+        'modelId': body['modelId'],
+        'sourceIp': '203.0.113.10',
+        'requestBody': json.dumps(request_parameters(body) if lean else body),
+        'userAgent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36',
+        'completion': completion,
+        'systemPrompt': system
+    }
+    if lean:
+        item.update(summary_fields(prompt, completion))
+    return item
+
+
+def item_size(item):
+    return sum(len(name) + len((value if isinstance(value, str) else json.dumps(value)).encode('utf-8')) for name, value in item.items())
+
+
+def page_capacity(items):
+    return math.ceil(sum(item_size(item) for item in items) / 4096) * 0.5
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--page', type=int, default=10)
+    parser.add_argument('--prompt-bytes', type=int, default=3000)
+    parser.add_argument('--completion-bytes', type=int, default=4000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_TABLE'] = 'bench-history-before'
+
+    with mock_aws():
+        tables = {'before': create_table('bench-history-before'), 'after': create_table('bench-history-after')}
+        for name, table in tables.items():
+            with table.batch_writer() as batch:
+                for i in range(args.items):
+                    batch.put_item(Item=history_item(i, args.prompt_bytes, args.completion_bytes, name == 'after'))
+
+        import history
+
+        def get(params):
+            event = {
+                'httpMethod': 'GET',
+                'queryStringParameters': {'email': USER, 'limit': str(args.page), **params},
+                'requestContext': {'authorizer': {'claims': {'email': USER}}}
+            }
+            response = history.handler(event, None)
+            assert response['statusCode'] == 200, response
+            return response['body']
+
+        print(f"{args.items} items, pages of {args.page}")
+        rows = []
+        for name, mode, params in (('before', 'full', {}), ('after', 'full', {}), ('after', 'summary', {'view': 'summary'})):
+            history.table = tables[name]
+            body = get(params)
+            items = json.loads(body)['items']
+            full_items = [tables[name].get_item(Key={'email': USER, 'timestamp': item['timestamp']})['Item'] for item in items]
+            read = full_items if mode == 'full' else items
+            rows.append((f'{name} write, {mode} list', sum(map(item_size, full_items)) / len(full_items), page_capacity(read), len(body)))
+
+        for label, size, capacity, response_bytes in rows:
+            print(f"    {label:26s} item {size / 1024:6.1f} KiB  page {capacity:5.1f} RCU  response {response_bytes / 1024:7.1f} KiB")
+
+        history.table = tables['after']
+        detail = json.loads(get({'timestamp': str(1700000000)}))
+        print(f"    detail fetch of one item: {len(json.dumps(detail)) / 1024:.1f} KiB, {page_capacity([detail]):.1f} RCU")
+
+
+if __name__ == '__main__':
+    main()
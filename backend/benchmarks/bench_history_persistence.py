@@ -0,0 +1,176 @@
+"""
+Measures the time until the client receives the end-of-message signal with the history written
+before it (HISTORY_WRITE_BEHIND=false) and behind it (HISTORY_WRITE_BEHIND=true).
+
+The real sendmessage handler runs against a fake ConverseStream, a fake API Gateway management API
+and a moto DynamoDB table whose PutItem calls are slowed down by --put-latency to stand in for the
+network round trip. The time of the endOfMessage post and the handler duration are reported; with
+write-behind the handler still waits for the write, only the client stops waiting for it.
+
+The retry behaviour is checked afterwards: replaying the same event stores a single item, and another
+request landing on the same second is stored next to it instead of overwriting it, even when the
+body object offloaded for the lost timestamp cannot be deleted (a role without s3:DeleteObject).
+
+Usage:
+    python backend/benchmarks/bench_history_persistence.py [--requests 20] [--tokens 200] [--put-latency 0.03]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import boto3
+from moto import mock_aws
+
+from fakes import FakeBedrockRuntime, FakeManagementApi, add_source_path, client_error
+
+add_source_path('src/websocket/sendmessage')
+
+TABLE_NAME = 'bench-history-persistence'
+BODY_BUCKET = 'bench-history-persistence-bodies'
+USER = 'bench@example.com'
+
+
+class TimedManagementApi(FakeManagementApi):
+    """Records when the end-of-message signal is posted."""
+
+    def __init__(self):
+        super().__init__()
+        self.ended_at = None
+
+    def post_to_connection(self, ConnectionId, Data):
+        super().post_to_connection(ConnectionId, Data)
+        if json.loads(Data).get('endOfMessage'):
+            self.ended_at = time.perf_counter()
+
+
+class DeleteDeniedS3:
+    """S3 client whose DeleteObject calls are denied, the other calls go to moto."""
+
+    def __init__(self, client):
+        self.client = client
+        self.denied = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def delete_object(self, **kwargs):
+        self.denied += 1
+        raise client_error('AccessDenied', 'Access Denied', 'DeleteObject')
+
+
+def message_event(request_id, request_time):
+    return {
+        'requestContext': {
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': 'bench-connection',
+            'authorizer': {'principalId': USER},
+            'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'bench'},
+            'requestId': request_id,
+            'requestTimeEpoch': request_time
+        },
+        'body': json.dumps({'action': 'sendmessage', 'data': f'Question of {request_id}'})
+    }
+
+
+def large_item(request_id, timestamp):
+    """A history item whose prompt is offloaded to the body bucket."""
+    return {'email': USER, 'timestamp': timestamp, 'requestId': request_id, 'modelId': 'bench',
+            'promptData': 'x' * 70000, 'completion': f'Answer of {request_id}'}
+
+
+def check_cleanup_denied(app, table, s3):
+    """Stores items whose offloaded body cannot be deleted after losing their timestamp to another request."""
+    table.put_item(Item={'email': USER, 'timestamp': '1900000000', 'requestId': 'other'})
+    stored = app.persist_history(table, large_item('collided', '1900000000'), BODY_BUCKET)
+    assert stored == '1900000000.1', stored
+
+    # A compare request whose second timestamp is taken: the transaction is cancelled, then each item is stored
+    table.put_item(Item={'email': USER, 'timestamp': '1900000001.1', 'requestId': 'other'})
+    batch = app.persist_history_batch(table, [large_item(f'compare#{index}', '1900000001') for index in range(2)], BODY_BUCKET)
+    assert batch == ['1900000001', '1900000001.2'], batch
+    stored_ids = [table.get_item(Key={'email': USER, 'timestamp': timestamp})['Item']['requestId'] for timestamp in batch]
+    assert stored_ids == ['compare#0', 'compare#1'], stored_ids
+    print(f"    body delete denied: the colliding item is stored under {stored}, the compare items under {batch} "
+          f"({s3.denied} deletes denied)")
+
+
+def run(app, api, requests, write_behind):
+    os.environ['HISTORY_WRITE_BEHIND'] = 'true' if write_behind else 'false'
+    to_end, durations = [], []
+    for i in range(requests):
+        api.ended_at = None
+        started = time.perf_counter()
+        # Each request gets its own second so the timestamps never collide
+        request_time = (1700000000 if write_behind else 1600000000) * 1000 + i * 1000
+        response = app.handler(message_event(f'{write_behind}-{i}', request_time), None)
+        durations.append((time.perf_counter() - started) * 1000)
+        assert response['statusCode'] == 200, response
+        to_end.append((api.ended_at - started) * 1000)
+    return to_end, durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--put-latency', type=float, default=0.03)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_TABLE'] = TABLE_NAME
+    os.environ.pop('HISTORY_BODY_BUCKET', None)
+
+    with mock_aws():
+        boto3.client('s3').create_bucket(Bucket=BODY_BUCKET)
+        boto3.client('dynamodb').create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}, {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}, {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+        import app
+        from assistant_common import clients
+
+        api = TimedManagementApi()
+        bedrock = FakeBedrockRuntime(tokens=args.tokens)
+        get_client = clients.get_client
+        app.get_client = lambda service_name, endpoint_url=None: bedrock if service_name == 'bedrock-runtime' else get_client(service_name, endpoint_url)
+        app.get_management_api = lambda domain_name, stage: api
+
+        table = clients.get_table(TABLE_NAME)
+
+        def slow_put(model, **kwargs):
+            if model.name == 'PutItem':
+                time.sleep(args.put_latency)
+
+        table.meta.client.meta.events.register('before-call.dynamodb', slow_put)
+
+        print(f"{args.requests} requests, {args.tokens} tokens, PutItem {args.put_latency * 1000:.0f} ms")
+        for label, write_behind in (('write before end', False), ('write behind end', True)):
+            to_end, durations = run(app, api, args.requests, write_behind)
+            print(f"    {label:17s} endOfMessage after {statistics.median(to_end):6.1f} ms (median), "
+                  f"handler {statistics.median(durations):6.1f} ms")
+
+        # Replaying a request stores it once, another request in the same second gets its own item
+        os.environ['HISTORY_WRITE_BEHIND'] = 'true'
+        for request_id in ('retried', 'retried', 'same-second'):
+            app.handler(message_event(request_id, 1800000000000), None)
+        stored = table.query(
+            KeyConditionExpression='email = :email AND begins_with(#ts, :second)',
+            ExpressionAttributeNames={'#ts': 'timestamp'},
+            ExpressionAttributeValues={':email': USER, ':second': '1800000000'}
+        )['Items']
+        print(f"    replay check: {sorted((item['timestamp'], item['requestId']) for item in stored)}")
+        assert sorted(item['requestId'] for item in stored) == ['retried', 'same-second'], stored
+
+        s3 = DeleteDeniedS3(get_client('s3'))
+        app.get_client = lambda service_name, endpoint_url=None: s3 if service_name == 's3' else get_client(service_name, endpoint_url)
+        check_cleanup_denied(app, table, s3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Measures `get_images_from_s3_as_base64` against a local S3 stand-in (moto) with artificial latency.
+
+The serial baseline reproduces the previous one-object-at-a-time download loop.
+
+Usage:
+    python backend/benchmarks/bench_image_fetch.py [--images 6] [--size 524288] [--latency 0.05]
+"""
+import argparse
+import os
+import time
+
+import boto3
+from moto import mock_aws
+
+from fakes import add_source_path
+
+add_source_path('src/websocket/sendmessage')
+
+BUCKET = 'bench-image-upload-bucket'
+
+
+def serial_fetch(s3, image_keys):
+    image_data_list = []
+    for key in image_keys:
+        response = s3.get_object(Bucket=BUCKET, Key=key)
+        image_data_list.append({'data': response['Body'].read(), 'format': key.split('.')[-1]})
+    return image_data_list
+
+
+def add_latency(client, latency):
+    # Every GetObject round trip waits `latency` seconds, like a real S3 request would
+    client.meta.events.register('before-call.s3.GetObject', lambda **kwargs: time.sleep(latency))
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=6)
+    parser.add_argument('--size', type=int, default=512 * 1024, help='Bytes per image')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per GetObject')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['IMAGE_UPLOAD_BUCKET'] = BUCKET
+
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        keys = [f'image-{i}.png' for i in range(args.images)]
+        for key in keys:
+            s3.put_object(Bucket=BUCKET, Key=key, Body=os.urandom(args.size))
+        # One object above the per-image budget is rejected from its ContentLength, without reading it
+        s3.put_object(Bucket=BUCKET, Key='oversized.png', Body=os.urandom(32 * 1024 * 1024))
+
+        import app
+        from assistant_common.clients import get_client
+
+        add_latency(s3, args.latency)
+        add_latency(get_client('s3'), args.latency)
+
+        serial_seconds, _ = timed(lambda: serial_fetch(s3, keys), args.repeat)
+        parallel_seconds, images = timed(lambda: app.get_images_from_s3_as_base64(keys), args.repeat)
+        _, with_oversized = timed(lambda: app.get_images_from_s3_as_base64(keys[:1] + ['oversized.png', 'missing.png']), 1)
+
+    print(f"serial    {serial_seconds * 1000:8.1f} ms for {args.images} images")
+    print(f"parallel  {parallel_seconds * 1000:8.1f} ms for {sum(1 for i in images if i)} images")
+    print(f"budget    results for [ok, oversized, missing]: {[bool(i) for i in with_oversized]}")
+
+
+if __name__ == '__main__':
+    main()
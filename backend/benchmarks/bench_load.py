@@ -0,0 +1,461 @@
+"""
+End-to-end load and latency harness for the WebSocket and REST handlers, run offline.
+
+The real sendmessage, chat, history and templates handlers are driven by synthetic API Gateway
+events from --users concurrent simulated users (one thread each, sending --requests requests one
+after the other). Bedrock is a scripted ConverseStream with a configurable time-to-first-token and
+token rate, the API Gateway management API is a recording fake, and DynamoDB and S3 are moto.
+
+The routes run one after the other, each with its own environment (sendmessage and chat both read
+DYNAMODB_TABLE), and sendmessage fills the history table that the history route then reads. For
+each route the report gives:
+- p50/p95/p99 of the handler time and of every stage of the request traces (see assistant_common.tracing);
+- AWS calls per request by service and operation, fakes included;
+- the peak resident memory of the process during the route, and its growth over the route start.
+
+With --check the report is compared with load_baseline.json, and the script exits with status 1
+when a p95 latency, a call count or the memory growth regresses past the tolerances, so it can run
+in CI. --update-baseline rewrites the baseline from the current run; regenerate it on the machine
+running the checks, the latencies depend on it.
+
+Usage:
+    python backend/benchmarks/bench_load.py [--users 20] [--requests 5] [--tokens 200] [--ttft 0.2]
+        [--tokens-per-second 200] [--templates 2000] [--output report.json] [--check] [--update-baseline]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+import boto3
+from botocore.client import BaseClient
+from moto import mock_aws
+
+from fakes import BACKEND_DIR, FakeBedrockRuntime, FakeManagementApi, add_source_path
+
+add_source_path()
+
+from assistant_common.clients import get_client
+from assistant_common.history_items import SUMMARY_ATTRIBUTES, SUMMARY_INDEX
+from assistant_common.tracing import LocalCollector
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_baseline.json')
+
+HISTORY_TABLE = 'load-history'
+CHAT_TABLE = 'load-chat'
+TEMPLATES_TABLE = 'load-templates'
+ADMISSION_TABLE = 'load-admission'
+CONNECTIONS_TABLE = 'load-connections'
+STREAM_BUFFER_TABLE = 'load-stream-buffer'
+BODY_BUCKET = 'load-history-bodies'
+INDEX_BUCKET = 'load-templates-index'
+MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
+SEARCH_WORDS = ['summarize', 'meeting', 'email', 'translate', 'review', 'report', 'blog', 'interview', 'plan', 'sql']
+
+
+def user_email(user):
+    return f'load-user{user}@example.com'
+
+
+def load_handler(alias, relative_dir, module_name):
+    """Imports a handler module under a unique name, its folder on the path like in its Lambda function."""
+    path = os.path.join(BACKEND_DIR, relative_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(alias, os.path.join(path, f'{module_name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def websocket_event(user, request_id, body, request_time):
+    return {
+        'requestContext': {
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': request_id,
+            'authorizer': {'principalId': user_email(user)},
+            'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'load'},
+            'requestId': request_id,
+            'requestTimeEpoch': request_time
+        },
+        'body': json.dumps(body)
+    }
+
+
+def rest_event(user, params):
+    return {
+        'httpMethod': 'GET',
+        'requestContext': {'authorizer': {'claims': {'email': user_email(user)}}},
+        'queryStringParameters': params
+    }
+
+
+def create_resources():
+    dynamodb = boto3.client('dynamodb')
+    key = lambda hash_key, range_key: [{'AttributeName': hash_key, 'KeyType': 'HASH'}, {'AttributeName': range_key, 'KeyType': 'RANGE'}]
+    strings = lambda *names: [{'AttributeName': name, 'AttributeType': 'S'} for name in names]
+    dynamodb.create_table(
+        TableName=HISTORY_TABLE, KeySchema=key('email', 'timestamp'), AttributeDefinitions=strings('email', 'timestamp'),
+        GlobalSecondaryIndexes=[{
+            'IndexName': SUMMARY_INDEX,
+            'KeySchema': key('email', 'timestamp'),
+            'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': [name for name in SUMMARY_ATTRIBUTES if name not in ('email', 'timestamp')]}
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    dynamodb.create_table(TableName=CHAT_TABLE, KeySchema=key('SessionId', 'Email'), AttributeDefinitions=strings('SessionId', 'Email'), BillingMode='PAY_PER_REQUEST')
+    index = lambda name, attribute: {'IndexName': name, 'KeySchema': key(attribute, 'dateCreated'), 'Projection': {'ProjectionType': 'ALL'}}
+    dynamodb.create_table(
+        TableName=TEMPLATES_TABLE,
+        KeySchema=[{'AttributeName': 'templateId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=strings('templateId', 'createdBy', 'visibility', 'dateCreated'),
+        GlobalSecondaryIndexes=[index('createdBy-dateCreated-index', 'createdBy'), index('visibility-dateCreated-index', 'visibility')],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    dynamodb.create_table(
+        TableName=ADMISSION_TABLE, KeySchema=[{'AttributeName': 'bucketKey', 'KeyType': 'HASH'}],
+        AttributeDefinitions=strings('bucketKey'), BillingMode='PAY_PER_REQUEST'
+    )
+    dynamodb.create_table(
+        TableName=CONNECTIONS_TABLE, KeySchema=[{'AttributeName': 'connectionId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=strings('connectionId'), BillingMode='PAY_PER_REQUEST'
+    )
+    dynamodb.create_table(
+        TableName=STREAM_BUFFER_TABLE, KeySchema=[{'AttributeName': 'streamId', 'KeyType': 'HASH'}, {'AttributeName': 'seq', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'streamId', 'AttributeType': 'S'}, {'AttributeName': 'seq', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BODY_BUCKET)
+    s3.create_bucket(Bucket=INDEX_BUCKET)
+
+
+def seed_templates(count, users):
+    rng = random.Random(11)
+    table = boto3.resource('dynamodb').Table(TEMPLATES_TABLE)
+    with table.batch_writer() as writer:
+        for i in range(count):
+            created = f'{1714852452 + i}.{i:06d}'
+            words = rng.sample(SEARCH_WORDS, 3)
+            writer.put_item(Item={
+                'templateId': created,
+                'dateCreated': created,
+                'createdBy': user_email(i % (users * 5)),
+                'visibility': 'public' if rng.random() < 0.2 else 'private',
+                'templateName': f'{words[0].capitalize()} {words[1]} template {i}',
+                'templateDescription': f'Helps to {words[0]} and {words[2]} documents for the team.',
+                'tags': words,
+                'modelversion': MODEL_ID,
+                'templatePrompt': 'Use the following text: ${INPUT_DATA}'
+            })
+
+
+class CallCounter:
+    """Counts the AWS API calls of every boto3 client by service and operation, while in use as a context manager."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._original = None
+
+    def __enter__(self):
+        original = self._original = BaseClient._make_api_call
+        counter = self
+
+        def counting_api_call(client, operation_name, api_params):
+            with counter._lock:
+                counter.calls[f'{client.meta.service_model.endpoint_prefix}.{operation_name}'] += 1
+            return original(client, operation_name, api_params)
+
+        BaseClient._make_api_call = counting_api_call
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        BaseClient._make_api_call = self._original
+        return False
+
+
+class PeakMemory:
+    """
+    Samples the resident set size of the process in a background thread, to report the peak of a phase.
+
+    Reads /proc/self/statm, so it is Linux only; elsewhere the peak of the whole process is reported.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_bytes = 0
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, self.rss())
+
+    def __enter__(self):
+        self.start_bytes = self.peak_bytes = self.rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self.rss())
+        return False
+
+
+def percentiles(values):
+    values = sorted(values)
+    pick = lambda fraction: round(values[min(len(values) - 1, int(len(values) * fraction))], 2)
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'count': len(values)}
+
+
+def run_route(route, users, requests, send, fake_calls, quiet=True):
+    """
+    Runs `requests` requests for each of `users` concurrent users and measures them.
+
+    An extra user first sends the same requests on its own, unmeasured except for its first request
+    ('firstRequestMs'): it pays the client setup and the lazily built state (the templates search
+    index, the listing cache) like the first requests of a container. The simulated users share one
+    process, so they would otherwise all build that state at once, which a Lambda container never does.
+
+    Args:
+        route (str): The route name, as in the 'Route' dimension of its traces.
+        send (callable): Sends request `index` of `user` to the handler and returns its response.
+        fake_calls (callable): Returns the calls made so far to the fake clients, by 'service.operation'.
+        quiet (bool, optional): Drop what the handlers print (their Lambda logs).
+
+    Returns:
+        dict: The route report.
+    """
+    handler_ms = []
+    errors = Counter()
+    output = open(os.devnull, 'w') if quiet else sys.stdout
+
+    def simulated_user(user):
+        for index in range(requests):
+            started = time.perf_counter()
+            response = send(user, index)
+            handler_ms.append((time.perf_counter() - started) * 1000)
+            if response.get('statusCode') != 200:
+                errors[response.get('statusCode')] += 1
+
+    with redirect_stdout(output), LocalCollector():
+        for index in range(requests):
+            started = time.perf_counter()
+            response = send(users, index)
+            if index == 0:
+                first_request_ms = (time.perf_counter() - started) * 1000
+            if response.get('statusCode') != 200:
+                errors[response.get('statusCode')] += 1
+
+    fakes_before = fake_calls()
+    with redirect_stdout(output), LocalCollector() as collector, CallCounter() as counter, PeakMemory() as memory:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=users) as executor:
+            list(executor.map(simulated_user, range(users)))
+        wall = time.perf_counter() - started
+
+    total = users * requests
+    calls = counter.calls + (fake_calls() - fakes_before)
+    stages = {'handlerMs': percentiles(handler_ms)}
+    records = [record for record in collector.records if record.get('Route') == route]
+    for name in sorted({name for record in records for name in record if name.endswith('Ms') and name != 'durationMs'}):
+        stages[name] = percentiles(collector.values(name))
+    return {
+        'requests': total,
+        'errors': dict(errors),
+        'throughputPerSecond': round(total / wall, 1),
+        'firstRequestMs': round(first_request_ms, 1),
+        'stages': stages,
+        'callsPerRequest': {name: round(count / total, 2) for name, count in sorted(calls.items())},
+        'peakRssMb': round(memory.peak_bytes / 2**20, 1),
+        'rssGrowthMb': round((memory.peak_bytes - memory.start_bytes) / 2**20, 1)
+    }
+
+
+def run(args):
+    """Runs every route and returns the report."""
+    os.environ.update({
+        'TRACING_ENABLED': 'true',
+        'HISTORY_BODY_BUCKET': BODY_BUCKET,
+        'TEMPLATES_TABLE': TEMPLATES_TABLE,
+        'TEMPLATES_INDEX_BUCKET': INDEX_BUCKET,
+        'TEMPLATES_INDEX_PATH': os.path.join(tempfile.mkdtemp(), 'templates-search-index.bin.gz'),
+        'CHAT_ENGINE': 'native',
+        # The rate limits are on, with room for every simulated user: the routes pay for the bucket
+        # updates but no request is queued or rejected
+        'ADMISSION_TABLE': ADMISSION_TABLE,
+        'ADMISSION_USER_RATE_PER_MINUTE': '6000',
+        'ADMISSION_USER_BURST': '100',
+        'ADMISSION_MODEL_RATE_PER_MINUTE': '60000',
+        'ADMISSION_MODEL_BURST': '1000',
+        # Generations register on their connection and poll its cancellation flag, as deployed
+        'CONNECTIONS_TABLE': CONNECTIONS_TABLE,
+        # sendmessage answers are buffered for resumption
+        'STREAM_BUFFER_TABLE': STREAM_BUFFER_TABLE
+    })
+    os.environ.pop('RESPONSE_CACHE_TABLE', None)
+    bedrock = FakeBedrockRuntime(tokens=args.tokens, first_token_delay=args.ttft, token_delay=1 / args.tokens_per_second)
+    api = FakeManagementApi(post_latency=args.post_latency)
+    fake_calls = lambda: Counter({'bedrock-runtime.ConverseStream': len(bedrock.calls), 'execute-api.PostToConnection': len(api.posts)})
+    clients = lambda service_name, endpoint_url=None: bedrock if service_name == 'bedrock-runtime' else get_client(service_name, endpoint_url)
+    request_times = iter(range(1700000000000, 1800000000000, 1000))
+    lock = threading.Lock()
+
+    def next_request_time():
+        with lock:
+            return next(request_times)
+
+    report = {}
+    create_resources()
+    seed_templates(args.templates, args.users)
+
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+    sendmessage = load_handler('sendmessage_app', 'src/websocket/sendmessage', 'app')
+    sendmessage.get_client = clients
+    sendmessage.get_management_api = lambda domain_name, stage: api
+    report['sendmessage'] = run_route('sendmessage', args.users, args.requests, lambda user, index: sendmessage.handler(websocket_event(
+        user, f'send-{user}-{index}',
+        {'action': 'sendmessage', 'data': f'Draft a status update number {index} for the team.', 'modelId': MODEL_ID},
+        next_request_time()
+    ), None), fake_calls, not args.verbose)
+
+    os.environ['DYNAMODB_TABLE'] = CHAT_TABLE
+    chat = load_handler('chat_app', 'src/websocket/chat', 'app')
+    chat.get_client = clients
+    chat.get_management_api = lambda domain_name, stage: api
+    report['chat'] = run_route('chat', args.users, args.requests, lambda user, index: chat.handler(websocket_event(
+        user, f'chat-{user}-{index}',
+        {'action': 'chat', 'session_id': f'load-session-{user}', 'modelId': MODEL_ID, 'data': f'Follow-up question {index} about the plan.'},
+        next_request_time()
+    ), None), fake_calls, not args.verbose)
+
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+    history = load_handler('history_handler', 'src/history', 'history')
+    history_views = [{'view': 'summary'}, {}, {'view': 'summary', 'limit': '25'}]
+    report['history'] = run_route('history', args.users, args.requests, lambda user, index: history.handler(rest_event(
+        user, {'email': user_email(user), **history_views[index % len(history_views)]}
+    ), None), fake_calls, not args.verbose)
+
+    templates = load_handler('templates_handler', 'src/templates', 'templates')
+    template_queries = [
+        lambda user, index: {'search': SEARCH_WORDS[(user + index) % len(SEARCH_WORDS)]},
+        lambda user, index: {'visibility': 'public'},
+        lambda user, index: {'createdBy': user_email(user)},
+        lambda user, index: {'search': f'{SEARCH_WORDS[index % len(SEARCH_WORDS)]} {SEARCH_WORDS[user % len(SEARCH_WORDS)][:3]}'},
+    ]
+    report['templates'] = run_route('templates', args.users, args.requests, lambda user, index: templates.handler(rest_event(
+        user, template_queries[index % len(template_queries)](user, index)
+    ), None), fake_calls, not args.verbose)
+    return report
+
+
+def regressions(report, baseline, latency_tolerance, latency_slack_ms, calls_tolerance, memory_slack_mb):
+    """Returns the regressions of `report` against `baseline`, as messages."""
+    found = []
+    for route, base in baseline['routes'].items():
+        current = report['routes'].get(route)
+        if current is None:
+            found.append(f"{route}: not run")
+            continue
+        if current['errors']:
+            found.append(f"{route}: errors {current['errors']}")
+        for stage, base_stage in base['stages'].items():
+            limit = base_stage['p95'] * (1 + latency_tolerance) + latency_slack_ms
+            value = current['stages'].get(stage, {}).get('p95')
+            if value is not None and value > limit:
+                found.append(f"{route}: {stage} p95 {value} ms > {limit:.1f} ms (baseline {base_stage['p95']} ms)")
+        for call in set(base['callsPerRequest']) | set(current['callsPerRequest']):
+            value, base_value = current['callsPerRequest'].get(call, 0), base['callsPerRequest'].get(call, 0)
+            # Posts depend on timing (deltas are flushed on an interval), so call counts get a relative tolerance too
+            if value > base_value * (1 + calls_tolerance) + 0.05:
+                found.append(f"{route}: {call} {value} calls per request > baseline {base_value}")
+        limit = base['rssGrowthMb'] * (1 + latency_tolerance) + memory_slack_mb
+        if current['rssGrowthMb'] > limit:
+            found.append(f"{route}: memory growth {current['rssGrowthMb']} MB > {limit:.1f} MB (baseline {base['rssGrowthMb']} MB)")
+    return found
+
+
+def print_report(report):
+    config = report['config']
+    print(f"{config['users']} concurrent users x {config['requests']} requests per route, {config['tokens']} tokens per answer, "
+          f"time-to-first-token {config['ttft'] * 1000:.0f} ms, {config['tokensPerSecond']} tokens/s")
+    for route, result in report['routes'].items():
+        print(f"\n{route}: {result['requests']} requests, {result['throughputPerSecond']} req/s, errors {result['errors'] or 0}, "
+              f"first request {result['firstRequestMs']} ms, peak RSS {result['peakRssMb']} MB (+{result['rssGrowthMb']} MB)")
+        for stage, values in result['stages'].items():
+            print(f"    {stage:24s} p50 {values['p50']:8.1f} ms   p95 {values['p95']:8.1f} ms   p99 {values['p99']:8.1f} ms")
+        print("    calls per request: " + ', '.join(f"{name} {count:g}" for name, count in result['callsPerRequest'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=5, help='Requests per user and route')
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--ttft', type=float, default=0.2, help='Time-to-first-token of the fake model, in seconds')
+    parser.add_argument('--tokens-per-second', type=float, default=200)
+    parser.add_argument('--post-latency', type=float, default=0.002, help='Seconds per PostToConnection call')
+    parser.add_argument('--templates', type=int, default=2000)
+    parser.add_argument('--verbose', action='store_true', help='Show the logs printed by the handlers')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    parser.add_argument('--check', action='store_true', help='Compare with load_baseline.json, exit with status 1 on regression')
+    parser.add_argument('--update-baseline', action='store_true', help='Write this run to load_baseline.json')
+    parser.add_argument('--latency-tolerance', type=float, default=0.5, help='Allowed relative p95 and memory increase')
+    parser.add_argument('--latency-slack-ms', type=float, default=20)
+    parser.add_argument('--calls-tolerance', type=float, default=0.25, help='Allowed relative increase of calls per request')
+    parser.add_argument('--memory-slack-mb', type=float, default=32)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        routes = run(args)
+    report = {
+        'config': {
+            'users': args.users, 'requests': args.requests, 'tokens': args.tokens, 'ttft': args.ttft,
+            'tokensPerSecond': args.tokens_per_second, 'postLatency': args.post_latency, 'templates': args.templates
+        },
+        'routes': routes
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"\nBaseline written to {BASELINE_FILE}")
+    if args.check:
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+        if baseline['config'] != report['config']:
+            print(f"\nWarning: the baseline was recorded with {baseline['config']}")
+        found = regressions(report, baseline, args.latency_tolerance, args.latency_slack_ms, args.calls_tolerance, args.memory_slack_mb)
+        print('\n' + ('\n'.join(f"REGRESSION {message}" for message in found) if found else 'No regression against the baseline'))
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
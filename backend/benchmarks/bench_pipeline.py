@@ -0,0 +1,77 @@
+"""
+Compares serial and pipelined consumption of a model stream against a slow WebSocket client.
+
+Also reports the CPU time of each mode, which must stay well below the wall time (the consumer
+waits for events, it does not poll), and how long the handler waits for the stream to close when
+the client disconnects during a pause of the model.
+
+Usage:
+    python backend/benchmarks/bench_pipeline.py [--tokens 300] [--token-delay 0.002] [--post-latency 0.02]
+"""
+import argparse
+import time
+from contextlib import closing
+
+from fakes import FakeConverseStream, FakeManagementApi, add_source_path
+
+add_source_path()
+
+from assistant_common.delivery import ConnectionGoneError, FlushPolicy, StreamDelivery
+from assistant_common.pipeline import PipelinedStream
+
+
+def run(pipelined, args, gone_after=None, token_delay=None):
+    stream = FakeConverseStream(tokens=args.tokens, token_delay=args.token_delay if token_delay is None else token_delay)
+    api = FakeManagementApi(post_latency=args.post_latency, gone_after=gone_after)
+    # Post every delta so that the cost of a slow connection is fully visible
+    delivery = StreamDelivery(api, 'bench', policy=FlushPolicy(interval_ms=0, max_bytes=0))
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    gone_at = None
+    events = PipelinedStream(stream, delivery) if pipelined else closing(stream)
+    try:
+        with events as chunks:
+            for chunk in chunks:
+                if 'contentBlockDelta' in chunk:
+                    try:
+                        delivery.send(chunk['contentBlockDelta']['delta']['text'])
+                    except ConnectionGoneError:
+                        gone_at = time.perf_counter()
+                        raise
+        delivery.end()
+    except ConnectionGoneError:
+        pass
+    return {
+        'seconds': time.perf_counter() - started,
+        'cpuSeconds': time.process_time() - cpu_started,
+        'closeSeconds': time.perf_counter() - gone_at if gone_at else 0,
+        'tokensGenerated': stream.emitted,
+        'posts': len(api.posts)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=300)
+    parser.add_argument('--token-delay', type=float, default=0.002)
+    parser.add_argument('--post-latency', type=float, default=0.004)
+    args = parser.parse_args()
+
+    for mode, pipelined in (('serial', False), ('pipeline', True)):
+        result = run(pipelined, args)
+        print(f"{mode:9} {result['seconds'] * 1000:8.1f} ms  cpu {result['cpuSeconds'] * 1000:8.1f} ms  posts={result['posts']}")
+
+    # The client disconnects after 20 posts: generation must stop instead of running to the end
+    for mode, pipelined in (('serial', False), ('pipeline', True)):
+        result = run(pipelined, args, gone_after=20)
+        print(f"{mode:9} gone after 20 posts: {result['tokensGenerated']}/{args.tokens} tokens generated")
+
+    # The client disconnects while the model pauses 1 s between tokens: the handler must not wait for the next token
+    for mode, pipelined in (('serial', False), ('pipeline', True)):
+        result = run(pipelined, args, gone_after=1, token_delay=1.0)
+        print(f"{mode:9} gone during a 1 s pause: closed in {result['closeSeconds'] * 1000:.1f} ms, cpu {result['cpuSeconds'] * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Measures Bedrock prompt caching on a multi-turn chat with a long system prompt, and checks the
+requests and the usage accounting.
+
+The native chat engine runs through the real chat handler against a moto DynamoDB table, a fake API
+Gateway management API and a Bedrock stub simulating prompt caching (see FakePromptCachingBedrock):
+the stub rejects misplaced cache points, reports cache reads and writes, and makes time-to-first-token
+grow with the input tokens that are not read from the cache. The same conversation runs with
+PROMPT_CACHE=false and true; the input tokens processed, the cache reads and writes and the
+time-to-first-token of each run are reported. The checks cover the position of the cache points,
+the usage in the end-of-message frame and on the stored AI messages, models without prompt caching,
+and the usage stored in sendmessage history items.
+
+Usage:
+    python backend/benchmarks/bench_prompt_cache.py [--turns 10] [--system-chars 12000] [--delay-per-token 0.00002]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+
+import boto3
+from moto import mock_aws
+
+from fakes import FakeManagementApi, FakePromptCachingBedrock, add_source_path
+
+add_source_path('src/websocket/chat')
+
+from assistant_common.tracing import LocalCollector
+
+CHAT_TABLE = 'bench-prompt-cache-chat'
+HISTORY_TABLE = 'bench-prompt-cache-history'
+USER = 'bench@example.com'
+MODEL_ID = 'us.anthropic.claude-3-7-sonnet-20250219-v1:0'
+
+
+def request_context(request_id):
+    return {
+        'authorizer': {'principalId': USER},
+        'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+        'stage': 'Prod',
+        'connectionId': request_id,
+        'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'bench'},
+        'requestId': request_id,
+        'requestTimeEpoch': 1700000000000
+    }
+
+
+def chat_event(session_id, turn, system_prompt, model_id):
+    return {
+        'requestContext': request_context(f'{session_id}-{turn}'),
+        'body': json.dumps({
+            'action': 'chat', 'engine': 'native', 'session_id': session_id, 'modelId': model_id,
+            'system_prompt': system_prompt, 'data': f'Question {turn}: ' + 'how does this apply to our team? ' * 20
+        })
+    }
+
+
+def create_tables():
+    dynamodb = boto3.client('dynamodb')
+    dynamodb.create_table(
+        TableName=CHAT_TABLE,
+        KeySchema=[{'AttributeName': 'SessionId', 'KeyType': 'HASH'}, {'AttributeName': 'Email', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'SessionId', 'AttributeType': 'S'}, {'AttributeName': 'Email', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    dynamodb.create_table(
+        TableName=HISTORY_TABLE,
+        KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}, {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}, {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def cache_points(call):
+    blocks = call.get('system', []) + [block for message in call['messages'] for block in message['content']]
+    return sum(1 for block in blocks if 'cachePoint' in block)
+
+
+def run_chat(app, args, session_id, system_prompt, model_id):
+    api = FakeManagementApi()
+    bedrock = FakePromptCachingBedrock(tokens=50, delay_per_input_token=args.delay_per_token)
+    app.get_client = lambda service_name, endpoint_url=None: bedrock
+    app.get_management_api = lambda domain_name, stage: api
+    with LocalCollector() as collector:
+        for turn in range(args.turns):
+            response = app.handler(chat_event(session_id, turn, system_prompt, model_id), None)
+            assert response['statusCode'] == 200, response
+    return bedrock, api, collector
+
+
+def check_chat(bedrock, api, table, session_id):
+    for turn, call in enumerate(bedrock.calls):
+        # The system prompt is always closed by a cache point, the history from the second turn on
+        assert call['system'][-1] == {'cachePoint': {'type': 'default'}}, call['system']
+        assert cache_points(call) == (1 if turn == 0 else 2), call
+        assert 'cachePoint' not in str(call['messages'][-1]), 'the new question must not be cached'
+    ends = [message for message in api.messages() if message.get('endOfMessage')]
+    for end, stream in zip(ends, bedrock.streams):
+        assert end['usage']['cacheReadInputTokens'] == stream.usage['cacheReadInputTokens'], end
+    history = table.get_item(Key={'SessionId': session_id, 'Email': USER})['Item']['History']
+    answer = history[-1]['data']
+    assert answer['usage_metadata']['input_token_details']['cache_read'] == ends[-1]['usage']['cacheReadInputTokens'], answer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--system-chars', type=int, default=12000)
+    parser.add_argument('--delay-per-token', type=float, default=0.00002)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_TABLE'] = CHAT_TABLE
+    os.environ['STREAM_PIPELINE'] = 'false'
+    system_prompt = ('You are the onboarding assistant of the engineering team. Follow the handbook below. ' * 200)[:args.system_chars]
+
+    with mock_aws():
+        create_tables()
+        import app
+        table = boto3.resource('dynamodb').Table(CHAT_TABLE)
+
+        print(f"{args.turns} chat turns, system prompt of {args.system_chars // 4} tokens, model {MODEL_ID}")
+        for label, enabled in (('no cache points', 'false'), ('cache points', 'true')):
+            os.environ['PROMPT_CACHE'] = enabled
+            session_id = f'session-{enabled}'
+            bedrock, api, collector = run_chat(app, args, session_id, system_prompt, MODEL_ID)
+            processed = sum(stream.usage['inputTokens'] + stream.usage['cacheWriteInputTokens'] for stream in bedrock.streams)
+            read = sum(stream.usage['cacheReadInputTokens'] for stream in bedrock.streams)
+            written = sum(stream.usage['cacheWriteInputTokens'] for stream in bedrock.streams)
+            print(f"    {label:16s} input tokens processed {processed:6d}, cache reads {read:6d}, cache writes {written:6d}, "
+                  f"median time-to-first-token {statistics.median(collector.values('timeToFirstTokenMs')):6.1f} ms")
+            if enabled == 'true':
+                check_chat(bedrock, api, table, session_id)
+            else:
+                assert all(cache_points(call) == 0 for call in bedrock.calls)
+
+        # Models without prompt caching get the request unchanged
+        os.environ['PROMPT_CACHE'] = 'true'
+        bedrock, _, _ = run_chat(app, argparse.Namespace(turns=2, delay_per_token=0), 'session-llama', system_prompt, 'meta.llama3-70b-instruct-v1:0')
+        assert all(cache_points(call) == 0 for call in bedrock.calls)
+
+    # sendmessage stores the usage, cache reads included, on the history item
+    sys.modules.pop('app')
+    add_source_path('src/websocket/sendmessage')
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+    os.environ.pop('RESPONSE_CACHE_TABLE', None)
+    with mock_aws():
+        create_tables()
+        import app
+        api = FakeManagementApi()
+        bedrock = FakePromptCachingBedrock(tokens=20)
+        app.get_client = lambda service_name, endpoint_url=None: bedrock
+        app.get_management_api = lambda domain_name, stage: api
+        for i in range(2):
+            context = dict(request_context(f'template-run-{i}'), requestTimeEpoch=1700000000000 + i * 1000)
+            event = {'requestContext': context, 'body': json.dumps({'action': 'sendmessage', 'data': f'Input {i}', 'modelId': MODEL_ID, 'system': system_prompt})}
+            assert app.handler(event, None)['statusCode'] == 200
+        items = boto3.resource('dynamodb').Table(HISTORY_TABLE).scan()['Items']
+        usage = [item['usage'] for item in sorted(items, key=lambda item: item['timestamp'])]
+        assert usage[0]['cacheWriteInputTokens'] > 0 and usage[1]['cacheReadInputTokens'] == usage[0]['cacheWriteInputTokens'], usage
+        print(f"    sendmessage history usage: first run {json.dumps(usage[0], default=int)}, second run {json.dumps(usage[1], default=int)}")
+    print("    request shape and usage checks passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Measures the response cache on repeated deterministic template runs.
+
+The real sendmessage handler runs against a fake ConverseStream (with a time-to-first-token and a
+token rate), a fake API Gateway management API and moto DynamoDB tables for the history and the
+cache. Requests cycle through --distinct prompts with "cache": true at temperature 0, and every
+--container-every requests the in-memory LRU is dropped to stand in for a new container, which then
+reads the table. The hit rate, the saved tokens and the latency of hits and misses are reported.
+
+Usage:
+    python backend/benchmarks/bench_response_cache.py [--requests 200] [--distinct 20] [--tokens 300] [--container-every 50]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import boto3
+from moto import mock_aws
+
+from fakes import FakeBedrockRuntime, FakeManagementApi, add_source_path
+
+add_source_path('src/websocket/sendmessage')
+
+HISTORY_TABLE = 'bench-cache-history'
+CACHE_TABLE = 'bench-response-cache'
+USER = 'bench@example.com'
+
+
+def template_event(i, prompt):
+    return {
+        'requestContext': {
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': f'connection-{i}',
+            'authorizer': {'principalId': USER},
+            'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'bench'},
+            'requestId': f'request-{i}',
+            'requestTimeEpoch': 1700000000000 + i * 1000
+        },
+        'body': json.dumps({
+            'action': 'sendmessage', 'data': prompt, 'system': 'You are a meeting notes assistant.',
+            'temperature': 0, 'cache': True
+        })
+    }
+
+
+def create_tables():
+    dynamodb = boto3.client('dynamodb')
+    dynamodb.create_table(
+        TableName=HISTORY_TABLE,
+        KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}, {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}, {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    dynamodb.create_table(
+        TableName=CACHE_TABLE,
+        KeySchema=[{'AttributeName': 'cacheKey', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'cacheKey', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def median_ms(latencies):
+    """Formats the median of request latencies, a run may have no hits (or no misses) at all."""
+    return f"{statistics.median(latencies):.1f} ms" if latencies else 'none'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--distinct', type=int, default=20)
+    parser.add_argument('--tokens', type=int, default=300)
+    parser.add_argument('--first-token-delay', type=float, default=0.05)
+    parser.add_argument('--token-delay', type=float, default=0.0005)
+    parser.add_argument('--container-every', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+    os.environ['RESPONSE_CACHE_TABLE'] = CACHE_TABLE
+    os.environ['TRACING_ENABLED'] = 'false'
+    os.environ.pop('HISTORY_BODY_BUCKET', None)
+
+    with mock_aws():
+        create_tables()
+
+        import app
+        from assistant_common import clients
+
+        api = FakeManagementApi()
+        bedrock = FakeBedrockRuntime(tokens=args.tokens, first_token_delay=args.first_token_delay, token_delay=args.token_delay)
+        get_client = clients.get_client
+        app.get_client = lambda service_name, endpoint_url=None: bedrock if service_name == 'bedrock-runtime' else get_client(service_name, endpoint_url)
+        app.get_management_api = lambda domain_name, stage: api
+
+        latencies = {'hit': [], 'miss': []}
+        for i in range(args.requests):
+            if i and i % args.container_every == 0:
+                # A new container starts with an empty LRU and reads the table
+                app.get_response_cache().entries.clear()
+            before = len(bedrock.calls)
+            started = time.perf_counter()
+            response = app.handler(template_event(i, f'Summarize the notes of meeting {i % args.distinct}.'), None)
+            assert response['statusCode'] == 200, response
+            latencies['miss' if len(bedrock.calls) > before else 'hit'].append((time.perf_counter() - started) * 1000)
+
+            text = api.text(f'connection-{i}')
+            assert text == ''.join(f'token{n} ' for n in range(args.tokens)), text[:80]
+
+        stats = app.get_response_cache().stats()
+        history = boto3.resource('dynamodb').Table(HISTORY_TABLE).scan()['Items']
+        cached_items = sum(1 for item in history if item.get('cached'))
+
+        print(f"{args.requests} template runs over {args.distinct} distinct prompts, a new container every {args.container_every}")
+        print(f"    Bedrock invocations {len(bedrock.calls)}, hit rate {stats['hitRate']:.1%} "
+              f"({stats['memoryHits']} in memory, {stats['tableHits']} from the table, {stats['misses']} misses)")
+        print(f"    saved tokens: {stats['savedInputTokens']} input, {stats['savedOutputTokens']} output")
+        print(f"    median latency: miss {median_ms(latencies['miss'])}, hit {median_ms(latencies['hit'])}")
+        print(f"    history items marked cached: {cached_items}/{len(history)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+"""
+Measures resumable sendmessage streams: a client whose WebSocket drops mid-answer reconnects and
+sends {"action": "resume", "streamId", "offset"} to receive the rest of the answer.
+
+The real onconnect, ondisconnect, cancel, sendmessage and resume handlers run against moto
+connections, history and stream buffer tables, a fake API Gateway management API and a slow fake
+ConverseStream (--tokens tokens at --tokens-per-second). The report gives:
+- the cost of buffering: handler time per token with the stream buffer off and on for a model
+  streaming as fast as possible, and the buffer writes of a normal stream (one per
+  STREAM_BUFFER_FLUSH_MS, none per token);
+- a drop after 20% of the answer, resumed --reconnect-delay seconds later: backlog replayed in the
+  first frame, time from the resume action to that frame, how far the followed tail lags behind the
+  generation, and a check that the client ends up with the whole answer exactly once;
+- a drop nobody resumes: the generation stops --grace seconds later (tokens not generated),
+  and a late resume still receives the partial answer and its truncated end frame;
+- a cancel action sent on the resumed connection, which stops the generation;
+- resume actions for unknown streams or streams of another user, which are rejected.
+
+Usage:
+    python backend/benchmarks/bench_resume.py [--tokens 2000] [--tokens-per-second 400] [--flush-ms 250] [--grace 1]
+
+The drops that are resumed run with a grace period of --resume-grace seconds, far longer than
+--reconnect-delay, so a slow machine cannot stop the generation before the resume is recorded.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from functools import partial
+
+import boto3
+from moto import mock_aws
+
+from fakes import BACKEND_DIR, FakeBedrockRuntime, FakeManagementApi, add_source_path
+
+add_source_path()
+
+from assistant_common.clients import get_table
+from assistant_common.history_items import hydrate_bodies
+from assistant_common.stream_buffer import StreamBuffer
+from assistant_common.tracing import LocalCollector
+
+CONNECTIONS_TABLE = 'bench-resume-connections'
+HISTORY_TABLE = 'bench-resume-history'
+STREAM_BUFFER_TABLE = 'bench-stream-buffer'
+USER = 'bench@example.com'
+OTHER_USER = 'other@example.com'
+
+
+def load_handler(alias, relative_dir, module_name='app'):
+    """Imports a handler module under a unique name, its folder on the path like in its Lambda function."""
+    path = os.path.join(BACKEND_DIR, relative_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(alias, os.path.join(path, f'{module_name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def websocket_event(connection_id, request_id, body=None, user=USER):
+    return {
+        'requestContext': {
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': connection_id,
+            'authorizer': {'principalId': user},
+            'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'bench'},
+            'requestId': request_id,
+            'requestTimeEpoch': int(time.time() * 1000)
+        },
+        'body': json.dumps(body) if body is not None else None
+    }
+
+
+def create_tables():
+    dynamodb = boto3.client('dynamodb')
+    strings = lambda *names: [{'AttributeName': name, 'AttributeType': 'S'} for name in names]
+    key = lambda *names: [{'AttributeName': name, 'KeyType': kind} for name, kind in zip(names, ('HASH', 'RANGE'))]
+    dynamodb.create_table(TableName=CONNECTIONS_TABLE, KeySchema=key('connectionId'), AttributeDefinitions=strings('connectionId'), BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(TableName=HISTORY_TABLE, KeySchema=key('email', 'timestamp'), AttributeDefinitions=strings('email', 'timestamp'), BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(TableName=STREAM_BUFFER_TABLE, KeySchema=key('streamId', 'seq'),
+                          AttributeDefinitions=strings('streamId') + [{'AttributeName': 'seq', 'AttributeType': 'N'}], BillingMode='PAY_PER_REQUEST')
+
+
+class Invocation:
+    """Runs a handler on its own thread, recording when it returns."""
+
+    def __init__(self, handler, event):
+        self.response = None
+        self.started_at = time.perf_counter()
+        self.ended_at = None
+        self._thread = threading.Thread(target=self._run, args=(handler, event))
+        self._thread.start()
+
+    def _run(self, handler, event):
+        self.response = handler(event, None)
+        self.ended_at = time.perf_counter()
+
+    def join(self):
+        self._thread.join()
+        return self.response
+
+
+class Routes:
+    def __init__(self, args):
+        self.args = args
+        self.onconnect = load_handler('onconnect_app', 'src/websocket/onconnect')
+        self.ondisconnect = load_handler('ondisconnect_app', 'src/websocket/ondisconnect')
+        self.cancel = load_handler('cancel_app', 'src/websocket/cancel')
+        self.sendmessage = load_handler('sendmessage_app', 'src/websocket/sendmessage')
+        self.resume_app = load_handler('resume_app', 'src/websocket/resume')
+        self.api = FakeManagementApi()
+        self.bedrock = None
+        self.sendmessage.get_client = lambda service_name, endpoint_url=None: self.bedrock
+        for module in (self.sendmessage, self.resume_app):
+            module.get_management_api = lambda domain_name, stage: self.api
+
+    def connect(self, connection_id):
+        assert self.onconnect.handler(websocket_event(connection_id, f'{connection_id}-connect'), None)['statusCode'] == 200
+
+    def send(self, connection_id, request_id, wait_for=0.0, grace=None, **stream_kwargs):
+        """
+        Starts a sendmessage request, returning once `wait_for` of its tokens were generated.
+
+        The stream buffer of the request waits `grace` seconds for a resume after a drop, --resume-grace by default.
+        """
+        grace = self.args.resume_grace if grace is None else grace
+        self.sendmessage.StreamBuffer = partial(StreamBuffer, grace=grace)
+        self.bedrock = FakeBedrockRuntime(tokens=self.args.tokens, token_delay=stream_kwargs.pop('token_delay', 1 / self.args.tokens_per_second), **stream_kwargs)
+        bedrock = self.bedrock
+        body = {'action': 'sendmessage', 'data': 'Write a long story.', 'max_tokens_to_sample': self.args.tokens}
+        generation = Invocation(self.sendmessage.handler, websocket_event(connection_id, request_id, body))
+        while generation.ended_at is None and (not bedrock.streams or bedrock.streams[-1].emitted < self.args.tokens * wait_for):
+            time.sleep(0.005)
+        return generation, bedrock
+
+    def drop(self, connection_id):
+        """The client loses its connection: posts return GoneException and $disconnect runs."""
+        self.api.gone.add(connection_id)
+        self.ondisconnect.handler(websocket_event(connection_id, f'{connection_id}-disconnect'), None)
+        frames = [frame for frame in self.api.messages(connection_id) if 'offset' in frame]
+        return frames[-1]['offset'] if frames else 0
+
+    def resume(self, connection_id, request_id, stream_id, offset, user=USER):
+        self.connect(connection_id)
+        body = {'action': 'resume', 'streamId': stream_id, 'offset': offset}
+        return Invocation(self.resume_app.handler, websocket_event(connection_id, request_id, body, user))
+
+
+def report(line):
+    """Prints a line of the report, the handler logs are silenced while the checks run."""
+    print(line, file=sys.__stdout__, flush=True)
+
+
+def history_item(request_id):
+    items = get_table(HISTORY_TABLE).scan()['Items']
+    return hydrate_bodies(next(item for item in items if item['requestId'] == request_id))
+
+
+def count_calls(table_name):
+    """Counts the DynamoDB API calls made on a table until `stop` is called."""
+    calls = Counter()
+    client = get_table(table_name).meta.client
+    count = lambda params, model, **kwargs: calls.update([model.name]) if params.get('TableName') == table_name else None
+    client.meta.events.register('provide-client-params.dynamodb', count)
+    return calls, lambda: client.meta.events.unregister('provide-client-params.dynamodb', count)
+
+
+def check_overhead(routes):
+    """Handler time per token without token delay, and the buffer writes of a normal stream."""
+    timings = {}
+    for label, table in (('off', None), ('on', STREAM_BUFFER_TABLE)):
+        if table:
+            os.environ['STREAM_BUFFER_TABLE'] = table
+        else:
+            os.environ.pop('STREAM_BUFFER_TABLE', None)
+        routes.connect(f'conn-fast-{label}')
+        best = None
+        for run in range(3):
+            generation, _ = routes.send(f'conn-fast-{label}', f'req-fast-{label}-{run}', token_delay=0)
+            generation.join()
+            elapsed = generation.ended_at - generation.started_at
+            best = elapsed if best is None else min(best, elapsed)
+        timings[label] = best
+    os.environ['STREAM_BUFFER_TABLE'] = STREAM_BUFFER_TABLE
+    per_token = {label: seconds / routes.args.tokens * 1e6 for label, seconds in timings.items()}
+    report(f"    {routes.args.tokens} tokens without delay: {per_token['off']:.1f} us per token with the buffer off, "
+          f"{per_token['on']:.1f} us on (the buffer writes run on their own thread)")
+
+    routes.connect('conn-writes')
+    calls, stop = count_calls(STREAM_BUFFER_TABLE)
+    generation, _ = routes.send('conn-writes', 'req-writes')
+    generation.join()
+    stop()
+    seconds = generation.ended_at - generation.started_at
+    frames = [frame for frame in routes.api.messages('conn-writes') if 'messages' in frame]
+    report(f"    {routes.args.tokens} tokens over {seconds:.1f} s: {len(frames)} frames posted, stream buffer calls {dict(calls)} "
+          f"(one PutItem per {routes.args.flush_ms} ms, none per token)")
+    assert calls['PutItem'] <= seconds * 1000 / routes.args.flush_ms + 3, calls
+    assert frames[-1]['offset'] == len(routes.api.text('conn-writes')) and frames[-1]['streamId'] == 'req-writes'
+
+
+def check_resume(routes):
+    routes.connect('conn-drop')
+    with LocalCollector() as collector:
+        generation, bedrock = routes.send('conn-drop', 'req-drop', wait_for=0.2)
+        offset = routes.drop('conn-drop')
+        time.sleep(routes.args.reconnect_delay)
+        resumed = routes.resume('conn-resumed', 'req-resume', 'req-drop', offset)
+        assert generation.join()['statusCode'] == 200, generation.response
+        assert resumed.join()['statusCode'] == 200, resumed.response
+    received = routes.api.text('conn-drop') + routes.api.text('conn-resumed')
+    item = history_item('req-drop')
+    assert bedrock.streams[-1].emitted == routes.args.tokens and 'truncated' not in item
+    assert received == item['completion'], 'the client did not receive the answer exactly once'
+
+    frames = routes.api.messages('conn-resumed')
+    offsets = [frame['offset'] for frame in frames if 'messages' in frame]
+    assert offsets == sorted(set(offsets)) and frames[-1]['offset'] == len(item['completion']), offsets
+    assert frames[-1]['endOfMessage'] and frames[-1]['usage'], frames[-1]
+    backlog = len(frames[0]['messages'])
+    resume_record = next(record for record in collector.records if record.get('Route') == 'resume')
+    report(f"    drop after {offset} characters, resumed {routes.args.reconnect_delay} s later: first frame replays {backlog} characters "
+          f"{resume_record['timeToFirstTokenMs']:.0f} ms after the resume action, then {len(frames) - 2} tail frames")
+    report(f"        end frame {(resumed.ended_at - generation.ended_at) * 1000:.0f} ms after the generation ended, "
+          f"the client received all {len(received)} characters exactly once, the history item is complete")
+
+
+def check_abandoned(routes):
+    routes.connect('conn-abandoned')
+    generation, bedrock = routes.send('conn-abandoned', 'req-abandoned', wait_for=0.1, grace=routes.args.grace)
+    dropped_at = time.perf_counter()
+    routes.drop('conn-abandoned')
+    assert generation.join()['statusCode'] == 410, generation.response
+    stream = bedrock.streams[-1]
+    item = history_item('req-abandoned')
+    assert item['truncationReason'] == 'disconnected' and stream.closed
+    report(f"    drop not resumed: generation stopped {generation.ended_at - dropped_at:.2f} s after the drop "
+          f"(grace {routes.args.grace} s), {stream.tokens - stream.emitted} of {stream.tokens} tokens not generated")
+
+    late = routes.resume('conn-late', 'req-late', 'req-abandoned', 0)
+    assert late.join()['statusCode'] == 200, late.response
+    frames = routes.api.messages('conn-late')
+    assert routes.api.text('conn-late') == item['completion']
+    assert frames[-1]['truncated'] and frames[-1]['reason'] == 'disconnected', frames[-1]
+    report(f"        a late resume receives the {len(item['completion'])} characters stored and the truncated end frame")
+
+
+def check_cancel(routes):
+    routes.connect('conn-cancel')
+    generation, bedrock = routes.send('conn-cancel', 'req-cancel', wait_for=0.1)
+    offset = routes.drop('conn-cancel')
+    resumed = routes.resume('conn-cancel-resumed', 'req-cancel-resume', 'req-cancel', offset)
+    while not routes.api.messages('conn-cancel-resumed'):
+        time.sleep(0.005)
+    cancelled_at = time.perf_counter()
+    routes.cancel.handler(websocket_event('conn-cancel-resumed', 'req-cancel-action', {'action': 'cancel'}), None)
+    assert generation.join()['statusCode'] == 200, generation.response
+    assert resumed.join()['statusCode'] == 200, resumed.response
+    end = routes.api.messages('conn-cancel-resumed')[-1]
+    assert end['truncated'] and end['reason'] == 'cancelled', end
+    assert history_item('req-cancel')['truncationReason'] == 'cancelled'
+    stream = bedrock.streams[-1]
+    report(f"    cancel on the resumed connection: generation stopped {(generation.ended_at - cancelled_at) * 1000:.0f} ms later, "
+          f"{stream.tokens - stream.emitted} tokens not generated, the resumed client gets the truncated end frame")
+
+
+def check_rejections(routes):
+    unknown = routes.resume('conn-unknown', 'req-unknown', 'no-such-stream', 0).join()
+    foreign = routes.resume('conn-foreign', 'req-foreign', 'req-drop', 0, user=OTHER_USER).join()
+    invalid = routes.resume('conn-invalid', 'req-invalid', 'req-drop', -1).join()
+    assert (unknown['statusCode'], foreign['statusCode'], invalid['statusCode']) == (404, 404, 400)
+    assert routes.api.text('conn-foreign') == '' and routes.api.messages('conn-foreign')[-1]['action'] == 'error'
+    report("    unknown stream and stream of another user rejected (404), invalid offset rejected (400)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=2000)
+    parser.add_argument('--tokens-per-second', type=float, default=400)
+    parser.add_argument('--flush-ms', type=int, default=250)
+    parser.add_argument('--grace', type=float, default=1)
+    parser.add_argument('--reconnect-delay', type=float, default=0.5)
+    parser.add_argument('--resume-grace', type=float, default=30)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['TRACING_ENABLED'] = 'true'
+    os.environ['CONNECTIONS_TABLE'] = CONNECTIONS_TABLE
+    os.environ['DYNAMODB_TABLE'] = HISTORY_TABLE
+    os.environ['STREAM_BUFFER_TABLE'] = STREAM_BUFFER_TABLE
+    os.environ['STREAM_BUFFER_FLUSH_MS'] = str(args.flush_ms)
+    os.environ['CANCEL_CHECK_INTERVAL_SECONDS'] = '0.1'
+    os.environ['HISTORY_WRITE_BEHIND'] = 'false'
+    for name in ('ADMISSION_TABLE', 'FALLBACK_MODEL_ID', 'HISTORY_BODY_BUCKET', 'RESPONSE_CACHE_TABLE'):
+        os.environ.pop(name, None)
+
+    with mock_aws(), open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        create_tables()
+        routes = Routes(args)
+        report(f"{args.tokens} tokens at {args.tokens_per_second:.0f} tokens/s, buffer written every {args.flush_ms} ms, "
+              f"grace period {args.grace} s ({args.resume_grace} s for the drops that are resumed)")
+        check_overhead(routes)
+        check_resume(routes)
+        check_abandoned(routes)
+        check_cancel(routes)
+        check_rejections(routes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+Measures the templates search mode (`GET /templates?search=...`) at 100k templates.
+
+Synthetic templates get names, descriptions and tags drawn from a fixed vocabulary with a long tail
+of rare words. The index of --templates templates is built in memory, and its build time, memory
+(tracemalloc), snapshot size and snapshot load time are reported. Query latency of the index is
+compared with filtering every visible template in memory (what a client does with the full
+listing), for exact, multi-word and prefix queries, and the match counts are checked against that
+filter. Scanning moto is slow, so the handler path runs on --table-templates templates: the index is
+built from a table scan, a cold start loads the S3 snapshot without scanning, and creates, updates
+and deletes show up in the next search without rebuilding the index. Writes save the snapshot at
+most every TEMPLATES_INDEX_SAVE_SECONDS and store a small delta each; another container searching
+before the next save applies the deltas to the older snapshot instead of scanning. The write latency
+is reported with and without a snapshot save.
+
+Usage:
+    python backend/benchmarks/bench_template_search.py [--templates 100000] [--table-templates 5000] [--queries 200]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import boto3
+from moto import mock_aws
+
+from fakes import add_source_path
+
+add_source_path('src/templates')
+
+from search_index import TemplateSearchIndex, template_terms, tokenize
+
+TABLE_NAME = 'bench-templates-search'
+BUCKET_NAME = 'bench-templates-index'
+USER = 'user0@example.com'
+TOPICS = [
+    'summarize', 'meeting', 'notes', 'email', 'reply', 'customer', 'support', 'translate', 'french', 'spanish',
+    'code', 'review', 'python', 'javascript', 'sql', 'query', 'report', 'quarterly', 'sales', 'marketing',
+    'blog', 'post', 'linkedin', 'tweet', 'press', 'release', 'contract', 'legal', 'policy', 'onboarding',
+    'interview', 'questions', 'job', 'description', 'proposal', 'project', 'plan', 'risk', 'analysis', 'survey',
+    'feedback', 'product', 'roadmap', 'release', 'changelog', 'bug', 'incident', 'postmortem', 'architecture', 'design',
+    'lambda', 'serverless', 'kubernetes', 'terraform', 'bedrock', 'prompt', 'classification', 'sentiment', 'extract', 'entities'
+]
+
+
+def create_table():
+    boto3.client('dynamodb').create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'templateId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'templateId', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    boto3.client('s3').create_bucket(Bucket=BUCKET_NAME)
+
+
+def synthetic_template(i, users, rng):
+    # A long tail of rarer words next to the common topics, like real template names
+    words = lambda n: [rng.choice(TOPICS) if rng.random() < 0.7 else f'term{rng.randint(0, 20000)}' for _ in range(n)]
+    created = f'{1714852452 + i}.{i % 1000000:06d}'
+    return {
+        'templateId': created,
+        'dateCreated': created,
+        'createdBy': f'user{i % users}@example.com',
+        'visibility': 'public' if rng.random() < 0.2 else 'private',
+        'templateName': ' '.join(words(4)).capitalize(),
+        'templateDescription': ' '.join(words(18)) + '.',
+        'tags': words(3),
+        'templatePrompt': 'Use the following text: ${INPUT_DATA}'
+    }
+
+
+def get_event(params):
+    return {'httpMethod': 'GET', 'requestContext': {'authorizer': {'claims': {'email': USER}}}, 'queryStringParameters': params}
+
+
+def write_event(method, body):
+    return {'httpMethod': method, 'requestContext': {'authorizer': {'claims': {'email': USER}}}, 'body': json.dumps({'createdBy': USER, **body})}
+
+
+def filter_templates(templates, query):
+    """In-memory filter of the full listing: every word must appear, the last one as a prefix."""
+    tokens = tokenize(query)
+    matches = []
+    for template in templates:
+        if template['visibility'] != 'public' and template['createdBy'] != USER:
+            continue
+        terms = template_terms(template)
+        if all(token in terms for token in tokens[:-1]) and any(term.startswith(tokens[-1]) for term in terms):
+            matches.append(template['templateId'])
+    return matches
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_queries(index, templates, rng, count):
+    queries = {
+        'one word': lambda: rng.choice(TOPICS),
+        'two words': lambda: f'{rng.choice(TOPICS)} {rng.choice(TOPICS)}',
+        'prefix (2 chars)': lambda: rng.choice(TOPICS)[:2],
+        'prefix (4 chars)': lambda: rng.choice(TOPICS)[:4],
+        'word + prefix': lambda: f'{rng.choice(TOPICS)} {rng.choice(TOPICS)[:3]}',
+        'rare word': lambda: f'term{rng.randint(0, 20000)}',
+    }
+    print(f"    {'query':18s} {'index p50':>10s} {'p95':>8s} {'p99':>8s}   {'filter p50':>10s}   matches")
+    for label, make in queries.items():
+        indexed, filtered, matches = [], [], []
+        for q in range(count):
+            query = make()
+            started = time.perf_counter()
+            total, results = index.search(query, USER, 20)
+            indexed.append((time.perf_counter() - started) * 1000)
+            matches.append(total)
+            if q < 5:
+                started = time.perf_counter()
+                expected = filter_templates(templates, query)
+                filtered.append((time.perf_counter() - started) * 1000)
+                assert total == len(expected), (query, total, len(expected))
+        print(f"    {label:18s} {statistics.median(indexed):8.2f} ms {percentile(indexed, 0.95):6.2f} ms {percentile(indexed, 0.99):6.2f} ms"
+              f"   {statistics.median(filtered):8.0f} ms   {statistics.median(matches):.0f}")
+
+
+def check_handler(templates):
+    """Builds the index from a moto table through the handler, cold-starts from S3, and checks writes."""
+    create_table()
+    table = boto3.resource('dynamodb').Table(TABLE_NAME)
+    with table.batch_writer() as writer:
+        for template in templates:
+            writer.put_item(Item=template)
+
+    import templates as app
+
+    started = time.perf_counter()
+    response = app.handler(get_event({'search': 'meeting notes'}), None)
+    assert response['statusCode'] == 200, response
+    print(f"    handler, {len(templates)} templates in moto: first search (table scan) {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    # A cold start in another container loads the S3 snapshot instead of scanning
+    os.remove(app.SEARCH_INDEX_PATH)
+    app.search_index = None
+    app.search_index_saved_at = None
+    calls = []
+    table.meta.client.meta.events.register('before-call.dynamodb', lambda model, **kwargs: calls.append(model.name))
+    started = time.perf_counter()
+    app.handler(get_event({'search': 'meeting'}), None)
+    print(f"    handler, cold start from the S3 snapshot {(time.perf_counter() - started) * 1000:.0f} ms, table scans: {calls.count('Scan')}")
+    assert calls.count('Scan') == 0, calls
+
+    # Writes update the index in place, without a rebuild; the first one saves the snapshot, the next ones within
+    # the save interval do not
+    puts, delta_puts = [], []
+    s3 = app.get_client('s3')
+    s3.meta.events.register('provide-client-params.s3.PutObject',
+                            lambda params, **kwargs: (puts if params['Key'] == app.SEARCH_INDEX_KEY else delta_puts).append(1))
+    write_ms = []
+
+    def write(method, body):
+        started = time.perf_counter()
+        response = app.handler(write_event(method, body), None)
+        write_ms.append((time.perf_counter() - started) * 1000)
+        return response
+
+    write('POST', {'templateName': 'Zebra onboarding checklist', 'visibility': 'private', 'tags': ['hr']})
+    items = json.loads(app.handler(get_event({'search': 'zebra'}), None)['body'])['items']
+    assert [item['templateName'] for item in items] == ['Zebra onboarding checklist'], items
+    template_id = items[0]['templateId']
+    write('PUT', {'templateId': template_id, 'templateName': 'Okapi onboarding checklist'})
+    assert json.loads(app.handler(get_event({'search': 'zebra'}), None)['body'])['total'] == 0
+    assert json.loads(app.handler(get_event({'search': 'okap'}), None)['body'])['total'] == 1
+    write('DELETE', {'templateId': template_id})
+    assert json.loads(app.handler(get_event({'search': 'okapi'}), None)['body'])['total'] == 0
+    assert calls.count('Scan') == 0, calls
+    assert len(puts) == 1 and len(delta_puts) == len(write_ms), (puts, delta_puts)
+    print(f"    handler writes: with a snapshot save {write_ms[0]:.0f} ms, within the save interval "
+          f"{statistics.median(write_ms[1:]):.0f} ms; {len(puts)} snapshot upload and {len(delta_puts)} deltas for {len(write_ms)} writes")
+
+    # Another container searching before the next save loads the older snapshot and applies the deltas since
+    app.search_index = None
+    os.remove(app.SEARCH_INDEX_PATH)
+    started = time.perf_counter()
+    assert json.loads(app.handler(get_event({'search': 'okapi'}), None)['body'])['total'] == 0
+    catch_up_ms = (time.perf_counter() - started) * 1000
+    assert json.loads(app.handler(get_event({'search': 'zebra'}), None)['body'])['total'] == 0
+    assert app.search_index.version == app.listing_cache.version and calls.count('Scan') == 0, calls
+    print(f"    another container within the save interval: snapshot and {len(write_ms) - 1} deltas in {catch_up_ms:.0f} ms, "
+          f"table scans: {calls.count('Scan')}")
+
+    # Once the interval passed, the next write saves the snapshot, and that is the one the next container loads
+    app.search_index_saved_at -= app.SEARCH_INDEX_SAVE_SECONDS
+    write('POST', {'templateName': 'Quokka release notes', 'visibility': 'private'})
+    assert len(puts) == 2, puts
+    app.search_index = None
+    os.remove(app.SEARCH_INDEX_PATH)
+    assert json.loads(app.handler(get_event({'search': 'okapi'}), None)['body'])['total'] == 0
+    assert json.loads(app.handler(get_event({'search': 'quokka'}), None)['body'])['total'] == 1
+    assert calls.count('Scan') == 0, calls
+    # Private templates of other users never show up
+    items = json.loads(app.handler(get_event({'search': 'summarize', 'limit': '100'}), None)['body'])['items']
+    assert all(item['visibility'] == 'public' or item['createdBy'] == USER for item in items)
+    print("    create/update/delete searchable without a scan, snapshot follows the writes, visibility checks passed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--templates', type=int, default=100000)
+    parser.add_argument('--table-templates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['TEMPLATES_TABLE'] = TABLE_NAME
+    os.environ['TEMPLATES_INDEX_BUCKET'] = BUCKET_NAME
+    os.environ['TEMPLATES_INDEX_PATH'] = os.path.join(tempfile.mkdtemp(), 'templates-search-index.bin.gz')
+
+    templates = [synthetic_template(i, args.users, rng) for i in range(args.templates)]
+    print(f"{args.templates} templates, {args.users} users")
+    started = time.perf_counter()
+    index = TemplateSearchIndex()
+    for template in templates:
+        index.add(template)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    data = index.dumps()
+    dump_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    loaded = TemplateSearchIndex.loads(data)
+    load_ms = (time.perf_counter() - started) * 1000
+    # Measured on a second load, tracemalloc slows down allocations too much to time them
+    tracemalloc.start()
+    copy = TemplateSearchIndex.loads(data)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del copy
+    print(f"    index build {build_ms:6.0f} ms (tokenizing), {len(index.terms)} terms, "
+          f"{sum(len(p) for p in index.postings.values())} postings, {memory / 2**20:.0f} MB in memory")
+    print(f"    snapshot {len(data) / 2**20:.1f} MB, save {dump_ms:.0f} ms, load {load_ms:.0f} ms")
+    assert loaded.search('meeting no', USER, 50) == index.search('meeting no', USER, 50)
+
+    run_queries(index, templates, rng, args.queries)
+
+    updated = templates[:1000]
+    started = time.perf_counter()
+    for template in updated:
+        index.add(dict(template, templateName=template['templateName'] + ' revised'))
+    update_ms = (time.perf_counter() - started) * 1000 / len(updated)
+    assert index.search('revised', USER)[0] == sum(1 for t in updated if t['visibility'] == 'public' or t['createdBy'] == USER)
+    print(f"    incremental update {update_ms:.3f} ms per template")
+
+    with mock_aws():
+        check_handler(templates[:args.table_templates])
+
+
+if __name__ == '__main__':
+    main()
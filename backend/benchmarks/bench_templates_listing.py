@@ -0,0 +1,125 @@
+"""
+Compares listing templates with a filtered table scan against the createdBy/visibility indexes.
+
+A moto DynamoDB table with the same indexes as template.yaml is filled with synthetic templates.
+moto does not report real capacity, so read capacity is estimated the way DynamoDB charges it:
+0.5 RCU (eventually consistent) per 4 KB of data read, where a scan reads every item of the table
+and a query only reads the matching items of the index.
+
+Usage:
+    python backend/benchmarks/bench_templates_listing.py [--templates 100000] [--users 200] [--public-ratio 0.1]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import time
+
+import boto3
+from moto import mock_aws
+
+from fakes import add_source_path
+
+add_source_path('src/templates')
+
+TABLE_NAME = 'bench-templates-table'
+
+
+def create_table():
+    index = lambda name, attribute: {
+        'IndexName': name,
+        'KeySchema': [{'AttributeName': attribute, 'KeyType': 'HASH'}, {'AttributeName': 'dateCreated', 'KeyType': 'RANGE'}],
+        'Projection': {'ProjectionType': 'ALL'}
+    }
+    boto3.client('dynamodb').create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'templateId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': name, 'AttributeType': 'S'} for name in ('templateId', 'createdBy', 'visibility', 'dateCreated')
+        ],
+        GlobalSecondaryIndexes=[index('createdBy-dateCreated-index', 'createdBy'), index('visibility-dateCreated-index', 'visibility')],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def synthetic_template(i, users, public_ratio):
+    created = f'{1714852452 + i}.{random.randint(0, 999999):06d}'
+    return {
+        'templateId': created,
+        'dateCreated': created,
+        'createdBy': f'user{i % users}@example.com',
+        'visibility': 'public' if random.random() < public_ratio else 'private',
+        'templateName': f'Template {i}',
+        'templateDescription': 'Synthetic template used to benchmark listings.',
+        'modelversion': 'anthropic.claude-3-haiku-20240307-v1:0',
+        'templatePrompt': 'Summarize the following text: ${INPUT_DATA}',
+        'templateGuidance': 'Paste the text to summarize.',
+        'systemPrompt': 'You are a helpful assistant. ' * 10
+    }
+
+
+def item_size(item):
+    return sum(len(name) + len(str(value)) for name, value in item.items())
+
+
+def read_capacity(items):
+    return math.ceil(sum(item_size(item) for item in items) / 4096) * 0.5
+
+
+def scan_listing(table, attribute, value):
+    """The previous implementation, following every page of the filtered scan."""
+    scanned, matched, kwargs = [], [], {'FilterExpression': boto3.dynamodb.conditions.Attr(attribute).eq(value)}
+    while True:
+        # moto does not expose the scanned items, so read the page unfiltered to measure it
+        page = table.scan(**{k: v for k, v in kwargs.items() if k != 'FilterExpression'})
+        scanned.extend(page['Items'])
+        matched.extend(item for item in page['Items'] if item.get(attribute) == value)
+        if 'LastEvaluatedKey' not in page:
+            return matched, scanned
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--templates', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--public-ratio', type=float, default=0.1)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['TEMPLATES_TABLE'] = TABLE_NAME
+    random.seed(1)
+
+    with mock_aws():
+        create_table()
+        table = boto3.resource('dynamodb').Table(TABLE_NAME)
+        started = time.perf_counter()
+        with table.batch_writer() as batch:
+            for i in range(args.templates):
+                batch.put_item(Item=synthetic_template(i, args.users, args.public_ratio))
+        print(f"Loaded {args.templates} templates in {time.perf_counter() - started:.1f} s")
+
+        import templates
+
+        for attribute, value, listing in (
+            ('createdBy', 'user1@example.com', templates.get_templates_by_createdBy),
+            ('visibility', 'public', templates.get_templates_by_visibility),
+        ):
+            started = time.perf_counter()
+            matched, scanned = scan_listing(table, attribute, value)
+            scan_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            response = listing(value)
+            query_ms = (time.perf_counter() - started) * 1000
+            queried = json.loads(response['body'])
+            assert len(queried) == len(matched), (len(queried), len(matched))
+
+            print(f"{attribute}={value}: {len(matched)} templates")
+            print(f"    scan   {read_capacity(scanned):10.1f} RCU  {scan_ms:9.1f} ms (moto)")
+            print(f"    query  {read_capacity(queried):10.1f} RCU  {query_ms:9.1f} ms (moto)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Shows the per-stage breakdown recorded by the request trace, and what tracing costs.
+
+The real sendmessage handler runs against a fake ConverseStream (with a time-to-first-token and a
+token rate), a fake API Gateway management API with a post latency and a moto DynamoDB table. The
+trace records of every request are kept by a LocalCollector; the median of each stage is printed,
+followed by the handler time with TRACING_ENABLED=false and true and the cost of one span.
+
+Usage:
+    python backend/benchmarks/bench_tracing.py [--requests 30] [--tokens 200] [--first-token-delay 0.05] [--token-delay 0.0005] [--post-latency 0.002]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import boto3
+from moto import mock_aws
+
+from fakes import FakeBedrockRuntime, FakeManagementApi, add_source_path
+
+add_source_path('src/websocket/sendmessage')
+
+from assistant_common.tracing import LocalCollector, Trace
+
+TABLE_NAME = 'bench-tracing'
+
+
+def message_event(i):
+    return {
+        'requestContext': {
+            'domainName': 'example.execute-api.us-east-1.amazonaws.com',
+            'stage': 'Prod',
+            'connectionId': 'bench-connection',
+            'authorizer': {'principalId': 'bench@example.com'},
+            'identity': {'sourceIp': '203.0.113.10', 'userAgent': 'bench'},
+            'requestId': f'request-{i}',
+            'requestTimeEpoch': 1700000000000 + i * 1000
+        },
+        'body': json.dumps({'action': 'sendmessage', 'data': f'Question {i}'})
+    }
+
+
+def run(app, requests, tracing):
+    os.environ['TRACING_ENABLED'] = 'true' if tracing else 'false'
+    durations = []
+    for i in range(requests):
+        started = time.perf_counter()
+        response = app.handler(message_event(i), None)
+        durations.append((time.perf_counter() - started) * 1000)
+        assert response['statusCode'] == 200, response
+    return statistics.median(durations)
+
+
+def span_cost(iterations=100000):
+    trace = Trace('bench')
+    started = time.perf_counter()
+    for _ in range(iterations):
+        with trace.span('stage'):
+            pass
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=30)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--first-token-delay', type=float, default=0.05)
+    parser.add_argument('--token-delay', type=float, default=0.0005)
+    parser.add_argument('--post-latency', type=float, default=0.002)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_TABLE'] = TABLE_NAME
+    os.environ.pop('HISTORY_BODY_BUCKET', None)
+
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}, {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}, {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+        import app
+        from assistant_common import clients
+
+        api = FakeManagementApi(post_latency=args.post_latency)
+        bedrock = FakeBedrockRuntime(tokens=args.tokens, first_token_delay=args.first_token_delay, token_delay=args.token_delay)
+        get_client = clients.get_client
+        app.get_client = lambda service_name, endpoint_url=None: bedrock if service_name == 'bedrock-runtime' else get_client(service_name, endpoint_url)
+        app.get_management_api = lambda domain_name, stage: api
+
+        with LocalCollector() as collector:
+            off = run(app, args.requests, tracing=False)
+            on = run(app, args.requests, tracing=True)
+
+        print(f"{args.requests} requests, {args.tokens} tokens, first token after {args.first_token_delay * 1000:.0f} ms, "
+              f"post {args.post_latency * 1000:.0f} ms")
+        names = [name for name in collector.records[-1] if name not in ('_aws', 'Route', 'ModelId', 'requestId')]
+        for name in names:
+            print(f"    {name:24s} {statistics.median(collector.values(name)):10.2f}")
+        print(f"    handler median: tracing off {off:.1f} ms, on {on:.1f} ms; one span costs {span_cost():.2f} us")
+        print(f"    one record is {len(json.dumps(collector.records[-1]))} bytes of log")
+        published = collector.records[-1]['_aws']['CloudWatchMetrics'][0]['Metrics']
+        print(f"    {len(published)} of {len(names)} values published as CloudWatch metrics: {', '.join(metric['Name'] for metric in published)}")
+
+
+if __name__ == '__main__':
+    main()
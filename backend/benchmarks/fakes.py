@@ -0,0 +1,239 @@
+"""
+Local stand-ins for the AWS services used by the Lambda functions.
+
+The benchmarks drive the real handler and layer code against these fakes so that streaming
+behaviour can be measured offline, without deploying the stack.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from botocore.exceptions import ClientError
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_LAYER_DIR = os.path.join(BACKEND_DIR, 'layer', 'common', 'python')
+
+
+def add_source_path(*relative_dirs):
+    """Makes the common layer and the given backend folders importable, like the Lambda runtime does."""
+    for path in (COMMON_LAYER_DIR,) + tuple(os.path.join(BACKEND_DIR, d) for d in relative_dirs):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def client_error(code, message='', operation='Operation'):
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, operation)
+
+
+class FakeConverseStream:
+    """
+    Scripted ConverseStream event stream.
+
+    Args:
+        tokens (int): Number of `contentBlockDelta` events to emit.
+        token_delay (float): Seconds between two deltas (1 / tokens per second).
+        first_token_delay (float): Seconds before the first delta (time-to-first-token).
+        text (str): Text of each delta, formatted with the token index.
+        usage (dict, optional): Input usage fields reported in the `metadata` event.
+    """
+
+    def __init__(self, tokens=200, token_delay=0.0, first_token_delay=0.0, text='token{} ', usage=None):
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+        self.text = text
+        self.usage = usage or {'inputTokens': 10}
+        self.emitted = 0
+        self.closed = False
+
+    def __iter__(self):
+        yield {'messageStart': {'role': 'assistant'}}
+        if self.first_token_delay:
+            time.sleep(self.first_token_delay)
+        for i in range(self.tokens):
+            if self.closed:
+                return
+            if i and self.token_delay:
+                time.sleep(self.token_delay)
+            self.emitted += 1
+            yield {'contentBlockDelta': {'delta': {'text': self.text.format(i)}, 'contentBlockIndex': 0}}
+        yield {'contentBlockStop': {'contentBlockIndex': 0}}
+        yield {'messageStop': {'stopReason': 'end_turn'}}
+        input_tokens = sum(self.usage.get(name, 0) for name in ('inputTokens', 'cacheReadInputTokens', 'cacheWriteInputTokens'))
+        yield {'metadata': {
+            'usage': {**self.usage, 'outputTokens': self.emitted, 'totalTokens': input_tokens + self.emitted},
+            'metrics': {'latencyMs': 0}
+        }}
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBedrockRuntime:
+    """Fake `bedrock-runtime` client returning a new `FakeConverseStream` per call."""
+
+    def __init__(self, **stream_kwargs):
+        self.stream_kwargs = stream_kwargs
+        self.calls = []
+        self.streams = []
+
+    def converse_stream(self, **kwargs):
+        self.calls.append(kwargs)
+        stream = FakeConverseStream(**self.stream_kwargs)
+        self.streams.append(stream)
+        return {'stream': stream}
+
+
+class FakeThrottlingBedrock(FakeBedrockRuntime):
+    """
+    Fake `bedrock-runtime` client throttling ConverseStream calls on a schedule.
+
+    Call n of a model raises a ThrottlingException when `schedule[model_id][n]` is true; models
+    without a schedule use the '*' one, and calls past the end of a schedule succeed.
+
+    Args:
+        schedule (dict): Model ID (or '*') to a sequence of booleans, one per call of the model.
+        **stream_kwargs: Passed to every `FakeConverseStream`.
+    """
+
+    def __init__(self, schedule, **stream_kwargs):
+        super().__init__(**stream_kwargs)
+        self.schedule = schedule
+        self.attempts = {}
+        self.throttled = []
+        self._lock = threading.Lock()
+
+    def converse_stream(self, **kwargs):
+        model_id = kwargs['modelId']
+        with self._lock:
+            attempt = self.attempts.get(model_id, 0)
+            self.attempts[model_id] = attempt + 1
+            schedule = self.schedule.get(model_id, self.schedule.get('*', ()))
+            if attempt < len(schedule) and schedule[attempt]:
+                self.throttled.append(model_id)
+                raise client_error('ThrottlingException', 'Too many requests, please wait before trying again.', 'ConverseStream')
+        return super().converse_stream(**kwargs)
+
+
+class FakePromptCachingBedrock(FakeBedrockRuntime):
+    """
+    Fake `bedrock-runtime` client simulating prompt caching, and checking where cache points are placed.
+
+    The prefixes of a request closed by cache points are cached across calls. Like Bedrock, a request
+    reads the longest cached prefix ending at any of its content block boundaries (so the history
+    cached by the previous turn is found even though the new cache point sits further), reports it
+    as `cacheReadInputTokens`, reports the tokens its cache points add to the cache as
+    `cacheWriteInputTokens` and the rest as `inputTokens` (tokens estimated at four characters each).
+    Time-to-first-token grows with the tokens that are not read from the cache.
+
+    Args:
+        first_token_delay (float): Seconds before the first token, regardless of the prompt.
+        delay_per_input_token (float): Seconds of time-to-first-token per processed input token.
+        max_cache_points (int): Cache points a request may contain, as enforced by Bedrock.
+        **stream_kwargs: Passed to every `FakeConverseStream`.
+    """
+
+    def __init__(self, first_token_delay=0.0, delay_per_input_token=0.0, max_cache_points=4, **stream_kwargs):
+        super().__init__(**stream_kwargs)
+        self.first_token_delay = first_token_delay
+        self.delay_per_input_token = delay_per_input_token
+        self.max_cache_points = max_cache_points
+        self.cached_prefixes = set()
+
+    @staticmethod
+    def _tokens(block):
+        return len(block.get('text', '')) // 4
+
+    def _scan(self, kwargs):
+        """Returns the (prefix key, tokens) of every block boundary and of every cache point, checking their placement."""
+        sections = [('system', kwargs.get('system', []))]
+        sections += [(message['role'], message['content']) for message in kwargs['messages']]
+        seen, tokens, boundaries, cache_points = [], 0, [], []
+        for role, blocks in sections:
+            for index, block in enumerate(blocks):
+                if 'cachePoint' in block:
+                    if index != len(blocks) - 1 or index == 0:
+                        raise client_error('ValidationException', 'A cache point must follow the content it caches', 'ConverseStream')
+                    cache_points.append((repr(seen), tokens))
+                else:
+                    seen.append((role, block.get('text')))
+                    tokens += self._tokens(block)
+                    boundaries.append((repr(seen), tokens))
+        return boundaries, cache_points, tokens
+
+    def converse_stream(self, **kwargs):
+        self.calls.append(kwargs)
+        boundaries, cache_points, total = self._scan(kwargs)
+        if len(cache_points) > self.max_cache_points:
+            raise client_error('ValidationException', 'Too many cache points', 'ConverseStream')
+        read = max([tokens for key, tokens in boundaries if key in self.cached_prefixes], default=0)
+        written = max([tokens for key, tokens in cache_points if key not in self.cached_prefixes] + [read]) - read
+        self.cached_prefixes.update(key for key, _ in cache_points)
+        usage = {'inputTokens': total - read - written, 'cacheReadInputTokens': read, 'cacheWriteInputTokens': written}
+        delay = self.first_token_delay + self.delay_per_input_token * (total - read)
+        stream = FakeConverseStream(first_token_delay=delay, usage=usage, **self.stream_kwargs)
+        self.streams.append(stream)
+        return {'stream': stream}
+
+
+class FakeManagementApi:
+    """
+    Recording fake of the `apigatewaymanagementapi` client.
+
+    Args:
+        post_latency (float): Seconds each `post_to_connection` call takes.
+        gone_after (int, optional): Raise GoneException once this many posts have been made.
+
+    Connections added to `gone` raise GoneException on their own, e.g. a client that dropped.
+    """
+
+    def __init__(self, post_latency=0.0, gone_after=None):
+        self.post_latency = post_latency
+        self.gone_after = gone_after
+        self.gone = set()
+        self.posts = []
+        self._lock = threading.Lock()
+
+    def post_to_connection(self, ConnectionId, Data):
+        if self.post_latency:
+            time.sleep(self.post_latency)
+        with self._lock:
+            if ConnectionId in self.gone or (self.gone_after is not None and len(self.posts) >= self.gone_after):
+                raise client_error('GoneException', operation='PostToConnection')
+            self.posts.append((ConnectionId, json.loads(Data)))
+
+    def messages(self, connection_id=None):
+        return [data for cid, data in self.posts if connection_id in (None, cid)]
+
+    def text(self, connection_id=None):
+        return ''.join(m.get('messages', '') for m in self.messages(connection_id))
+
+
+class FakeMultipartS3:
+    """
+    Fake S3 client for multipart uploads that only records the size of the uploaded parts.
+
+    Parts are not kept, so memory measurements only reflect the code under test.
+    """
+
+    def __init__(self):
+        self.parts = {}
+        self.completed = {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.parts[Key] = []
+        return {'UploadId': Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts[Key].append(len(Body))
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed[Key] = self.parts.pop(Key)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.parts.pop(Key, None)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
@@ -0,0 +1,110 @@
+"""
+Profiles the cold import time of the Lambda handlers with `python -X importtime`.
+
+Each target in import_budgets.json runs a Python statement in a fresh interpreter from the
+function folder, with the common layer on the path. The importtime output is parsed to record the
+cost of every module, and the script exits with status 1 when a target exceeds its budget, so it
+can run in CI to catch cold start regressions.
+
+Usage:
+    python backend/benchmarks/import_profile.py [--target chat] [--runs 3] [--output report.json]
+        [--extra-path /path/to/built/langchain/layer/python]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+from fakes import BACKEND_DIR, COMMON_LAYER_DIR
+
+BUDGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_budgets.json')
+
+# e.g. "import time:       214 |        214 |   assistant_common.pipeline"
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def parse_importtime(stderr):
+    """
+    Parses `-X importtime` output.
+
+    Returns:
+        list: (module, self_us, cumulative_us, depth) tuples in output order.
+    """
+    modules = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            modules.append((module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return modules
+
+
+def run_importtime(statement, cwd, python_path):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(python_path))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=cwd, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Statement failed: {statement}\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def profile(target, python_path, runs):
+    """Returns the best total import time of `target` over `runs` fresh interpreters, with its module costs."""
+    cwd = os.path.join(BACKEND_DIR, target['path'])
+    # Modules imported by the bare interpreter (site, encodings...) are not charged to the handler
+    startup = {module for module, *_ in run_importtime('pass', cwd, python_path)}
+
+    best = None
+    for _ in range(runs):
+        modules = [m for m in run_importtime(target['statement'], cwd, python_path) if m[0] not in startup]
+        total_us = sum(cumulative for _, _, cumulative, depth in modules if depth == 0)
+        if best is None or total_us < best[0]:
+            best = (total_us, modules)
+
+    total_us, modules = best
+    heaviest = sorted(modules, key=lambda m: m[1], reverse=True)[:15]
+    return {
+        'statement': target['statement'],
+        'totalMs': round(total_us / 1000, 1),
+        'budgetMs': target['budget_ms'],
+        'modules': len(modules),
+        'heaviestModules': [{'module': m, 'selfMs': round(s / 1000, 2), 'cumulativeMs': round(c / 1000, 2)} for m, s, c, _ in heaviest]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', action='append', help='Target name from import_budgets.json (default: all)')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    parser.add_argument('--extra-path', action='append', default=[], help='Additional PYTHONPATH entries, e.g. a built layer')
+    args = parser.parse_args()
+
+    with open(BUDGETS_FILE) as f:
+        targets = json.load(f)
+
+    python_path = [COMMON_LAYER_DIR] + args.extra_path
+    report = {}
+    failed = False
+    for name in args.target or targets:
+        result = profile(targets[name], python_path, args.runs)
+        report[name] = result
+        status = 'OK' if result['totalMs'] <= result['budgetMs'] else 'OVER BUDGET'
+        failed = failed or status != 'OK'
+        print(f"{name:24} {result['totalMs']:8.1f} ms (budget {result['budgetMs']} ms, {result['modules']} modules) {status}")
+        for module in result['heaviestModules'][:5]:
+            print(f"    {module['selfMs']:8.2f} ms  {module['module']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+"""
+Shared helpers for the Employee Productivity GenAI Assistant Lambda functions.
+
+This package is deployed as a Lambda layer (see `CommonLayer` in template.yaml) so that
+the WebSocket and REST handlers can reuse the same building blocks without copying code
+between function folders.
+"""
@@ -0,0 +1,312 @@
+import math
+import os
+import random
+import time
+from contextlib import closing
+from botocore.exceptions import ClientError
+
+from assistant_common.batch import backoff_delay
+from assistant_common.clients import get_table
+from assistant_common.prompt_cache import add_cache_points
+
+# Sustained request rate and burst of every user, and of every model across all users
+USER_RATE_PER_MINUTE = float(os.environ.get('ADMISSION_USER_RATE_PER_MINUTE', 20))
+USER_BURST = int(os.environ.get('ADMISSION_USER_BURST', 5))
+MODEL_RATE_PER_MINUTE = float(os.environ.get('ADMISSION_MODEL_RATE_PER_MINUTE', 200))
+MODEL_BURST = int(os.environ.get('ADMISSION_MODEL_BURST', 20))
+# Time a request may be queued by the rate limits before it is rejected
+MAX_WAIT_SECONDS = float(os.environ.get('ADMISSION_MAX_WAIT_SECONDS', 10))
+# ConverseStream calls per model when Bedrock throttles, with jittered exponential backoff in between
+THROTTLE_ATTEMPTS = int(os.environ.get('BEDROCK_THROTTLE_ATTEMPTS', 4))
+THROTTLE_BASE_DELAY = float(os.environ.get('BEDROCK_THROTTLE_BASE_DELAY', 0.5))
+THROTTLE_MAX_DELAY = float(os.environ.get('BEDROCK_THROTTLE_MAX_DELAY', 8))
+
+# Bedrock errors worth retrying later or on another model
+THROTTLING_ERRORS = {'ThrottlingException', 'ServiceUnavailableException', 'ModelNotReadyException', 'TooManyRequestsException'}
+# Idle buckets are removed by the table TTL
+BUCKET_TTL_SECONDS = 3600
+
+# Rate limits of the container, created on first use when ADMISSION_TABLE is set
+_admission = None
+
+
+def fallback_model_id():
+    """Returns the model answering instead of a rate limited or throttled one (FALLBACK_MODEL_ID), if configured."""
+    return os.environ.get('FALLBACK_MODEL_ID') or None
+
+
+def get_admission():
+    """Returns the rate limits of the container, or None when ADMISSION_TABLE is not set."""
+    global _admission
+    table_name = os.environ.get('ADMISSION_TABLE')
+    if _admission is None and table_name:
+        _admission = Admission(get_table(table_name))
+    return _admission
+
+
+def status_sender(delivery, trace=None):
+    """
+    Returns the `notify` callable of `Admission.admit`, `converse_stream_with_retry` and `stream_with_retry`.
+
+    Status frames ({"action": "status", "status": "queued" | "retrying" | "fallback", ...}) are posted
+    right away, outside of the delta buffer of `delivery`, and counted on `trace` under their status.
+    """
+    def notify(status):
+        if trace:
+            trace.count(status['status'])
+        delivery.post({'action': 'status', **status})
+    return notify
+
+
+def is_throttling(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+
+class TokenBucket:
+    """
+    Token bucket stored in DynamoDB, shared by every container, in its GCRA form.
+
+    Instead of a token count refilled over time, the item of a bucket holds the theoretical arrival
+    time `tat` (in milliseconds): the time at which the bucket will be full again. Taking a token
+    moves `tat` one interval (60000 / rate per minute) forward, and is allowed while `tat` stays
+    within `burst` intervals of now. Both cases are single conditional UpdateItem calls with atomic
+    arithmetic, so concurrent requests can never take more tokens than the bucket holds, without
+    any read-modify-write:
+
+    - an idle bucket (`tat` in the past) restarts from now;
+    - otherwise `tat` is incremented if the bucket still has a token.
+
+    Args:
+        table: The boto3 DynamoDB Table resource of the buckets, keyed by 'bucketKey' with the 'expiresAt' TTL.
+        rate_per_minute (float): Sustained rate of tokens.
+        burst (int): Tokens available at once to an idle bucket.
+        clock (callable, optional): Wall clock in seconds, shared by every container.
+    """
+
+    def __init__(self, table, rate_per_minute, burst, clock=time.time):
+        self.table = table
+        self.interval_ms = math.ceil(60000 / rate_per_minute)
+        self.burst = max(burst, 1)
+        self.clock = clock
+
+    def take(self, key):
+        """
+        Takes a token from the bucket `key`.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the seconds until the next token.
+        """
+        now = int(self.clock() * 1000)
+        expires_at = now // 1000 + BUCKET_TTL_SECONDS
+        try:
+            self.table.update_item(
+                Key={'bucketKey': key},
+                UpdateExpression='SET tat = :next, expiresAt = :expires',
+                ConditionExpression='attribute_not_exists(tat) OR tat < :now',
+                ExpressionAttributeValues={':next': now + self.interval_ms, ':now': now, ':expires': expires_at}
+            )
+            return 0
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+        latest = now + (self.burst - 1) * self.interval_ms
+        try:
+            self.table.update_item(
+                Key={'bucketKey': key},
+                UpdateExpression='SET tat = tat + :interval, expiresAt = :expires',
+                ConditionExpression='tat <= :latest',
+                ExpressionAttributeValues={':interval': self.interval_ms, ':latest': latest, ':expires': expires_at},
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+            return 0
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            tat = e.response.get('Item', {}).get('tat', {}).get('N')
+            return max(int(tat) - latest if tat else self.interval_ms, 1) / 1000
+
+    def give_back(self, key):
+        """Returns a token taken by `take`, when the request it was taken for is not sent after all."""
+        self.table.update_item(
+            Key={'bucketKey': key},
+            UpdateExpression='SET tat = tat - :interval',
+            ConditionExpression='attribute_exists(tat)',
+            ExpressionAttributeValues={':interval': self.interval_ms}
+        )
+
+
+class Admission:
+    """
+    Per-user and per-model rate limits of the Bedrock requests, see `TokenBucket`.
+
+    A request takes a token from the bucket of its user, so one user cannot use up the model
+    throughput of everyone, and one from the bucket of its model, which keeps the total below the
+    Bedrock quota of the account instead of running into throttling.
+
+    Args:
+        table: The boto3 DynamoDB Table resource of the buckets.
+        clock (callable, optional): Wall clock in seconds.
+        sleep (callable, optional): Replaceable in benchmarks.
+    """
+
+    def __init__(self, table, user_rate_per_minute=USER_RATE_PER_MINUTE, user_burst=USER_BURST,
+                 model_rate_per_minute=MODEL_RATE_PER_MINUTE, model_burst=MODEL_BURST, clock=time.time, sleep=time.sleep):
+        self.users = TokenBucket(table, user_rate_per_minute, user_burst, clock)
+        self.models = TokenBucket(table, model_rate_per_minute, model_burst, clock)
+        self.sleep = sleep
+
+    def try_admit(self, user, model_id):
+        """
+        Takes a token from the user and model buckets, or from neither.
+
+        Returns:
+            tuple: 0 and None when admitted, otherwise the seconds to wait and the bucket that refused ('user' or 'model').
+        """
+        wait = self.users.take(f'user#{user}')
+        if wait:
+            return wait, 'user'
+        wait = self.models.take(f'model#{model_id}')
+        if wait:
+            self.users.give_back(f'user#{user}')
+            return wait, 'model'
+        return 0, None
+
+    def admit(self, user, model_id, notify, fallback=None, max_wait=MAX_WAIT_SECONDS):
+        """
+        Waits until a request of `user` to `model_id` is admitted.
+
+        While the request is queued, `notify` receives {'status': 'queued', 'retryAfterMs', 'reason'}
+        frames. When the model is out of tokens and a `fallback` model has some, the fallback model
+        is admitted right away and `notify` receives {'status': 'fallback', 'modelId', 'reason'}. The
+        rate limits fail open: if the buckets cannot be read the request is admitted.
+
+        Args:
+            user (str): The email address of the user.
+            model_id (str): The model requested.
+            notify (callable): Posts a status frame to the client.
+            fallback (str, optional): The model to use when `model_id` is rate limited.
+            max_wait (float, optional): Seconds the request may be queued.
+
+        Returns:
+            str: The admitted model ID, or None if the request was not admitted within `max_wait`.
+        """
+        waited = 0
+        while True:
+            try:
+                wait, reason = self.try_admit(user, model_id)
+                if wait and reason == 'model' and fallback and fallback != model_id:
+                    if not self.try_admit(user, fallback)[0]:
+                        notify({'status': 'fallback', 'modelId': fallback, 'reason': 'rateLimited'})
+                        return fallback
+            except ClientError as e:
+                print(f"Could not check the rate limits, admitting the request: {e}")
+                return model_id
+            if not wait:
+                return model_id
+            # Jitter spreads the retries of the requests queued at the same time
+            wait *= 1 + random.random() * 0.2
+            if waited + wait > max_wait:
+                return None
+            notify({'status': 'queued', 'retryAfterMs': int(wait * 1000), 'reason': reason})
+            self.sleep(wait)
+            waited += wait
+
+
+def switch_model(request, model_id):
+    """Points a ConverseStream request at another model, moving its cache points to what that model supports."""
+    request['modelId'] = model_id
+    for blocks in [request.get('system', [])] + [message['content'] for message in request['messages']]:
+        blocks[:] = [block for block in blocks if 'cachePoint' not in block]
+    add_cache_points(request)
+
+
+def next_attempt(error, attempt, model_id, notify, fallback=None, max_attempts=THROTTLE_ATTEMPTS, sleep=time.sleep):
+    """
+    Handles a failed call of a retried request: raises `error` unless it is throttling, then waits
+    with full-jitter exponential backoff behind a {'status': 'retrying', 'attempt', 'retryAfterMs'}
+    frame. Once a model has been throttled `max_attempts` times, the request moves to the `fallback`
+    model, announced with a {'status': 'fallback', 'modelId', 'reason'} frame, and gets as many
+    attempts there.
+
+    Returns:
+        tuple: The attempts made on the model to call next, and that model ID.
+    """
+    if not is_throttling(error):
+        raise error
+    attempt += 1
+    if attempt >= max_attempts:
+        if not fallback or fallback == model_id:
+            raise error
+        print(f"Model {model_id} is throttled, falling back to {fallback}")
+        notify({'status': 'fallback', 'modelId': fallback, 'reason': 'throttled'})
+        return 0, fallback
+    delay = backoff_delay(attempt - 1, THROTTLE_BASE_DELAY, THROTTLE_MAX_DELAY)
+    notify({'status': 'retrying', 'attempt': attempt, 'retryAfterMs': int(delay * 1000)})
+    sleep(delay)
+    return attempt, model_id
+
+
+def converse_stream_with_retry(bedrock, request, notify, fallback=None, max_attempts=THROTTLE_ATTEMPTS, sleep=time.sleep):
+    """
+    Calls ConverseStream, retrying throttling errors with backoff and falling back (see `next_attempt`).
+
+    Errors other than throttling are raised right away. Only the call is retried: once deltas have
+    reached the client the stream is not restarted.
+
+    Args:
+        bedrock: A `bedrock-runtime` boto3 client.
+        request (dict): The ConverseStream keyword arguments, its 'modelId' updated when falling back.
+        notify (callable): Posts a status frame to the client.
+        fallback (str, optional): The model to use once `request['modelId']` keeps being throttled.
+        max_attempts (int, optional): Calls per model.
+
+    Returns:
+        dict: The ConverseStream response.
+    """
+    attempt = 0
+    while True:
+        try:
+            return bedrock.converse_stream(**request)
+        except ClientError as e:
+            attempt, model_id = next_attempt(e, attempt, request['modelId'], notify, fallback, max_attempts, sleep)
+            if model_id != request['modelId']:
+                switch_model(request, model_id)
+
+
+def stream_with_retry(start, model_id, notify, fallback=None, max_attempts=THROTTLE_ATTEMPTS, sleep=time.sleep):
+    """
+    Starts a stream whose model call only happens on its first read, retrying it like `converse_stream_with_retry`.
+
+    Meant for streams such as LangChain `Runnable.stream`: the first chunk is read here, and a
+    throttling error raised before it is retried with backoff on a new stream from `start`, or on
+    the `fallback` model (see `next_attempt`). Errors after the first chunk are not retried.
+
+    Args:
+        start (callable): Returns a new stream (a generator) answered by the model ID it is given.
+        model_id (str): The model requested.
+        notify (callable): Posts a status frame to the client.
+        fallback (str, optional): The model to use once `model_id` keeps being throttled.
+        max_attempts (int, optional): Calls per model.
+
+    Returns:
+        generator: The chunks of the stream, the first one included; closing it closes the stream.
+    """
+    attempt = 0
+    while True:
+        stream = start(model_id)
+        try:
+            first = next(stream)
+        except StopIteration:
+            return stream
+        except ClientError as e:
+            stream.close()
+            attempt, model_id = next_attempt(e, attempt, model_id, notify, fallback, max_attempts, sleep)
+            continue
+        return _prepend(first, stream)
+
+
+def _prepend(first, stream):
+    with closing(stream):
+        yield first
+        yield from stream
@@ -0,0 +1,148 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# BatchWriteItem accepts at most 25 requests, BatchGetItem at most 100 keys
+WRITE_BATCH_SIZE = 25
+GET_BATCH_SIZE = 100
+# Number of batches written concurrently
+BATCH_WRITE_WORKERS = int(os.environ.get('BATCH_WRITE_WORKERS', 4))
+# Attempts for the unprocessed part of a batch, with jittered exponential backoff in between
+BATCH_MAX_ATTEMPTS = 8
+BATCH_BASE_DELAY = 0.05
+BATCH_MAX_DELAY = 2.0
+
+
+def chunked(items, size):
+    """Splits an iterable (possibly a lazy generator) into lists of at most `size` items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def backoff_delay(attempt, base_delay=BATCH_BASE_DELAY, max_delay=BATCH_MAX_DELAY):
+    """Full-jitter exponential backoff: a random delay up to `base_delay * 2 ** attempt`."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def log_progress(operation, every=500):
+    """Returns a progress callback printing the number of processed items every `every` items."""
+    state = {'next': every}
+
+    def report(progress):
+        done = progress['written'] + progress['failed']
+        if done >= state['next'] or progress['finished']:
+            print(f"{operation}: {progress['written']} written, {progress['failed']} failed, {progress['retries']} retries")
+            state['next'] = done + every
+    return report
+
+
+def write_batch(client, table_name, requests, max_attempts=BATCH_MAX_ATTEMPTS, sleep=time.sleep):
+    """
+    Writes up to 25 put/delete requests with BatchWriteItem, retrying the unprocessed ones with backoff.
+
+    Returns:
+        tuple: The requests that could not be written after `max_attempts`, and the number of retries.
+    """
+    pending = requests
+    for attempt in range(max_attempts):
+        response = client.batch_write_item(RequestItems={table_name: pending})
+        pending = response.get('UnprocessedItems', {}).get(table_name, [])
+        if not pending:
+            return [], attempt
+        if attempt < max_attempts - 1:
+            sleep(backoff_delay(attempt))
+    return pending, max_attempts - 1
+
+
+def batch_write(table, requests, workers=BATCH_WRITE_WORKERS, progress=None, max_attempts=BATCH_MAX_ATTEMPTS):
+    """
+    Writes many put/delete requests to a table in 25-request batches, several batches in parallel.
+
+    `requests` can be a generator (for example the keys read from a query), it is consumed as the
+    batches are written so at most a few batches per worker are held in memory. Requests use the
+    resource representation (plain Python values), e.g. `{'DeleteRequest': {'Key': {...}}}`.
+    BatchWriteItem does not support conditions: callers are responsible for only passing items the
+    requesting user owns.
+
+    Args:
+        table: The boto3 DynamoDB Table resource.
+        requests (iterable): The `PutRequest`/`DeleteRequest` entries.
+        workers (int, optional): Number of batches written concurrently.
+        progress (callable, optional): Called with the running totals after every batch.
+        max_attempts (int, optional): Attempts for the unprocessed items of a batch.
+
+    Returns:
+        dict: 'written' and 'failed' request counts, 'retries', 'batches', and the 'unprocessed' requests.
+    """
+    client = table.meta.client
+    totals = {'written': 0, 'failed': 0, 'retries': 0, 'batches': 0, 'finished': False}
+    unprocessed = []
+    lock = threading.Lock()
+
+    def run(chunk):
+        failed, retries = write_batch(client, table.name, chunk, max_attempts)
+        with lock:
+            totals['written'] += len(chunk) - len(failed)
+            totals['failed'] += len(failed)
+            totals['retries'] += retries
+            totals['batches'] += 1
+            unprocessed.extend(failed)
+            if progress:
+                progress(dict(totals))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        in_flight = set()
+        for chunk in chunked(requests, WRITE_BATCH_SIZE):
+            # Bound the batches waiting for a worker so lazy inputs are not read ahead
+            if len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(executor.submit(run, chunk))
+        for future in in_flight:
+            future.result()
+
+    totals['finished'] = True
+    if progress:
+        progress(dict(totals))
+    return {**{k: v for k, v in totals.items() if k != 'finished'}, 'unprocessed': unprocessed}
+
+
+def batch_get(table, keys, projection=None, max_attempts=BATCH_MAX_ATTEMPTS, sleep=time.sleep):
+    """
+    Reads many items by key with BatchGetItem in 100-key batches, retrying unprocessed keys with backoff.
+
+    Args:
+        table: The boto3 DynamoDB Table resource.
+        keys (iterable): The primary keys of the items.
+        projection (list, optional): The attributes to read.
+
+    Returns:
+        list: The items found, in no particular order.
+    """
+    client = table.meta.client
+    items = []
+    for chunk in chunked(keys, GET_BATCH_SIZE):
+        request = {'Keys': chunk}
+        if projection:
+            request['ProjectionExpression'] = ', '.join(f'#p{i}' for i in range(len(projection)))
+            request['ExpressionAttributeNames'] = {f'#p{i}': name for i, name in enumerate(projection)}
+        for attempt in range(max_attempts):
+            response = client.batch_get_item(RequestItems={table.name: request})
+            items.extend(response['Responses'].get(table.name, []))
+            pending = response.get('UnprocessedKeys', {}).get(table.name)
+            if not pending:
+                break
+            if attempt == max_attempts - 1:
+                raise RuntimeError(f"{len(pending['Keys'])} keys could not be read from {table.name}")
+            request = pending
+            sleep(backoff_delay(attempt))
+    return items
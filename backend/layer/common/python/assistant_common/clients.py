@@ -0,0 +1,89 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# Client configuration shared by every client created through the registry: a larger connection
+# pool for the threaded code paths, TCP keep-alive for long streams and adaptive retries
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('BOTO_MAX_POOL_CONNECTIONS', 25)),
+    tcp_keepalive=True,
+    retries={
+        'mode': 'adaptive',
+        'max_attempts': int(os.environ.get('BOTO_MAX_ATTEMPTS', 3))
+    }
+)
+
+_session = None
+_clients = {}
+_resources = {}
+_tables = {}
+_lock = threading.Lock()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def get_client(service_name, endpoint_url=None):
+    """
+    Returns a boto3 client that is created once per Lambda container and reused by warm invocations.
+
+    Clients are keyed by service name and endpoint URL, so every API Gateway stage gets its own
+    management API client.
+
+    Args:
+        service_name (str): The boto3 service name, e.g. 'bedrock-runtime'.
+        endpoint_url (str, optional): A custom endpoint URL.
+
+    Returns:
+        botocore.client.BaseClient: The cached client.
+    """
+    key = (service_name, endpoint_url)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session().client(service_name, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+                _clients[key] = client
+    return client
+
+
+def get_resource(service_name):
+    """Returns a boto3 resource that is created once per Lambda container."""
+    resource = _resources.get(service_name)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(service_name)
+            if resource is None:
+                resource = _get_session().resource(service_name, config=CLIENT_CONFIG)
+                _resources[service_name] = resource
+    return resource
+
+
+def get_table(table_name):
+    """Returns a cached DynamoDB Table resource for `table_name`."""
+    table = _tables.get(table_name)
+    if table is None:
+        table = get_resource('dynamodb').Table(table_name)
+        _tables[table_name] = table
+    return table
+
+
+def get_management_api(domain_name, stage):
+    """Returns the cached `apigatewaymanagementapi` client for a WebSocket API stage."""
+    return get_client('apigatewaymanagementapi', endpoint_url=f'https://{domain_name}/{stage}')
+
+
+def reset():
+    """Drops every cached client, forcing the next call to build new ones (used by benchmarks)."""
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
+        _resources.clear()
+        _tables.clear()
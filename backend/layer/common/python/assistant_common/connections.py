@@ -0,0 +1,203 @@
+import os
+import threading
+from botocore.exceptions import ClientError
+
+from assistant_common.clients import get_table
+
+# API Gateway closes WebSocket connections after two hours, items of older connections are expired through TTL
+CONNECTION_TTL_SECONDS = 3 * 3600
+# Time a closed connection is kept, so generations still streaming to it see the disconnection
+CLOSED_CONNECTION_TTL_SECONDS = 600
+# Interval between two reads of the cancellation flag by a streaming generation
+CANCEL_CHECK_SECONDS = float(os.environ.get('CANCEL_CHECK_INTERVAL_SECONDS', 0.5))
+
+CANCELLED = 'cancelled'
+DISCONNECTED = 'disconnected'
+
+
+class GenerationCancelled(Exception):
+    """Raised in a streaming loop when its generation was cancelled by the client, or the connection closed."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def connections_table():
+    """Returns the connections table, or None when CONNECTIONS_TABLE is not set."""
+    table_name = os.environ.get('CONNECTIONS_TABLE')
+    return get_table(table_name) if table_name else None
+
+
+def register_connection(table, connection_id, email, connected_at):
+    """
+    Records a new WebSocket connection.
+
+    Args:
+        table: The boto3 DynamoDB Table resource of the connections, keyed by 'connectionId'.
+        connection_id (str): The API Gateway connection ID.
+        email (str): The email address of the authenticated user.
+        connected_at (int): The API Gateway request time of the connection, in milliseconds.
+    """
+    table.put_item(Item={
+        'connectionId': connection_id,
+        'email': email,
+        'connectedAt': connected_at,
+        'expiresAt': connected_at // 1000 + CONNECTION_TTL_SECONDS
+    })
+
+
+def close_connection(table, connection_id, disconnected_at):
+    """
+    Marks a connection as closed, which cancels the generations still streaming to it.
+
+    The item is kept for CLOSED_CONNECTION_TTL_SECONDS so that those generations read the flag.
+    """
+    table.update_item(
+        Key={'connectionId': connection_id},
+        UpdateExpression='SET disconnectedAt = :now, cancelledAt = :now, expiresAt = :expires',
+        ExpressionAttributeValues={':now': disconnected_at, ':expires': disconnected_at // 1000 + CLOSED_CONNECTION_TTL_SECONDS}
+    )
+
+
+def request_cancel(table, connection_id, requested_at):
+    """
+    Cancels the generations of a connection started before `requested_at`.
+
+    Generations compare the flag with their own start time, so a later request on the same
+    connection is not affected and the flag never needs to be reset.
+
+    Returns:
+        list: The request IDs of the generations in flight on the connection.
+    """
+    try:
+        response = table.update_item(
+            Key={'connectionId': connection_id},
+            UpdateExpression='SET cancelledAt = :now',
+            ConditionExpression='attribute_exists(connectionId)',
+            ExpressionAttributeValues={':now': requested_at},
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return []
+    return sorted(response['Attributes'].get('activeRequests', []))
+
+
+class GenerationWatch:
+    """
+    Registers an in-flight generation on its connection item and watches for its cancellation.
+
+    `start` adds the request ID to the 'activeRequests' set of the connection and starts a daemon
+    thread reading the 'cancelledAt' and 'disconnectedAt' attributes every `interval` seconds; the
+    streaming loop only tests an in-memory flag (`cancelled` or `check`), so watching costs one
+    eventually consistent GetItem per interval and nothing per token. `stop` ends the thread and
+    removes the request ID. Without a table the watch is inert. DynamoDB errors are logged and
+    never fail the generation.
+
+    Args:
+        table: The boto3 DynamoDB Table resource of the connections, or None.
+        connection_id (str): The connection the generation streams to.
+        request_id (str): The API Gateway request ID of the generation.
+        started_at (int): The API Gateway request time of the generation, in milliseconds.
+        interval (float, optional): Seconds between two reads of the flag.
+    """
+
+    def __init__(self, table, connection_id, request_id, started_at, interval=CANCEL_CHECK_SECONDS):
+        self.table = table
+        self.connection_id = connection_id
+        self.request_id = request_id
+        self.started_at = started_at
+        self.interval = interval
+        self.reason = None
+        self.reads = 0
+
+        self._cancelled = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """Raises GenerationCancelled once the generation was cancelled."""
+        if self._cancelled.is_set():
+            raise GenerationCancelled(self.reason)
+
+    def cancel(self, reason):
+        """Flags the generation as cancelled from this container, e.g. when a post returned GoneException."""
+        if not self._cancelled.is_set():
+            self.reason = reason
+            self._cancelled.set()
+
+    def start(self):
+        if self.table is None:
+            return self
+        try:
+            self.table.update_item(
+                Key={'connectionId': self.connection_id},
+                UpdateExpression='ADD activeRequests :request SET expiresAt = if_not_exists(expiresAt, :expires)',
+                ExpressionAttributeValues={
+                    ':request': {self.request_id},
+                    ':expires': self.started_at // 1000 + CONNECTION_TTL_SECONDS
+                }
+            )
+        except Exception as e:
+            print(f"Could not register generation {self.request_id}: {e}")
+        self._thread = threading.Thread(target=self._watch, name='generation-watch', daemon=True)
+        self._thread.start()
+        return self
+
+    def _read(self):
+        response = self.table.get_item(
+            Key={'connectionId': self.connection_id},
+            ProjectionExpression='cancelledAt, disconnectedAt'
+        )
+        self.reads += 1
+        item = response.get('Item', {})
+        if item.get('cancelledAt', 0) >= self.started_at:
+            self.cancel(DISCONNECTED if 'disconnectedAt' in item else CANCELLED)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._read()
+            except Exception as e:
+                print(f"Could not read the cancellation flag of generation {self.request_id}: {e}")
+            if self._cancelled.is_set():
+                return
+
+    def stop(self):
+        """Stops watching and removes the generation from the connection. Must run before the handler returns."""
+        self._stop.set()
+        if self._thread is None:
+            return
+        self._thread.join()
+        self._thread = None
+        try:
+            self.table.update_item(
+                Key={'connectionId': self.connection_id},
+                UpdateExpression='DELETE activeRequests :request',
+                ExpressionAttributeValues={':request': {self.request_id}}
+            )
+        except Exception as e:
+            print(f"Could not unregister generation {self.request_id}: {e}")
+
+
+def estimate_output_tokens(text):
+    """Estimates the output tokens of a partial completion, four characters per token."""
+    return (len(text) + 3) // 4
+
+
+def max_tokens_avoided(max_tokens, text):
+    """
+    Returns an upper bound of the output tokens a stopped generation did not produce.
+
+    Bedrock does not report the usage of a stream closed early, so the tokens generated are
+    estimated from the text. The bound assumes the model would have used all of `max_tokens`;
+    most answers stop earlier on their own, so the actual savings are usually much lower and are
+    left to analysis of the estimated generated tokens.
+    """
+    return max(max_tokens - estimate_output_tokens(text), 0)
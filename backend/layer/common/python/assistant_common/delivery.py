@@ -0,0 +1,192 @@
+import json
+import os
+import time
+from botocore.exceptions import ClientError
+
+# Default flush thresholds, overridable via the STREAM_FLUSH_INTERVAL_MS and
+# STREAM_FLUSH_BYTES environment variables on the Lambda functions
+DEFAULT_FLUSH_INTERVAL_MS = 50
+DEFAULT_FLUSH_BYTES = 512
+
+
+class ConnectionGoneError(Exception):
+    """Raised when the WebSocket client has disconnected (API Gateway returned GoneException)."""
+
+
+class FlushPolicy:
+    """
+    Decides when buffered deltas should be posted to the WebSocket connection.
+
+    A flush happens as soon as either the buffered text reaches `max_bytes` or the oldest
+    buffered delta has been waiting for `interval_ms`. The very first delta of a response is
+    always posted immediately so that time-to-first-token is not delayed by coalescing.
+
+    Args:
+        interval_ms (int): Maximum time a delta may sit in the buffer before it is flushed.
+        max_bytes (int): Buffer size (UTF-8 bytes) that triggers a flush.
+        flush_first (bool): Whether the first delta is posted without buffering.
+    """
+
+    def __init__(self, interval_ms=DEFAULT_FLUSH_INTERVAL_MS, max_bytes=DEFAULT_FLUSH_BYTES, flush_first=True):
+        self.interval_ms = interval_ms
+        self.max_bytes = max_bytes
+        self.flush_first = flush_first
+
+    @classmethod
+    def from_env(cls):
+        """Builds a policy from the function environment variables, falling back to the defaults."""
+        return cls(
+            interval_ms=int(os.environ.get('STREAM_FLUSH_INTERVAL_MS', DEFAULT_FLUSH_INTERVAL_MS)),
+            max_bytes=int(os.environ.get('STREAM_FLUSH_BYTES', DEFAULT_FLUSH_BYTES))
+        )
+
+    def should_flush(self, buffered_bytes, waited_ms):
+        return buffered_bytes >= self.max_bytes or waited_ms >= self.interval_ms
+
+
+class StreamDelivery:
+    """
+    Buffers streamed text deltas and posts them to a WebSocket connection in batches.
+
+    The wire format is unchanged: every post carries `{"messages": <text>}` and the response is
+    terminated with `{"endOfMessage": true}`, so clients simply receive fewer, larger chunks. Each
+    frame also carries the `offset` of the end of its text, i.e. the characters of the answer the
+    client has received so far, which is where a resumed stream picks up (see `StreamBuffer`).
+
+    With a `buffer`, the posted text is also appended to the stream buffer, and a client that went
+    away (GoneException) detaches the generation instead of stopping it: nothing is posted anymore,
+    but the text and the final frame keep going to the buffer for the client to resume.
+
+    Args:
+        api_client: An `apigatewaymanagementapi` boto3 client.
+        connection_id (str): The WebSocket connection to post to.
+        policy (FlushPolicy, optional): Flush thresholds, defaults to `FlushPolicy.from_env()`.
+        clock (callable, optional): Monotonic clock in seconds, injectable for tests.
+        trace (Trace, optional): Request trace receiving the post latency and the post and byte counts.
+        tags (dict, optional): Fields added to every message and end frame, e.g. the model ID when several
+            models stream over the same connection.
+        offset (int, optional): The characters already received by the client, when resuming a stream.
+        buffer (StreamBuffer, optional): Stream buffer receiving the text and the end frame.
+    """
+
+    def __init__(self, api_client, connection_id, policy=None, clock=time.monotonic, trace=None, tags=None, offset=0, buffer=None):
+        self.api_client = api_client
+        self.connection_id = connection_id
+        self.policy = policy or FlushPolicy.from_env()
+        self.clock = clock
+        self.trace = trace
+        self.tags = tags or {}
+        self.offset = offset
+        self.buffer = buffer
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_since = None
+
+        self.deltas_received = 0
+        self.message_posts = 0
+        self.total_posts = 0
+
+    def send(self, text):
+        """Adds a text delta to the buffer and flushes it if the policy says so."""
+        if not text:
+            return
+        self.deltas_received += 1
+        if self.trace:
+            self.trace.count('chunks')
+        if self._buffered_since is None:
+            self._buffered_since = self.clock()
+        self._buffer.append(text)
+        self._buffered_bytes += len(text.encode('utf-8'))
+
+        if self.policy.flush_first and self.message_posts == 0:
+            self.flush()
+        elif self.policy.should_flush(self._buffered_bytes, self.waited_ms()):
+            self.flush()
+
+    def waited_ms(self):
+        """Returns how long the oldest buffered delta has been waiting, in milliseconds."""
+        if self._buffered_since is None:
+            return 0
+        return (self.clock() - self._buffered_since) * 1000
+
+    def flush(self):
+        """Posts all buffered text as a single message."""
+        if not self._buffer:
+            return
+        text = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_since = None
+        self.message_posts += 1
+        self.offset = self.buffer.append(text) if self.buffer else self.offset + len(text)
+        self.post({"messages": text, "offset": self.offset, **self.tags})
+
+    def end_frame(self, metadata=None):
+        """Returns the end-of-message frame, with the fields of `metadata`."""
+        return {"endOfMessage": True, "offset": self.offset, **self.tags, **(metadata or {})}
+
+    def end(self, metadata=None):
+        """
+        Flushes the remaining text and sends the end-of-message signal, then closes the stream buffer.
+
+        Args:
+            metadata (dict, optional): Fields added to the end-of-message frame, e.g. the token usage.
+        """
+        self.flush()
+        frame = self.end_frame(metadata)
+        self.post(frame)
+        if self.buffer:
+            self.buffer.close(frame)
+
+    @property
+    def detached(self):
+        """Whether the client went away while the generation goes on into the stream buffer."""
+        return self.buffer is not None and self.buffer.detached
+
+    def post(self, payload):
+        """
+        Posts a JSON payload to the connection immediately, bypassing the buffer.
+
+        Once the generation is detached nothing is posted.
+
+        Raises:
+            ConnectionGoneError: If the client is no longer connected and the generation cannot be detached.
+        """
+        if self.detached:
+            return
+        self.total_posts += 1
+        data = json.dumps(payload)
+        started = time.perf_counter()
+        try:
+            self.api_client.post_to_connection(
+                ConnectionId=self.connection_id,
+                Data=data
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'GoneException':
+                if self.buffer and self.buffer.detach():
+                    return
+                raise ConnectionGoneError(self.connection_id) from error
+            raise
+        finally:
+            if self.trace:
+                self.trace.add_time('postToConnection', (time.perf_counter() - started) * 1000)
+                self.trace.count('posts')
+                self.trace.count('postedBytes', len(data))
+
+    @property
+    def posts_saved(self):
+        """Number of `post_to_connection` calls avoided compared to posting every delta."""
+        return self.deltas_received - self.message_posts
+
+    def stats(self):
+        return {
+            'deltas': self.deltas_received,
+            'posts': self.total_posts,
+            'postsSaved': self.posts_saved
+        }
+
+    def log_stats(self, request_id=None):
+        """Prints the per-request delivery statistics to the function logs."""
+        print(f"Stream delivery for request {request_id}: {json.dumps(self.stats())}")
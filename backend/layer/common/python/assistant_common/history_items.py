@@ -0,0 +1,156 @@
+import gzip
+import hashlib
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Length of the prompt and completion previews stored on history items for the list view
+PREVIEW_CHARS = int(os.environ.get('HISTORY_PREVIEW_CHARS', 200))
+
+# Global secondary index of the history table projecting only the list view attributes
+SUMMARY_INDEX = 'email-timestamp-summary-index'
+SUMMARY_ATTRIBUTES = ['email', 'timestamp', 'requestId', 'modelId', 'promptPreview', 'completionPreview', 'imageS3Keys']
+
+# Prompt and completion sizes (in bytes, together) above which they are stored compressed in the
+# item, and above which they are moved to a compressed S3 object
+COMPRESS_BYTES = int(os.environ.get('HISTORY_COMPRESS_BYTES', 4096))
+OFFLOAD_BYTES = int(os.environ.get('HISTORY_OFFLOAD_BYTES', 65536))
+BODY_FIELDS = ('promptData', 'completion')
+# Attributes holding the bodies once compressed or offloaded
+BODY_ATTRIBUTES = ['bodyBlob', 'bodyS3Key', 'bodyEncoding']
+
+# Request fields already stored in their own history attributes, or not worth keeping
+STORED_REQUEST_FIELDS = {'action', 'data', 'modelId', 'system', 'imageS3Keys'}
+
+
+def preview(text, chars=PREVIEW_CHARS):
+    """Returns the start of `text`, cut at `chars` characters with an ellipsis."""
+    if not text or len(text) <= chars:
+        return text or ''
+    return text[:chars].rstrip() + '…'
+
+
+def request_parameters(body):
+    """
+    Returns the fields of a WebSocket request body that are not stored elsewhere in the history item.
+
+    The prompt, system prompt, model and image keys have their own attributes, so only the inference
+    parameters (and any other field a client sent) are kept in 'requestBody'.
+    """
+    return {name: value for name, value in body.items() if name not in STORED_REQUEST_FIELDS}
+
+
+def summary_fields(prompt, completion):
+    """Returns the preview attributes written on a history item for the list view."""
+    return {'promptPreview': preview(prompt), 'completionPreview': preview(completion)}
+
+
+def body_encoding():
+    """zstd when the zstandard package is available, gzip otherwise."""
+    return 'zstd' if zstandard else 'gzip'
+
+
+def compress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data, encoding):
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('History body is zstd-compressed but the zstandard package is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def body_prefix(email):
+    """S3 prefix of the offloaded bodies of a user."""
+    return f"history-bodies/{hashlib.sha256(email.encode('utf-8')).hexdigest()[:32]}/"
+
+
+def body_key(email, timestamp, request_id):
+    """
+    S3 key of the offloaded bodies of a history item.
+
+    The key starts with the item timestamp so deletes can select objects without reading the items, and ends
+    with the request ID so two requests landing on the same timestamp never share an object.
+    """
+    return f'{body_prefix(email)}{timestamp}-{request_id}'
+
+
+def body_key_timestamp(key, prefix):
+    """Returns the item timestamp of an offloaded body key under `prefix`."""
+    return key[len(prefix):].split('-', 1)[0]
+
+
+def store_bodies(item, s3=None, bucket=None):
+    """
+    Moves the prompt and completion of a history item to the storage tier matching their size.
+
+    Small bodies stay inline. Above COMPRESS_BYTES they are stored together as one compressed binary
+    attribute ('bodyBlob'), and above OFFLOAD_BYTES (when a bucket is configured) as a compressed S3
+    object whose key is kept in 'bodyS3Key'. The previews of the list view stay on the item in every case.
+
+    Args:
+        item (dict): The history item, updated in place.
+        s3: A boto3 S3 client, required to offload.
+        bucket (str, optional): The bucket holding offloaded bodies.
+
+    Returns:
+        str: Where the bodies are stored: 'inline', 'compressed' or 's3'.
+    """
+    bodies = {field: item[field] for field in BODY_FIELDS if item.get(field)}
+    size = sum(len(text.encode('utf-8')) for text in bodies.values())
+    if size < COMPRESS_BYTES:
+        return 'inline'
+
+    encoding = body_encoding()
+    data = compress(json.dumps(bodies).encode('utf-8'), encoding)
+    if size >= OFFLOAD_BYTES and s3 and bucket:
+        key = body_key(item['email'], item['timestamp'], item['requestId'])
+        s3.put_object(Bucket=bucket, Key=key, Body=data, ContentType='application/octet-stream', Metadata={'encoding': encoding})
+        item['bodyS3Key'] = key
+        location = 's3'
+    else:
+        item['bodyBlob'] = data
+        location = 'compressed'
+    item['bodyEncoding'] = encoding
+    for field in bodies:
+        del item[field]
+    return location
+
+
+def hydrate_bodies(item, s3=None, bucket=None, fetch=True):
+    """
+    Restores the prompt and completion of a history item written by `store_bodies`.
+
+    Compressed bodies are decoded from the item. Offloaded bodies are read from S3 only when `fetch` is set;
+    otherwise their previews stand in for them and 'bodyTruncated' is set, so list views never read S3.
+
+    Args:
+        item (dict): The history item, updated in place.
+        s3: A boto3 S3 client, required to fetch offloaded bodies.
+        bucket (str, optional): The bucket holding offloaded bodies.
+        fetch (bool, optional): Whether to read offloaded bodies from S3.
+
+    Returns:
+        dict: The item.
+    """
+    encoding = item.pop('bodyEncoding', None)
+    blob = item.pop('bodyBlob', None)
+    key = item.pop('bodyS3Key', None)
+    if blob is not None:
+        item.update(json.loads(decompress(getattr(blob, 'value', blob), encoding)))
+    elif key and fetch:
+        data = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        item.update(json.loads(decompress(data, encoding)))
+    elif key:
+        item['promptData'] = item.get('promptPreview', '')
+        item['completion'] = item.get('completionPreview', '')
+        item['bodyTruncated'] = True
+    return item
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError
+
+from assistant_common.batch import backoff_delay
+
+# Attempts of a queued write, errors that cannot succeed on retry are not retried
+WRITE_BEHIND_ATTEMPTS = 3
+NON_RETRYABLE_ERRORS = {'ConditionalCheckFailedException', 'ValidationException', 'AccessDeniedException'}
+
+
+def write_behind_enabled():
+    """Whether history is persisted after the end-of-message signal (HISTORY_WRITE_BEHIND, on by default)."""
+    return os.environ.get('HISTORY_WRITE_BEHIND', 'true').lower() == 'true'
+
+
+class WriteBehindQueue:
+    """
+    Runs writes on a background thread so the caller can answer the client before they complete.
+
+    Lambda freezes the container as soon as the handler returns, so every invocation must call
+    `drain()` before returning: the writes still run within the invocation, just off the critical
+    path of the response. Failed writes are retried with backoff; the writes must therefore be
+    idempotent (e.g. conditional on a request ID).
+
+    Args:
+        max_attempts (int, optional): Attempts of each write.
+        sleep (callable, optional): Replaceable sleep used between attempts.
+    """
+
+    def __init__(self, max_attempts=WRITE_BEHIND_ATTEMPTS, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.sleep = sleep
+        self._executor = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _run(self, label, fn, args):
+        started = time.perf_counter()
+        for attempt in range(self.max_attempts):
+            try:
+                result = fn(*args)
+                return {'label': label, 'ok': True, 'attempts': attempt + 1, 'ms': (time.perf_counter() - started) * 1000, 'result': result}
+            except Exception as error:
+                code = error.response['Error']['Code'] if isinstance(error, ClientError) else None
+                if code in NON_RETRYABLE_ERRORS or attempt == self.max_attempts - 1:
+                    return {'label': label, 'ok': False, 'attempts': attempt + 1, 'ms': (time.perf_counter() - started) * 1000, 'error': str(error)}
+                self.sleep(backoff_delay(attempt))
+
+    def submit(self, label, fn, *args):
+        """Queues `fn(*args)`; `label` identifies the write in the logs (e.g. the request ID)."""
+        with self._lock:
+            if self._executor is None:
+                # One worker keeps the writes of an invocation in submission order
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._pending.append(self._executor.submit(self._run, label, fn, args))
+
+    def drain(self, timeout=None):
+        """
+        Waits for the queued writes and logs their outcome.
+
+        Returns:
+            list: One result per write with 'label', 'ok', 'attempts', 'ms' and 'result' or 'error'.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return []
+        done, not_done = wait(pending, timeout=timeout)
+        results = [future.result() for future in done]
+        results += [{'label': None, 'ok': False, 'attempts': 0, 'ms': None, 'error': 'Timed out'} for _ in not_done]
+        for result in results:
+            if result['ok']:
+                print(f"Persisted {result['label']} in {result['ms']:.1f} ms ({result['attempts']} attempts)")
+            else:
+                print(f"Failed to persist {result['label']} after {result['attempts']} attempts: {result['error']}")
+        return results
@@ -0,0 +1,118 @@
+import os
+import queue
+import threading
+
+# Maximum number of stream events held between the reader thread and the sender
+DEFAULT_QUEUE_SIZE = 256
+# Shortest wait for the next event while text is buffered, so a zero flush interval does not spin
+MIN_IDLE_WAIT_SECONDS = 0.005
+# Time `close()` waits for the producer once the stream is closed
+CLOSE_TIMEOUT_SECONDS = 0.2
+
+_END = object()
+
+
+def pipeline_enabled():
+    """Returns True when the STREAM_PIPELINE environment variable turns the pipeline mode on."""
+    return os.environ.get('STREAM_PIPELINE', 'false').lower() == 'true'
+
+
+class PipelinedStream:
+    """
+    Reads a model stream on a background thread so that WebSocket posting never stalls it.
+
+    The producer thread drains `events` into a bounded queue; iterating over this object on
+    the calling thread yields the same events in order. When the queue is full the producer
+    blocks (backpressure), and when `close()` is called - for example because the client went
+    away - the underlying stream is closed so that the model stops generating tokens nobody will
+    read. Closing it also ends a read the producer is blocked in, so `close()` does not wait for
+    the next model event.
+
+    While waiting for the next event the consumer flushes `delivery` once its time threshold is
+    reached, so buffered text is not held back by a pause in the model output. With nothing
+    buffered it blocks until the next event.
+
+    Args:
+        events (iterable): The stream to consume, e.g. the `stream` of a ConverseStream response.
+        delivery (StreamDelivery, optional): Delivery buffer to flush while the stream is idle.
+        max_queue (int, optional): Capacity of the queue between producer and consumer.
+    """
+
+    def __init__(self, events, delivery=None, max_queue=DEFAULT_QUEUE_SIZE):
+        self.events = events
+        self.delivery = delivery
+        self.events_read = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._produce, name='stream-producer', daemon=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _produce(self):
+        try:
+            for event in self.events:
+                self.events_read += 1
+                if not self._put(event):
+                    break
+        except Exception as error:
+            self._error = error
+        finally:
+            if self._stop.is_set():
+                close = getattr(self.events, 'close', None)
+                if close:
+                    close()
+            self._put(_END)
+
+    def _put(self, item):
+        # Block while the queue is full, but give up as soon as the consumer stops
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _idle_timeout(self):
+        # Nothing is buffered: only the next event can change that
+        if not self.delivery or self.delivery.waited_ms() == 0:
+            return None
+        return max((self.delivery.policy.interval_ms - self.delivery.waited_ms()) / 1000, MIN_IDLE_WAIT_SECONDS)
+
+    def __iter__(self):
+        self._thread.start()
+        while True:
+            try:
+                item = self._queue.get(timeout=self._idle_timeout())
+            except queue.Empty:
+                self.delivery.flush()
+                continue
+            if item is _END:
+                break
+            yield item
+
+        if self._error:
+            raise self._error
+
+    def close(self):
+        """Stops the producer thread, closing the stream it may be blocked on, and waits for it."""
+        self._stop.set()
+        if not self._thread.is_alive():
+            return
+        close = getattr(self.events, 'close', None)
+        if close:
+            try:
+                close()
+            except ValueError:
+                # A generator (e.g. a chat engine) running on the producer thread cannot be closed from here,
+                # the producer closes it itself once its next event is refused
+                pass
+            except Exception as e:
+                print(f"Could not close the model stream: {e}")
+        self._thread.join(CLOSE_TIMEOUT_SECONDS)
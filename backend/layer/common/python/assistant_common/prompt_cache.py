@@ -0,0 +1,84 @@
+import os
+
+# Model ID prefixes accepting Converse API cache points. Overridable with PROMPT_CACHE_MODELS
+# (comma-separated prefixes) as support is added to more models.
+DEFAULT_PROMPT_CACHE_MODELS = (
+    'anthropic.claude-3-5-haiku',
+    'anthropic.claude-3-7-sonnet',
+    'anthropic.claude-sonnet-4',
+    'anthropic.claude-opus-4',
+    'anthropic.claude-haiku-4',
+    'amazon.nova-micro',
+    'amazon.nova-lite',
+    'amazon.nova-pro',
+    'amazon.nova-premier',
+)
+
+# Models ignore cache points closing a shorter prefix, estimated at four characters per token
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get('PROMPT_CACHE_MIN_TOKENS', 1024))
+
+# Usage fields of the ConverseStream `metadata` event, as stored in history items and end frames
+USAGE_FIELDS = ('inputTokens', 'outputTokens', 'totalTokens', 'cacheReadInputTokens', 'cacheWriteInputTokens')
+
+CACHE_POINT = {'cachePoint': {'type': 'default'}}
+
+
+def prompt_caching_enabled():
+    """Returns True unless the PROMPT_CACHE environment variable turns cache points off."""
+    return os.environ.get('PROMPT_CACHE', 'true').lower() == 'true'
+
+
+def supports_prompt_cache(model_id):
+    """Whether `model_id` accepts cache points, ignoring cross-region inference profile prefixes."""
+    model = model_id.split('/')[-1]
+    if model.split('.')[0] in ('us', 'eu', 'apac', 'us-gov', 'global'):
+        model = model.split('.', 1)[1]
+    configured = os.environ.get('PROMPT_CACHE_MODELS')
+    prefixes = tuple(p.strip() for p in configured.split(',') if p.strip()) if configured else DEFAULT_PROMPT_CACHE_MODELS
+    return model.startswith(prefixes)
+
+
+def estimate_tokens(blocks):
+    return sum(len(block.get('text', '')) for block in blocks) // 4
+
+
+def add_cache_points(request, min_tokens=PROMPT_CACHE_MIN_TOKENS):
+    """
+    Inserts cache points in a ConverseStream request after its stable prefix.
+
+    A cache point closes the system blocks, and another one closes the messages before the last
+    one (the conversation history, which the next turn resends unchanged). Bedrock then reuses the
+    processed prefix of earlier requests instead of reprocessing it: cached tokens are billed at
+    the cache read rate and time-to-first-token drops. A cache point is only added when the prefix
+    it closes reaches `min_tokens`, and only for models supporting prompt caching.
+
+    Args:
+        request (dict): The ConverseStream keyword arguments ('modelId', 'messages', optional 'system'),
+            updated in place.
+        min_tokens (int, optional): Minimum estimated size of a cached prefix.
+
+    Returns:
+        int: The number of cache points added.
+    """
+    if not prompt_caching_enabled() or not supports_prompt_cache(request['modelId']):
+        return 0
+    added = 0
+    prefix_tokens = 0
+    system = request.get('system')
+    if system:
+        prefix_tokens = estimate_tokens(system)
+        if prefix_tokens >= min_tokens:
+            system.append(dict(CACHE_POINT))
+            added += 1
+    history = request['messages'][:-1]
+    if history:
+        prefix_tokens += sum(estimate_tokens(message['content']) for message in history)
+        if prefix_tokens >= min_tokens:
+            history[-1]['content'].append(dict(CACHE_POINT))
+            added += 1
+    return added
+
+
+def usage_fields(usage):
+    """Returns the token usage of a `metadata` event, reduced to the USAGE_FIELDS it reports."""
+    return {name: int(usage[name]) for name in USAGE_FIELDS if name in usage}
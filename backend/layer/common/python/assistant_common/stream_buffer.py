@@ -0,0 +1,302 @@
+import json
+import os
+import threading
+import time
+
+from assistant_common.clients import get_table
+from assistant_common.connections import CANCELLED, DISCONNECTED, GenerationCancelled
+
+# Time the deltas of a generation stay available to a reconnected client, through the table TTL
+STREAM_BUFFER_TTL_SECONDS = int(os.environ.get('STREAM_BUFFER_TTL_SECONDS', 900))
+# Interval between two buffer writes, the deltas received in between are stored as one chunk item
+STREAM_BUFFER_FLUSH_SECONDS = int(os.environ.get('STREAM_BUFFER_FLUSH_MS', 250)) / 1000
+# Time a generation keeps going after its client disconnected, waiting for a resume action
+RESUME_GRACE_SECONDS = float(os.environ.get('RESUME_GRACE_SECONDS', 20))
+# Time a resumed stream waits for new chunks before giving up on the generation
+RESUME_IDLE_TIMEOUT_SECONDS = float(os.environ.get('RESUME_IDLE_TIMEOUT_SECONDS', 60))
+
+# Final frame of a generation that failed before sending its end-of-message signal
+INTERRUPTED_FRAME = {'action': 'error', 'error': 'The answer was interrupted, please try again.'}
+
+
+def stream_buffer_table():
+    """Returns the stream buffer table, or None when STREAM_BUFFER_TABLE is not set."""
+    table_name = os.environ.get('STREAM_BUFFER_TABLE')
+    return get_table(table_name) if table_name else None
+
+
+class StreamBuffer:
+    """
+    Keeps the deltas of an in-flight generation in DynamoDB so a reconnected client can resume it.
+
+    The items of a stream share its 'streamId' (the request ID of the generation) and are ordered by
+    'seq'. Item 0 is the header: connection, user, and the 'resumedAt' / 'cancelledAt' attributes set
+    by the resume action. Items 1, 2... are chunks holding the text between 'startOffset' and
+    'startOffset' + len(text), in characters of the answer; the last one also holds the 'final' frame
+    of the generation (its end-of-message or error frame). Every item expires after
+    STREAM_BUFFER_TTL_SECONDS.
+
+    `append` only adds the text to an in-memory list: a daemon thread writes the pending text as one
+    chunk every `interval` seconds, so buffering costs one PutItem per interval and nothing per token.
+    When the client is gone, `detach` lets the generation go on into the buffer; while detached the
+    thread also reads the header, and `check` stops the generation once the resumed client cancelled
+    it, or when nobody resumed it within `grace` seconds. Without a table the buffer is inert. DynamoDB
+    errors are logged and never fail the generation; a chunk that could not be written is retried with
+    the next one.
+
+    Args:
+        table: The boto3 DynamoDB Table resource of the stream buffer, or None.
+        stream_id (str): The request ID of the generation.
+        connection_id (str): The connection the generation streams to.
+        email (str): The email address of the user, only this user may resume the stream.
+        started_at (int): The API Gateway request time of the generation, in milliseconds.
+        interval (float, optional): Seconds between two chunk writes.
+        grace (float, optional): Seconds a detached generation waits for a resume action.
+        clock (callable, optional): Monotonic clock in seconds.
+    """
+
+    def __init__(self, table, stream_id, connection_id, email, started_at,
+                 interval=STREAM_BUFFER_FLUSH_SECONDS, grace=RESUME_GRACE_SECONDS, clock=time.monotonic):
+        self.table = table
+        self.stream_id = stream_id
+        self.connection_id = connection_id
+        self.email = email
+        self.expires_at = started_at // 1000 + STREAM_BUFFER_TTL_SECONDS
+        self.interval = interval
+        self.grace = grace
+        self.clock = clock
+
+        self.length = 0
+        self.detached_at = None
+        self.resumed = False
+        self.cancel_requested = False
+        self.chunks_written = 0
+        self.write_errors = 0
+
+        self._pending = []
+        self._pending_start = 0
+        self._seq = 0
+        self._final = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.table is not None
+
+    @property
+    def detached(self):
+        return self.detached_at is not None
+
+    def open(self):
+        """Starts the writer thread, which writes the header first."""
+        if not self.enabled:
+            return self
+        self._thread = threading.Thread(target=self._write_loop, name='stream-buffer', daemon=True)
+        self._thread.start()
+        return self
+
+    def append(self, text):
+        """
+        Adds a delta to the buffer.
+
+        Returns:
+            int: The offset of the end of the delta, i.e. the characters of the answer so far.
+        """
+        with self._lock:
+            if self.enabled:
+                self._pending.append(text)
+            self.length += len(text)
+            return self.length
+
+    def detach(self):
+        """
+        Lets the generation go on without a client, until it is resumed or the grace period ends.
+
+        Returns:
+            bool: True if the generation may continue into the buffer, False when buffering is disabled.
+        """
+        if not self.enabled:
+            return False
+        if self.detached_at is None:
+            self.detached_at = self.clock()
+            print(f"Client of stream {self.stream_id} is gone, buffering for {self.grace:.0f} s while it may resume")
+        return True
+
+    def check(self):
+        """Raises GenerationCancelled once a detached generation was cancelled, or nobody resumed it in time."""
+        if self.detached_at is None:
+            return
+        if self.cancel_requested:
+            raise GenerationCancelled(CANCELLED)
+        if not self.resumed and self.clock() - self.detached_at > self.grace:
+            raise GenerationCancelled(DISCONNECTED)
+
+    def close(self, final=None):
+        """
+        Writes the pending text with the `final` frame and stops the writer thread. Must run before the handler returns.
+
+        Only the first call counts, so the handler can call it from its `finally` block: without a
+        `final` frame the stream ends with INTERRUPTED_FRAME.
+        """
+        if self._thread is None:
+            return
+        self._final = final or INTERRUPTED_FRAME
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _write_loop(self):
+        self._put({
+            'streamId': self.stream_id,
+            'seq': 0,
+            'connectionId': self.connection_id,
+            'email': self.email,
+            'expiresAt': self.expires_at
+        })
+        while not self._stop.wait(self.interval):
+            self._write_chunk()
+            if self.detached_at is not None and not self.cancel_requested:
+                self._read_header()
+        # Retried once, the final chunk is what ends the stream for a resumed client
+        if not self._write_chunk(final=True):
+            self._write_chunk(final=True)
+
+    def _write_chunk(self, final=False):
+        with self._lock:
+            texts, start = self._pending, self._pending_start
+            self._pending = []
+            self._pending_start = self.length
+        if not texts and not final:
+            return True
+        item = {
+            'streamId': self.stream_id,
+            'seq': self._seq + 1,
+            'startOffset': start,
+            'text': ''.join(texts),
+            'expiresAt': self.expires_at
+        }
+        if final:
+            item['final'] = json.dumps(self._final)
+        if self._put(item):
+            self._seq += 1
+            self.chunks_written += 1
+            return True
+        # Put the text back in front of what was appended meanwhile, it goes out with the next chunk
+        with self._lock:
+            self._pending[:0] = texts
+            self._pending_start = start
+        return False
+
+    def _put(self, item):
+        try:
+            self.table.put_item(Item=item)
+            return True
+        except Exception as e:
+            self.write_errors += 1
+            print(f"Could not buffer stream {self.stream_id}: {e}")
+            return False
+
+    def _read_header(self):
+        try:
+            item = self.table.get_item(
+                Key={'streamId': self.stream_id, 'seq': 0},
+                ProjectionExpression='resumedAt, cancelledAt'
+            ).get('Item', {})
+        except Exception as e:
+            print(f"Could not read the header of stream {self.stream_id}: {e}")
+            return
+        self.resumed = self.resumed or 'resumedAt' in item
+        self.cancel_requested = 'cancelledAt' in item
+
+    def stats(self):
+        return {
+            'characters': self.length,
+            'chunks': self.chunks_written,
+            'writeErrors': self.write_errors,
+            'detached': self.detached,
+            'resumed': self.resumed
+        }
+
+
+def get_stream_header(table, stream_id):
+    """Returns the header item of a buffered stream, or None once it expired."""
+    return table.get_item(Key={'streamId': stream_id, 'seq': 0}, ConsistentRead=True).get('Item')
+
+
+def mark_resumed(table, stream_id, connection_id, resumed_at):
+    """Records that a client resumed the stream, which keeps a detached generation going."""
+    table.update_item(
+        Key={'streamId': stream_id, 'seq': 0},
+        UpdateExpression='SET resumedAt = :now, resumedBy = :connection',
+        ExpressionAttributeValues={':now': resumed_at, ':connection': connection_id}
+    )
+
+
+def cancel_stream(table, stream_id, cancelled_at):
+    """Cancels a detached generation from the connection that resumed it."""
+    table.update_item(
+        Key={'streamId': stream_id, 'seq': 0},
+        UpdateExpression='SET cancelledAt = :now',
+        ExpressionAttributeValues={':now': cancelled_at}
+    )
+
+
+def tail_stream(table, stream_id, offset, send, poll_interval=STREAM_BUFFER_FLUSH_SECONDS,
+                idle_timeout=RESUME_IDLE_TIMEOUT_SECONDS, clock=time.monotonic, sleep=time.sleep):
+    """
+    Sends the text of a buffered stream from `offset`, following the live tail until the final chunk.
+
+    The chunks after the last one read are fetched with a strongly consistent Query every
+    `poll_interval` seconds while the generation is running, and the text of each poll is passed to
+    `send` at once: replaying a long backlog costs one call, then the tail follows with one call per
+    chunk written. Text before `offset` is skipped, so the client receives every character exactly
+    once whatever the chunk boundaries.
+
+    Args:
+        table: The boto3 DynamoDB Table resource of the stream buffer.
+        stream_id (str): The request ID of the generation.
+        offset (int): The characters the client already received.
+        send (callable): Receives the text of the answer, in order.
+        idle_timeout (float, optional): Seconds without a new chunk after which the generation is considered lost.
+
+    Returns:
+        dict: The final frame of the generation, INTERRUPTED_FRAME if it never arrived.
+    """
+    last_seq = 0
+    last_chunk_at = clock()
+    while True:
+        query = {
+            'KeyConditionExpression': 'streamId = :stream AND seq > :seq',
+            'ExpressionAttributeValues': {':stream': stream_id, ':seq': last_seq},
+            'ConsistentRead': True
+        }
+        texts = []
+        final = None
+        read = False
+        while final is None:
+            response = table.query(**query)
+            for item in response['Items']:
+                read = True
+                last_seq = int(item['seq'])
+                start = int(item['startOffset'])
+                text = item['text'][max(offset - start, 0):]
+                if text:
+                    offset += len(text)
+                    texts.append(text)
+                if 'final' in item:
+                    final = json.loads(item['final'])
+                    break
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        if texts:
+            send(''.join(texts))
+        if final is not None:
+            return final
+        if read:
+            last_chunk_at = clock()
+        elif clock() - last_chunk_at > idle_timeout:
+            return INTERRUPTED_FRAME
+        sleep(poll_interval)
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# CloudWatch namespace of the metrics extracted from the trace log lines
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'EmployeeProductivityGenAIAssistant')
+
+# Usage fields of the ConverseStream `metadata` event recorded as counters
+USAGE_COUNTERS = ('inputTokens', 'outputTokens', 'totalTokens', 'cacheReadInputTokens', 'cacheWriteInputTokens')
+
+# Values of a record published as CloudWatch metrics, each one is billed per Route and ModelId. The
+# other spans, marks and counters are only fields of the log line, queryable in Logs Insights
+CLOUDWATCH_METRICS = (
+    'durationMs', 'timeToFirstTokenMs', 'endOfMessageMs', 'outputTokensPerSecond',
+    'inputTokens', 'outputTokens', 'errors', 'rejected', 'disconnects', 'cancellations'
+)
+
+
+def tracing_enabled():
+    """Returns True unless the TRACING_ENABLED environment variable turns tracing off."""
+    return os.environ.get('TRACING_ENABLED', 'true').lower() == 'true'
+
+
+def metric_unit(name):
+    if name.endswith('Ms'):
+        return 'Milliseconds'
+    if name.endswith('Bytes'):
+        return 'Bytes'
+    if name.endswith('PerSecond'):
+        return 'Count/Second'
+    return 'Count'
+
+
+def print_sink(record):
+    """Writes a record to the function logs, where CloudWatch extracts the metrics of EMF lines."""
+    print(json.dumps(record))
+
+
+_sink = print_sink
+
+
+def set_sink(sink):
+    """Replaces the destination of emitted records. Returns the previous one."""
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+class LocalCollector:
+    """
+    Keeps emitted records in memory instead of logging them, for tests and benchmarks.
+
+    Used as a context manager it becomes the sink for the duration of the block:
+
+        with LocalCollector() as collector:
+            handler(event, None)
+        collector.values('timeToFirstTokenMs')
+    """
+
+    def __init__(self):
+        self.records = []
+        self._previous = None
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def values(self, name):
+        """Returns the value of a metric in every record that has it."""
+        return [record[name] for record in self.records if name in record]
+
+    def __enter__(self):
+        self._previous = set_sink(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        set_sink(self._previous)
+        return False
+
+
+class Trace:
+    """
+    Collects the stage timings and counters of one request and emits them as a single log line.
+
+    Spans accumulate the time spent in a stage (every WebSocket post adds to one span), marks record
+    the time elapsed since the start of the request the first time a point is reached (e.g. the
+    first token), and counters add up. `emit()` writes everything as one CloudWatch Embedded
+    Metric Format record: span and mark names get an 'Ms' suffix, and the values listed in
+    CLOUDWATCH_METRICS become metrics with the dimensions of the trace. Every other value, like
+    the properties (such as the request ID), is searchable in Logs Insights without creating a
+    metric. A trace costs a few clock reads and dict updates per stage, and one log line.
+
+    Methods may be called from the stream reader and write-behind threads.
+
+    Args:
+        route (str): The route of the request, used as the 'Route' dimension.
+        request_id (str, optional): Logged as a property of the record.
+        clock (callable, optional): Clock in seconds, injectable for tests.
+    """
+
+    def __init__(self, route, request_id=None, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.dimensions = {'Route': route}
+        self.properties = {'requestId': request_id} if request_id else {}
+        self.spans = {}
+        self.marks = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, (self.clock() - started) * 1000)
+
+    def add_time(self, name, ms):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0) + ms
+
+    def mark(self, name):
+        """Records the time elapsed since the start of the request, the first time only."""
+        if name not in self.marks:
+            self.marks[name] = (self.clock() - self.started) * 1000
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_dimension(self, name, value):
+        self.dimensions[name] = value
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def record_metadata(self, metadata):
+        """
+        Records the ConverseStream `metadata` event: the token usage as counters and the latency
+        Bedrock reports as the 'modelLatency' span.
+        """
+        usage = metadata.get('usage', {})
+        for name in USAGE_COUNTERS:
+            if name in usage:
+                self.count(name, usage[name])
+        latency = metadata.get('metrics', {}).get('latencyMs')
+        if latency is not None:
+            self.add_time('modelLatency', latency)
+
+    def metrics(self):
+        """Returns the metrics of the trace, including the total duration so far."""
+        with self._lock:
+            metrics = {f'{name}Ms': round(ms, 2) for name, ms in {**self.spans, **self.marks}.items()}
+            metrics.update(self.counters)
+        metrics['durationMs'] = round((self.clock() - self.started) * 1000, 2)
+        stream_ms = self.spans.get('stream')
+        if stream_ms and self.counters.get('outputTokens'):
+            metrics['outputTokensPerSecond'] = round(self.counters['outputTokens'] / stream_ms * 1000, 1)
+        return metrics
+
+    def record(self):
+        """Builds the Embedded Metric Format record of the trace."""
+        metrics = self.metrics()
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': metric_unit(name)} for name in metrics if name in CLOUDWATCH_METRICS]
+                }]
+            },
+            **self.dimensions,
+            **self.properties,
+            **metrics
+        }
+
+    def emit(self):
+        """Sends the record to the current sink, unless tracing is turned off."""
+        if tracing_enabled():
+            _sink(self.record())
@@ -2,13 +2,30 @@ import boto3
 import json
 import time
 import os
+import uuid
 from botocore.exceptions import ClientError
+from assistant_common.batch import batch_get, batch_write, log_progress
+from assistant_common.clients import get_client
+from assistant_common.history_items import BODY_ATTRIBUTES, SUMMARY_INDEX, body_key_timestamp, body_prefix, hydrate_bodies, summary_fields
+from history_export import MultipartGzipWriter, json_default, write_ndjson
 
 # Set up DynamoDB client
 dynamodb = boto3.resource('dynamodb')
 # Set up DynamoDB table
 table = dynamodb.Table(os.environ.get('DYNAMODB_TABLE'))
 
+# Maximum number of keys accepted by a bulk delete request
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+
+# Bucket receiving the history exports, and validity of their download URL
+EXPORT_BUCKET = os.environ.get('HISTORY_EXPORT_BUCKET')
+EXPORT_URL_EXPIRES = int(os.environ.get('HISTORY_EXPORT_URL_EXPIRES', 900))
+# Attributes included in an export, the request body, source IP and user agent are left out
+EXPORT_ATTRIBUTES = ['timestamp', 'requestId', 'modelId', 'promptData', 'completion', 'systemPrompt', 'imageS3Keys'] + BODY_ATTRIBUTES
+
+# Bucket holding the prompts and completions moved out of large history items
+BODY_BUCKET = os.environ.get('HISTORY_BODY_BUCKET')
+
 def handler(event, context):
     http_method = event['httpMethod']
     # extract email value from the requestContext (provided by API GW input)
@@ -17,13 +34,19 @@ def handler(event, context):
     try:
         # Handle GET requests
         if http_method == 'GET':
-            query_params = event.get('queryStringParameters', {})
+            query_params = event.get('queryStringParameters') or {}
             last_key_email = query_params.get('last_key_email')
             last_key_timestamp = query_params.get('last_key_timestamp')
-            limit = query_params.get('limit', 10)  # Default to 10 items per page
+            limit = int(query_params.get('limit', 10))  # Default to 10 items per page
         
             # Make sure the user requesting is the same user authenticated (security check)
-            if 'email' in query_params and email_from_token == query_params['email']:
+            if 'email' in query_params and email_from_token == query_params['email'] and query_params.get('export') == 'true':
+                return export_history(email_from_token)
+            elif 'email' in query_params and email_from_token == query_params['email'] and 'timestamp' in query_params:
+                return get_history_item(email_from_token, query_params['timestamp'])
+            elif 'email' in query_params and email_from_token == query_params['email'] and query_params.get('view') == 'summary':
+                return get_history_summary(email_from_token, last_key_email, last_key_timestamp, limit)
+            elif 'email' in query_params and email_from_token == query_params['email']:
                 return get_history_by_createdBy(query_params['email'], last_key_email, last_key_timestamp, limit)
             else:
                 # If not, return an error
@@ -34,6 +57,9 @@ def handler(event, context):
             eventBody = json.loads(event['body'])
             # Make sure the user requesting is the same user authenticated (security check)
             if 'email' in eventBody and email_from_token == eventBody['email']:
+                # Bulk deletes: the whole history, a timestamp range or a list of timestamps
+                if eventBody.get('all') or 'from' in eventBody or 'to' in eventBody or 'timestamps' in eventBody:
+                    return delete_history_bulk(eventBody, email_from_token)
                 return delete_history(event, email_from_token)
             else:
                 # If not, return an error
@@ -82,6 +108,9 @@ def get_history_by_createdBy(email, last_key_email=None, last_key_timestamp=None
 
         # Query the DynamoDB table with arguments of user
         response = table.query(**query_kwargs)
+        # Compressed bodies are decoded, offloaded ones are left to the detail view
+        for item in response['Items']:
+            hydrate_bodies(item, fetch=False)
 
         return {
             'statusCode': 200,
@@ -93,7 +122,7 @@ def get_history_by_createdBy(email, last_key_email=None, last_key_timestamp=None
             'body': json.dumps({
                 'items': response['Items'],
                 'last_evaluated_key': response.get('LastEvaluatedKey')  # Can be used for subsequent queries
-            })
+            }, default=json_default)
         }
     except ClientError as e:
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
@@ -104,9 +133,8 @@ def delete_history(event, email_from_token):
     """
     Deletes a user's history item from the DynamoDB table.
 
-    This function first retrieves the item from the table to check if the requesting user is the owner of the item.
-    If the item exists and the requesting user is the owner, the function deletes the item from the table.
-    If the item does not exist or the requesting user is not the owner, the function returns a 403 Forbidden response.
+    The item is deleted with a single conditional write: the condition checks that the item exists and that the requesting user is its owner.
+    If the item does not exist or the requesting user is not the owner, the condition fails and the function returns a 403 Forbidden response.
     If an exception occurs during the operation, the function returns a 500 Internal Server Error response.
 
     Args:
@@ -122,16 +150,17 @@ def delete_history(event, email_from_token):
     timestamp = body.get('timestamp')
     
     try:
-        # Retrieve the item to check ownership and existence
-        response = table.get_item(Key={'email': email, 'timestamp': timestamp})
-        item = response.get('Item', {})
-
-        # Check if the item exists and if the requesting user is the owner
-        if not item or item.get('email') != email_from_token:
-            return {'statusCode': 403, 'body': json.dumps({'error': 'Access denied'})}
-
-        # Delete the item
-        table.delete_item(Key={'email': email, 'timestamp': timestamp})
+        # Delete the item only if it exists and the requesting user is the owner
+        response = table.delete_item(
+            Key={'email': email, 'timestamp': timestamp},
+            ConditionExpression='attribute_exists(email) AND email = :owner',
+            ExpressionAttributeValues={':owner': email_from_token},
+            ReturnValues='ALL_OLD'
+        )
+        # Remove the offloaded prompt and completion with the item
+        body_key = response.get('Attributes', {}).get('bodyS3Key')
+        if body_key and BODY_BUCKET:
+            get_client('s3').delete_object(Bucket=BODY_BUCKET, Key=body_key)
         return {
             'statusCode': 200, 
             'headers': {
@@ -141,5 +170,286 @@ def delete_history(event, email_from_token):
             },
             'body': json.dumps({'message': 'History deleted successfully'})}
     except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return {'statusCode': 403, 'body': json.dumps({'error': 'Access denied'})}
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
+
+
+# Function to get a page of history summaries by email
+def get_history_summary(email, last_key_email=None, last_key_timestamp=None, limit=10):
+    """
+    Retrieves a page of lean history rows for the list view.
+
+    The query runs on the 'email-timestamp-summary-index' global secondary index, which only projects the request ID, the model,
+    the image keys and the truncated 'promptPreview' and 'completionPreview' attributes, so a page reads and returns a fraction
+    of the full items. Items written before the previews existed are completed with previews computed from one BatchGetItem
+    of their prompt and completion. The full item is fetched with `get_history_item`.
+
+    Args:
+        email (str): The email address of the user whose history should be retrieved.
+        last_key_email (str, optional): The email address of the last evaluated key, used for pagination.
+        last_key_timestamp (str, optional): The timestamp of the last evaluated key, used for pagination.
+        limit (int, optional): The maximum number of history items to retrieve, defaults to 10.
+
+    Returns:
+        dict: A response object with the summary 'items' and the 'last_evaluated_key' for pagination.
+    """
+    try:
+        query_kwargs = {
+            'IndexName': SUMMARY_INDEX,
+            'KeyConditionExpression': boto3.dynamodb.conditions.Key('email').eq(email),
+            'Limit': limit
+        }
+        if last_key_email and last_key_timestamp:
+            query_kwargs['ExclusiveStartKey'] = {'email': last_key_email, 'timestamp': last_key_timestamp}
+        response = table.query(**query_kwargs)
+        items = response['Items']
+
+        legacy = [item for item in items if 'promptPreview' not in item]
+        if legacy:
+            keys = [{'email': item['email'], 'timestamp': item['timestamp']} for item in legacy]
+            bodies = {item['timestamp']: item for item in batch_get(table, keys, ['timestamp', 'promptData', 'completion'])}
+            for item in legacy:
+                body = bodies.get(item['timestamp'], {})
+                item.update(summary_fields(body.get('promptData', ''), body.get('completion', '')))
+
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*', 
+                'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken'
+            },
+            'body': json.dumps({
+                'items': items,
+                'last_evaluated_key': response.get('LastEvaluatedKey')
+            }, default=json_default)
+        }
+    except ClientError as e:
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+
+# Function to get one history item
+def get_history_item(email, timestamp):
+    """
+    Retrieves one full history item, for the detail view of a row listed with `get_history_summary`.
+
+    This is the only read that fetches prompts and completions offloaded to S3 by large requests.
+
+    Args:
+        email (str): The email address of the user, the partition of the item, so only the user's own items can be read.
+        timestamp (str): The timestamp of the item.
+
+    Returns:
+        dict: A response object with the item, or a 404 response if it does not exist.
+    """
+    try:
+        item = table.get_item(Key={'email': email, 'timestamp': timestamp}).get('Item')
+        if not item:
+            return {'statusCode': 404, 'body': json.dumps({'error': 'History item not found'})}
+        # Read the prompt and completion back from S3 if they were offloaded
+        hydrate_bodies(item, get_client('s3') if 'bodyS3Key' in item else None, BODY_BUCKET)
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*', 
+                'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken'
+            },
+            'body': json.dumps(item, default=json_default)
+        }
+    except ClientError as e:
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+
+def iter_history(email, attributes):
+    """
+    Yields every history item of a user, newest first, following the query pages.
+
+    Only `attributes` are read, and a single page (at most 1 MB) is held in memory at a time.
+    """
+    query_kwargs = {
+        'KeyConditionExpression': boto3.dynamodb.conditions.Key('email').eq(email),
+        'ProjectionExpression': ', '.join(f'#a{i}' for i in range(len(attributes))),
+        'ExpressionAttributeNames': {f'#a{i}': name for i, name in enumerate(attributes)},
+        'ScanIndexForward': False
+    }
+    while True:
+        response = table.query(**query_kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Function to export the whole history of a user
+def export_history(email_from_token):
+    """
+    Exports the whole history of a user as a gzip-compressed NDJSON file and returns a download URL.
+
+    The user's partition is read page by page with only the exported attributes projected, and every item is written as one
+    JSON line to a gzip stream uploaded to S3 as a multipart upload. Memory use is bounded by one query page and one upload
+    part, whatever the size of the history. The response carries a pre-signed GET URL for the export.
+
+    Args:
+        email_from_token (str): The email of the user making the request, extracted from the authorization token.
+
+    Returns:
+        dict: A response object with the 'downloadUrl' of the export, its number of 'items' and its compressed size in 'bytes'.
+    """
+    s3_client = get_client('s3')
+    key = f'history-exports/{uuid.uuid4()}.ndjson.gz'
+    try:
+        with MultipartGzipWriter(s3_client, EXPORT_BUCKET, key) as writer:
+            items = (hydrate_bodies(item, s3_client, BODY_BUCKET) for item in iter_history(email_from_token, EXPORT_ATTRIBUTES))
+            count = write_ndjson(items, writer)
+        print(f"Exported {count} history items for {email_from_token}: {writer.uncompressed_bytes} bytes, {writer.compressed_bytes} compressed, {len(writer.parts)} parts")
+
+        download_url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': EXPORT_BUCKET, 'Key': key, 'ResponseContentDisposition': 'attachment; filename="history.ndjson.gz"'},
+            ExpiresIn=EXPORT_URL_EXPIRES
+        )
+        # Include the region in the URL if not already present
+        region = os.environ.get('AWS_REGION')
+        if region and "s3.amazonaws.com" in download_url:
+            download_url = download_url.replace("s3.amazonaws.com", f"s3.{region}.amazonaws.com")
+
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*', 
+                'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken'
+            },
+            'body': json.dumps({
+                'downloadUrl': download_url,
+                'expiresIn': EXPORT_URL_EXPIRES,
+                'items': count,
+                'bytes': writer.compressed_bytes
+            })
+        }
+    except ClientError as e:
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+
+def range_end(end):
+    """
+    Returns the highest timestamp string selected by an inclusive `end` bound.
+
+    Items stored in the same second as another request get a '.1', '.2'... suffix, which sorts after the bare second:
+    '.\uffff' sorts after every suffix, so the whole second of `end` is selected.
+    """
+    return f'{end}.\uffff'
+
+
+def history_keys(email, start=None, end=None):
+    """Yields the keys of the user's history items, optionally limited to timestamps between `start` and `end` (inclusive)."""
+    key_condition = boto3.dynamodb.conditions.Key('email').eq(email)
+    if start is not None and end is not None:
+        key_condition &= boto3.dynamodb.conditions.Key('timestamp').between(str(start), range_end(end))
+    elif start is not None:
+        key_condition &= boto3.dynamodb.conditions.Key('timestamp').gte(str(start))
+    elif end is not None:
+        key_condition &= boto3.dynamodb.conditions.Key('timestamp').lte(range_end(end))
+
+    query_kwargs = {
+        'KeyConditionExpression': key_condition,
+        'ProjectionExpression': 'email, #ts',
+        'ExpressionAttributeNames': {'#ts': 'timestamp'}
+    }
+    while True:
+        response = table.query(**query_kwargs)
+        for item in response['Items']:
+            yield {'email': item['email'], 'timestamp': item['timestamp']}
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def delete_offloaded_bodies(email, selection, kept):
+    """
+    Deletes the S3 objects of the offloaded bodies of the history items removed by a bulk delete.
+
+    Object keys start with the item timestamp, so the user's prefix is listed and filtered with the same selection
+    as the items; only items with offloaded bodies have an object, so the listing stays short.
+
+    Args:
+        email (str): The email of the user.
+        selection (dict): The bulk delete request body ('all', 'from'/'to' or 'timestamps').
+        kept (set): Timestamps of items that could not be deleted, whose bodies are kept.
+    """
+    s3_client = get_client('s3')
+    prefix = body_prefix(email)
+    timestamps = {str(ts) for ts in selection['timestamps']} if 'timestamps' in selection else None
+    start, end = selection.get('from'), selection.get('to')
+
+    def selected(timestamp):
+        if timestamp in kept:
+            return False
+        if timestamps is not None:
+            return timestamp in timestamps
+        return (start is None or timestamp >= str(start)) and (end is None or timestamp <= range_end(end))
+
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=BODY_BUCKET, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []) if selected(body_key_timestamp(obj['Key'], prefix)))
+    # DeleteObjects accepts up to 1000 keys per request
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(Bucket=BODY_BUCKET, Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+
+
+# Function to delete many history items of a user at once
+def delete_history_bulk(body, email_from_token):
+    """
+    Deletes many of a user's history items with batched writes.
+
+    The body selects the items to delete with one of:
+    - 'all': true, to delete the whole history of the user
+    - 'from' and/or 'to', epoch timestamps (in seconds) delimiting the range of items to delete, inclusive
+    - 'timestamps', a list of the timestamps of the items to delete
+
+    Keys are read page by page from the user's partition (or built from the given timestamps) and deleted in
+    BatchWriteItem batches of 25, several in parallel, with the unprocessed items retried. Every key is in the
+    partition of the requesting user, so no item of another user can be deleted; deleting a missing key has no effect.
+
+    Args:
+        body (dict): The request body, with the 'email' of the user and the selection described above.
+        email_from_token (str): The email of the user making the request, extracted from the authorization token.
+
+    Returns:
+        dict: A response object with the number of deleted items and the timestamps that could not be deleted.
+    """
+    if 'timestamps' in body:
+        timestamps = body['timestamps']
+        if not isinstance(timestamps, list) or len(timestamps) > BULK_MAX_ITEMS:
+            return {'statusCode': 400, 'body': json.dumps({'error': f'timestamps must be a list of at most {BULK_MAX_ITEMS} items'})}
+        # BatchWriteItem rejects duplicate keys in a batch
+        keys = ({'email': email_from_token, 'timestamp': str(ts)} for ts in dict.fromkeys(timestamps))
+    else:
+        keys = history_keys(email_from_token, body.get('from'), body.get('to'))
+
+    try:
+        result = batch_write(
+            table,
+            ({'DeleteRequest': {'Key': key}} for key in keys),
+            progress=log_progress(f'Bulk history delete for {email_from_token}')
+        )
+        failed = {request['DeleteRequest']['Key']['timestamp'] for request in result['unprocessed']}
+        if BODY_BUCKET:
+            delete_offloaded_bodies(email_from_token, body, failed)
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*', 
+                'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken'
+            },
+            'body': json.dumps({
+                'message': 'History deleted successfully' if not result['failed'] else 'History partially deleted',
+                'deleted': result['written'],
+                'failed': sorted(failed)
+            })}
+    except ClientError as e:
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
@@ -0,0 +1,96 @@
+import gzip
+import io
+import json
+import os
+from decimal import Decimal
+
+# Size of the multipart upload parts, S3 requires at least 5 MiB for every part but the last
+EXPORT_PART_BYTES = max(int(os.environ.get('HISTORY_EXPORT_PART_BYTES', 8 * 1024 * 1024)), 5 * 1024 * 1024)
+
+
+def json_default(value):
+    """Serializes the Decimal numbers returned by DynamoDB."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class MultipartGzipWriter:
+    """
+    File-like object compressing what is written to it with gzip and uploading it to S3 as a multipart upload.
+
+    Compressed bytes are buffered until a part is full, then uploaded, so memory stays bounded by the part
+    size whatever the size of the export. The upload is completed by `close()` and aborted if the writer is
+    left through an exception.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The destination bucket.
+        key (str): The destination object key.
+        content_type (str, optional): The Content-Type of the object.
+        part_bytes (int, optional): The size of the uploaded parts.
+    """
+
+    def __init__(self, s3, bucket, key, content_type='application/gzip', part_bytes=EXPORT_PART_BYTES):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)['UploadId']
+        self.parts = []
+        self.buffer = io.BytesIO()
+        self.gzip = gzip.GzipFile(fileobj=self.buffer, mode='wb')
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+
+    def write(self, data):
+        self.gzip.write(data)
+        self.uncompressed_bytes += len(data)
+        if self.buffer.tell() >= self.part_bytes:
+            self._upload_part()
+
+    def _upload_part(self):
+        body = self.buffer.getvalue()
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=len(self.parts) + 1, Body=body
+        )
+        self.parts.append({'PartNumber': len(self.parts) + 1, 'ETag': response['ETag']})
+        self.compressed_bytes += len(body)
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        """Flushes the gzip trailer, uploads the last part and completes the upload."""
+        self.gzip.close()
+        # The last part may be smaller than the minimum size, and an empty export still needs one part
+        if self.buffer.tell() or not self.parts:
+            self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        """Aborts the upload; a failure is logged, the bucket lifecycle rule removes the parts after a day."""
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Could not abort the upload of {self.key}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def write_ndjson(items, writer):
+    """Writes every item as one JSON line. Returns the number of items written."""
+    count = 0
+    for item in items:
+        writer.write(json.dumps(item, default=json_default).encode('utf-8') + b'\n')
+        count += 1
+    return count
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+# Time a cached listing is served before it is read again from DynamoDB
+CACHE_TTL_SECONDS = float(os.environ.get('TEMPLATES_CACHE_TTL_SECONDS', 60))
+# Interval between two reads of the version marker, the staleness window after a write in another container
+VERSION_CHECK_SECONDS = float(os.environ.get('TEMPLATES_CACHE_VERSION_CHECK_SECONDS', 5))
+# Number of listings (query and page) kept per container
+CACHE_MAX_ENTRIES = int(os.environ.get('TEMPLATES_CACHE_MAX_ENTRIES', 64))
+
+# Key of the item holding the listings version in the templates table. It has no 'createdBy',
+# 'visibility' or 'dateCreated', so it never shows up in the listing indexes.
+VERSION_MARKER_ID = '__listing_version__'
+
+def etag_for(body):
+    """Returns a strong ETag for a serialized response body."""
+    return '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match, etag):
+    """Checks an `If-None-Match` header value (a list of ETags, weak or not, or `*`) against `etag`."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+class ListingCache:
+    """
+    Per-container LRU cache of serialized template listings, with a TTL and cross-container invalidation.
+
+    Entries hold the JSON body exactly as returned to the client and its ETag, so a hit costs no
+    DynamoDB read and no serialization. Every write to the templates table bumps a version number
+    stored in a marker item; each container reads the marker at most every `version_check_seconds`
+    and drops its entries when the version moved, which bounds how long another container can serve
+    a listing that predates a write. Entries also expire after `ttl_seconds` in any case.
+
+    Args:
+        table: The boto3 DynamoDB Table resource of the templates.
+        max_entries (int, optional): Maximum number of cached listings.
+        ttl_seconds (float, optional): Maximum age of a cached listing.
+        version_check_seconds (float, optional): Minimum interval between two reads of the version marker.
+        clock (callable, optional): Monotonic clock, replaceable in benchmarks.
+    """
+
+    def __init__(self, table, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS,
+                 version_check_seconds=VERSION_CHECK_SECONDS, clock=time.monotonic):
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_check_seconds = version_check_seconds
+        self.clock = clock
+
+        self.entries = OrderedDict()
+        self.version = None
+        self.version_checked_at = None
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+        self.version_reads = 0
+
+    def _read_version(self):
+        response = self.table.get_item(Key={'templateId': VERSION_MARKER_ID}, ProjectionExpression='listingVersion')
+        self.version_reads += 1
+        return int(response.get('Item', {}).get('listingVersion', 0))
+
+    def _invalidate(self):
+        if self.entries:
+            self.invalidations += 1
+        self.entries.clear()
+
+    def _check_version(self):
+        now = self.clock()
+        if self.version_checked_at is not None and now - self.version_checked_at < self.version_check_seconds:
+            return
+        try:
+            version = self._read_version()
+        except Exception as e:
+            # Without the marker the TTL still bounds staleness
+            print(f"Could not read the templates listing version: {e}")
+            return
+        if version != self.version:
+            self._invalidate()
+            self.version = version
+        self.version_checked_at = now
+
+    def get(self, key):
+        """Returns the cached `(body, etag)` of a listing, or None on a miss."""
+        self._check_version()
+        entry = self.entries.get(key)
+        if entry is None or self.clock() - entry[2] > self.ttl_seconds:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def current_version(self):
+        """Returns the listings version, reading the version marker at most every `version_check_seconds`."""
+        self._check_version()
+        return self.version
+
+    def put(self, key, body):
+        """Caches a serialized listing and returns its ETag."""
+        etag = etag_for(body)
+        self.entries[key] = (body, etag, self.clock())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return etag
+
+    def bump_version(self):
+        """
+        Invalidates the listings in this container and, through the version marker, in every other one.
+
+        Returns:
+            int: The new listings version, or None when the version marker could not be updated.
+        """
+        self._invalidate()
+        try:
+            response = self.table.update_item(
+                Key={'templateId': VERSION_MARKER_ID},
+                UpdateExpression='ADD listingVersion :one',
+                ExpressionAttributeValues={':one': 1},
+                ReturnValues='UPDATED_NEW'
+            )
+            self.version = int(response['Attributes']['listingVersion'])
+            self.version_checked_at = self.clock()
+            return self.version
+        except Exception as e:
+            # Other containers will pick up the write when their entries expire
+            print(f"Could not bump the templates listing version: {e}")
+            return None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'notModified': self.not_modified,
+            'invalidations': self.invalidations,
+            'versionReads': self.version_reads,
+            'entries': len(self.entries)
+        }
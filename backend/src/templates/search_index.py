@@ -0,0 +1,360 @@
+import gzip
+import heapq
+import json
+import math
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+
+# Weight of a term occurrence per indexed attribute, a match in the name ranks above one in the description
+FIELD_WEIGHTS = {'templateName': 4, 'tags': 3, 'templateDescription': 1}
+# Attributes read from the table to build the index
+INDEXED_ATTRIBUTES = ['templateId', 'createdBy', 'visibility', 'templateName', 'templateDescription', 'tags']
+
+# A posting packs the document number and the term weight in one unsigned 32-bit integer
+WEIGHT_BITS = 4
+MAX_WEIGHT = (1 << WEIGHT_BITS) - 1
+# Terms a prefix expands to, the most frequent ones are kept
+MAX_PREFIX_TERMS = int(os.environ.get('TEMPLATES_SEARCH_MAX_PREFIX_TERMS', 64))
+# A prefix match scores below the exact term
+PREFIX_PENALTY = 0.7
+# Share of deleted documents above which the postings are rewritten without them
+COMPACT_RATIO = 0.2
+
+# Format 2 keeps deleted documents as null IDs instead of compacting before every save
+SNAPSHOT_FORMAT = 2
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Splits a text into lowercase word tokens."""
+    return TOKEN_PATTERN.findall(text.casefold()) if isinstance(text, str) else []
+
+
+def template_terms(template):
+    """Returns the weight of every term of a template, summed over its indexed attributes and capped at MAX_WEIGHT."""
+    weights = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        value = template.get(field)
+        for text in value if isinstance(value, (list, set, tuple)) else [value]:
+            for token in tokenize(text):
+                weights[token] = min(MAX_WEIGHT, weights.get(token, 0) + weight)
+    return weights
+
+
+class TemplateSearchIndex:
+    """
+    Compact in-memory inverted index of the template names, descriptions and tags.
+
+    Every template gets a document number; the postings of a term are an `array('I')` of document
+    numbers shifted left by WEIGHT_BITS, with the weight of the term in the template in the low bits.
+    The vocabulary is also kept sorted, so a prefix maps to a contiguous range of terms found with a
+    binary search. Removing a template only marks its document as deleted, and the postings are
+    rewritten once deleted documents pass COMPACT_RATIO of the total. Snapshots keep the deleted
+    documents as they are, so saving never compacts.
+
+    Only the owner and visibility of each template are kept besides the postings: a search returns
+    template IDs, and the templates themselves are read from the table.
+
+    Args:
+        version (int, optional): The templates listing version the index reflects.
+    """
+
+    def __init__(self, version=None):
+        self.version = version
+        self.ids = []         # document number -> templateId, None once deleted
+        self.owners = []      # document number -> createdBy
+        self.public = bytearray()
+        self.documents = {}   # templateId -> document number
+        self.postings = {}
+        self.terms = []
+        self.deleted = 0
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, template):
+        """Indexes a template, replacing its previous version."""
+        template_id = template['templateId']
+        self.remove(template_id)
+        document = len(self.ids)
+        self.ids.append(template_id)
+        self.owners.append(template.get('createdBy') or '')
+        self.public.append(template.get('visibility') == 'public')
+        self.documents[template_id] = document
+        for term, weight in template_terms(template).items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array('I')
+                insort(self.terms, term)
+            postings.append(document << WEIGHT_BITS | weight)
+
+    def remove(self, template_id):
+        """Removes a template from the results, returns False if it was not indexed."""
+        document = self.documents.pop(template_id, None)
+        if document is None:
+            return False
+        self.ids[document] = None
+        self.deleted += 1
+        if self.deleted > COMPACT_RATIO * len(self.ids):
+            self.compact()
+        return True
+
+    def compact(self):
+        """Renumbers the documents without the deleted ones and drops the terms left without postings."""
+        renumbered = array('I', [0]) * len(self.ids)
+        ids, owners, public = [], [], bytearray()
+        for document, template_id in enumerate(self.ids):
+            if template_id is not None:
+                renumbered[document] = len(ids)
+                ids.append(template_id)
+                owners.append(self.owners[document])
+                public.append(self.public[document])
+        postings = {}
+        for term in self.terms:
+            kept = array('I', (
+                renumbered[posting >> WEIGHT_BITS] << WEIGHT_BITS | posting & MAX_WEIGHT
+                for posting in self.postings[term] if self.ids[posting >> WEIGHT_BITS] is not None
+            ))
+            if kept:
+                postings[term] = kept
+        self.ids, self.owners, self.public = ids, owners, public
+        self.documents = {template_id: document for document, template_id in enumerate(ids)}
+        self.postings = postings
+        self.terms = list(postings)
+        self.deleted = 0
+
+    def _expand(self, token, prefix):
+        if not prefix:
+            return [token] if token in self.postings else []
+        terms = []
+        for position in range(bisect_left(self.terms, token), len(self.terms)):
+            term = self.terms[position]
+            if not term.startswith(token):
+                break
+            terms.append(term)
+        if len(terms) > MAX_PREFIX_TERMS:
+            terms = heapq.nlargest(MAX_PREFIX_TERMS, terms, key=lambda term: len(self.postings[term]))
+        return terms
+
+    def search(self, query, user, limit=20, offset=0):
+        """
+        Ranks the templates visible to `user` (public or created by them) matching every token of `query`.
+
+        The last token is also matched as a prefix, so results follow the query while it is typed. A
+        template scores, for each token, the best weight of its matching terms times their inverse
+        document frequency.
+
+        Args:
+            query (str): The search text.
+            user (str): The email address of the user searching.
+            limit (int, optional): The number of results to return.
+            offset (int, optional): The number of results to skip.
+
+        Returns:
+            tuple: The total number of matching templates, and the `(templateId, score)` pairs of the page, best first.
+        """
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return 0, []
+        documents = max(len(self.documents), 1)
+        scores = None
+        for position, token in enumerate(tokens):
+            matches = {}
+            for term in self._expand(token, prefix=position == len(tokens) - 1):
+                postings = self.postings[term]
+                idf = math.log(1 + documents / len(postings)) * (1 if term == token else PREFIX_PENALTY)
+                for posting in postings:
+                    document = posting >> WEIGHT_BITS
+                    score = idf * (posting & MAX_WEIGHT)
+                    if score > matches.get(document, 0):
+                        matches[document] = score
+            if scores is None:
+                scores = matches
+            else:
+                scores = {document: score + matches[document] for document, score in scores.items() if document in matches}
+            if not scores:
+                return 0, []
+
+        visible = [
+            (score, document) for document, score in scores.items()
+            if self.ids[document] is not None and (self.public[document] or self.owners[document] == user)
+        ]
+        page = heapq.nlargest(offset + limit, visible)[offset:]
+        return len(visible), [(self.ids[document], round(score, 3)) for score, document in page]
+
+    def dumps(self):
+        """
+        Serializes the index to a gzip snapshot: a JSON header line followed by the raw postings.
+
+        The postings are written as they are laid out in memory, so loading a snapshot costs no tokenizing.
+        Deleted documents are written as null IDs and their postings are kept, like in memory.
+        """
+        header = {
+            'format': SNAPSHOT_FORMAT,
+            'byteorder': sys.byteorder,
+            'version': self.version,
+            'ids': self.ids,
+            'owners': self.owners,
+            'public': self.public.hex(),
+            'terms': [[term, len(self.postings[term])] for term in self.terms]
+        }
+        parts = [json.dumps(header, separators=(',', ':')).encode('utf-8'), b'\n']
+        parts.extend(self.postings[term].tobytes() for term in self.terms)
+        return gzip.compress(b''.join(parts), compresslevel=1)
+
+    @classmethod
+    def loads(cls, data):
+        """Loads a snapshot written by `dumps`, returns None if its format is not supported."""
+        data = gzip.decompress(data)
+        end = data.index(b'\n')
+        header = json.loads(data[:end])
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('byteorder') != sys.byteorder:
+            return None
+        index = cls(header['version'])
+        index.ids = header['ids']
+        index.owners = header['owners']
+        index.public = bytearray.fromhex(header['public'])
+        index.documents = {template_id: document for document, template_id in enumerate(index.ids) if template_id is not None}
+        index.deleted = len(index.ids) - len(index.documents)
+        view = memoryview(data)[end + 1:]
+        itemsize = array('I').itemsize
+        offset = 0
+        for term, count in header['terms']:
+            postings = array('I')
+            postings.frombytes(view[offset:offset + count * itemsize])
+            index.postings[term] = postings
+            offset += count * itemsize
+        index.terms = [term for term, _ in header['terms']]
+        return index
+
+
+def load_snapshot(version, path, s3_client=None, bucket=None, key=None):
+    """
+    Loads the newest index snapshot not after `version`, from the local file first, then from S3.
+
+    A snapshot of a later version is ignored, and the local one is replaced when S3 has a newer one. A snapshot
+    behind `version` is returned as is: the caller brings it up to date with the deltas of the writes made since
+    it was saved (see `load_deltas`), so an index is never served behind the writes.
+
+    Args:
+        version (int): The current templates listing version.
+        path (str): The local snapshot file, kept in /tmp across warm invocations.
+        s3_client: An S3 boto3 client, None to only use the local file.
+        bucket (str, optional): The bucket holding the shared snapshot.
+        key (str, optional): The object key of the shared snapshot.
+
+    Returns:
+        TemplateSearchIndex: The index, or None if no snapshot up to `version` was found.
+    """
+    usable = lambda index: index is not None and index.version is not None and version is not None and index.version <= version
+    local = None
+    try:
+        with open(path, 'rb') as file:
+            local = TemplateSearchIndex.loads(file.read())
+        if usable(local) and local.version == version:
+            return local
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Could not load the local templates search snapshot: {e}")
+    local = local if usable(local) else None
+
+    if not s3_client or not bucket:
+        return local
+    try:
+        data = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        index = TemplateSearchIndex.loads(data)
+    except s3_client.exceptions.NoSuchKey:
+        return local
+    except Exception as e:
+        print(f"Could not load the templates search snapshot from S3: {e}")
+        return local
+    if not usable(index) or (local is not None and local.version >= index.version):
+        return local
+    write_local_snapshot(path, data)
+    return index
+
+
+def write_local_snapshot(path, data):
+    """Replaces the local snapshot atomically, so a concurrent reader never sees a partial file."""
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+def save_snapshot(index, path, s3_client=None, bucket=None, key=None):
+    """Saves the index to the local file and, when a bucket is configured, to S3 for the other containers."""
+    data = index.dumps()
+    try:
+        write_local_snapshot(path, data)
+    except OSError as e:
+        print(f"Could not write the local templates search snapshot: {e}")
+    if s3_client and bucket:
+        try:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=data, ContentType='application/octet-stream')
+        except Exception as e:
+            print(f"Could not upload the templates search snapshot: {e}")
+    return len(data)
+
+
+def delta_key(prefix, version):
+    """Object key of the delta of a templates listing version."""
+    return f'{prefix}{version:012d}.json'
+
+
+def save_delta(s3_client, bucket, prefix, version, added=(), removed=()):
+    """
+    Stores the templates written at `version`, so other containers can apply them to an older snapshot.
+
+    Only the indexed attributes of the added templates are kept. Returns False when the upload failed: the
+    containers that need this version then rebuild their index from a table scan.
+    """
+    delta = {
+        'version': version,
+        'added': [{name: template[name] for name in INDEXED_ATTRIBUTES if name in template} for template in added],
+        'removed': list(removed)
+    }
+    try:
+        s3_client.put_object(Bucket=bucket, Key=delta_key(prefix, version), Body=json.dumps(delta).encode('utf-8'),
+                             ContentType='application/json')
+        return True
+    except Exception as e:
+        print(f"Could not upload the templates search delta of version {version}: {e}")
+        return False
+
+
+def load_deltas(s3_client, bucket, prefix, first, last, workers=8):
+    """
+    Reads the deltas of versions `first` to `last`, in order, fetched concurrently.
+
+    Returns:
+        list: The deltas, or None if one of them is missing (a write whose delta could not be stored, or expired).
+    """
+    def fetch(version):
+        try:
+            return json.loads(s3_client.get_object(Bucket=bucket, Key=delta_key(prefix, version))['Body'].read())
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        except Exception as e:
+            print(f"Could not load the templates search delta of version {version}: {e}")
+            return None
+
+    versions = range(first, last + 1)
+    if not versions:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(versions))) as executor:
+        deltas = list(executor.map(fetch, versions))
+    return None if any(delta is None for delta in deltas) else deltas
+
+
+def apply_delta(index, delta):
+    """Applies the writes of a delta to the index, in the order they were made."""
+    for template_id in delta['removed']:
+        index.remove(template_id)
+    for template in delta['added']:
+        index.add(template)
@@ -3,12 +3,53 @@ import json
 import time
 import os
 from botocore.exceptions import ClientError
+from listing_cache import ListingCache, etag_for, etag_matches, VERSION_MARKER_ID
+from search_index import INDEXED_ATTRIBUTES, TemplateSearchIndex, apply_delta, load_deltas, load_snapshot, save_delta, save_snapshot
+from assistant_common.batch import batch_get, batch_write, log_progress
+from assistant_common.clients import get_client
 
 # Import DynamoDB SDK from boto3
 dynamodb = boto3.resource('dynamodb')
 # Set the table name from the environment variable on Lambda
 table = dynamodb.Table(os.environ.get('TEMPLATES_TABLE'))
 
+# Global secondary indexes used to list templates, both sorted by 'dateCreated'
+CREATED_BY_INDEX = 'createdBy-dateCreated-index'
+VISIBILITY_INDEX = 'visibility-dateCreated-index'
+
+# Template attributes a PUT request may change
+UPDATABLE_FIELDS = ['createdBy', 'templateName', 'templateDescription', 'modelversion', 'templatePrompt', 'visibility', 'templateGuidance', 'systemPrompt', 'tags']
+
+# Maximum number of templates accepted by a bulk import or delete request
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+
+# Listings served from the per-container cache, the public templates are read by every user
+CACHED_VISIBILITIES = {'public'}
+listing_cache = ListingCache(table)
+
+# Search index snapshot, kept in /tmp for warm invocations and in S3 for the cold starts of other containers
+SEARCH_INDEX_PATH = os.environ.get('TEMPLATES_INDEX_PATH', '/tmp/templates-search-index.bin.gz')
+SEARCH_INDEX_BUCKET = os.environ.get('TEMPLATES_INDEX_BUCKET')
+SEARCH_INDEX_KEY = os.environ.get('TEMPLATES_INDEX_KEY', 'templates-search-index/index.bin.gz')
+# Minimum time between two snapshot saves after writes; the writes in between are stored as deltas
+SEARCH_INDEX_SAVE_SECONDS = float(os.environ.get('TEMPLATES_INDEX_SAVE_SECONDS', 60))
+# Prefix of the per-version deltas a container applies to an older snapshot, and the most it applies before rescanning
+SEARCH_INDEX_DELTA_PREFIX = os.environ.get('TEMPLATES_INDEX_DELTA_PREFIX', 'templates-search-index/deltas/')
+SEARCH_INDEX_MAX_DELTAS = int(os.environ.get('TEMPLATES_INDEX_MAX_DELTAS', 200))
+# Maximum number of results in a search page
+SEARCH_MAX_LIMIT = 100
+# Built or loaded on the first search of the container
+search_index = None
+# Monotonic time of the last snapshot saved by this container
+search_index_saved_at = None
+
+def get_header(event, name):
+    """Returns a request header, API Gateway keeps the case used by the client."""
+    for header, value in (event.get('headers') or {}).items():
+        if header.lower() == name.lower():
+            return value
+    return None
+
 def handler(event, context):
     http_method = event['httpMethod']
     # Retries email from API GW requestContext
@@ -17,19 +58,30 @@ def handler(event, context):
     try:
         # Handel GET Method
         if http_method == 'GET':
-            query_params = event.get('queryStringParameters', {})
-            if 'createdBy' in query_params and email_from_token == query_params['createdBy']:
-                return get_templates_by_createdBy(query_params['createdBy'])
+            query_params = event.get('queryStringParameters') or {}
+            # Optional pagination, without 'limit' every page is returned as a single list
+            limit = query_params.get('limit')
+            last_key_template_id = query_params.get('last_key_templateId')
+            last_key_date_created = query_params.get('last_key_dateCreated')
+            if_none_match = get_header(event, 'If-None-Match')
+            if 'search' in query_params:
+                return search_templates(query_params['search'], email_from_token, limit, query_params.get('offset'))
+            elif 'createdBy' in query_params and email_from_token == query_params['createdBy'] and query_params.get('export') == 'true':
+                return export_templates(email_from_token)
+            elif 'createdBy' in query_params and email_from_token == query_params['createdBy']:
+                return get_templates_by_createdBy(query_params['createdBy'], limit, last_key_template_id, last_key_date_created, if_none_match)
             elif 'visibility' in query_params:
                 visibility = query_params['visibility']
-                return get_templates_by_visibility(visibility)
+                return get_templates_by_visibility(visibility, limit, last_key_template_id, last_key_date_created, if_none_match)
             else:
                 return {'statusCode': 400, 'body': json.dumps({'error': 'Invalid query parameters'})}
             
         # Handle POST Method
         elif http_method == 'POST':
             eventBody = json.loads(event['body'])
-            if 'createdBy' in eventBody and email_from_token == eventBody['createdBy']:
+            if 'createdBy' in eventBody and email_from_token == eventBody['createdBy'] and 'templates' in eventBody:
+                return import_templates(eventBody, email_from_token)
+            elif 'createdBy' in eventBody and email_from_token == eventBody['createdBy']:
                 return create_template(event)
             else:
                 return {'statusCode': 400, 'body': json.dumps({'error': 'Invalid body'})}
@@ -45,7 +97,9 @@ def handler(event, context):
         # Handle DELETE Method
         elif http_method == 'DELETE':
             eventBody = json.loads(event['body'])
-            if 'createdBy' in eventBody and email_from_token == eventBody['createdBy']:
+            if 'createdBy' in eventBody and email_from_token == eventBody['createdBy'] and 'templateIds' in eventBody:
+                return delete_templates(eventBody, email_from_token)
+            elif 'createdBy' in eventBody and email_from_token == eventBody['createdBy']:
                 return delete_template(event, email_from_token)
             else:
                 return {'statusCode': 400, 'body': json.dumps({'error': 'Invalid body'})}
@@ -62,74 +116,315 @@ def handler(event, context):
             'body': json.dumps({'error': str(e)})
         }
 
-def get_templates_by_createdBy(createdBy):
+def query_templates(index_name, attribute, value, limit=None, last_key_template_id=None, last_key_date_created=None):
+    """
+    Queries templates through one of the listing global secondary indexes, newest first.
+
+    When `limit` is given, a single page of at most `limit` items is read, starting after the
+    provided last evaluated key. Without `limit`, the query follows `LastEvaluatedKey` until every
+    matching template has been read, so results are never truncated at the 1 MB page size.
+
+    If the index does not exist yet (a table deployed before the indexes were added), the function
+    falls back to a paginated scan with a filter, so listings keep working during the migration.
+
+    Args:
+        index_name (str): The name of the global secondary index to query.
+        attribute (str): The partition key attribute of the index ('createdBy' or 'visibility').
+        value (str): The value of the partition key.
+        limit (int, optional): The maximum number of templates to return.
+        last_key_template_id (str, optional): The 'templateId' of the last evaluated key, used for pagination.
+        last_key_date_created (str, optional): The 'dateCreated' of the last evaluated key, used for pagination.
+
+    Returns:
+        tuple: The list of templates and the last evaluated key (None once all items were read).
+    """
+    query_kwargs = {
+        'IndexName': index_name,
+        'KeyConditionExpression': boto3.dynamodb.conditions.Key(attribute).eq(value),
+        'ScanIndexForward': False
+    }
+    if limit:
+        query_kwargs['Limit'] = int(limit)
+
+    # Check if both parts of the last evaluated key are provided and use them
+    if last_key_template_id and last_key_date_created:
+        query_kwargs['ExclusiveStartKey'] = {
+            'templateId': last_key_template_id,
+            'dateCreated': last_key_date_created,
+            attribute: value
+        }
+
+    items = []
+    try:
+        while True:
+            response = table.query(**query_kwargs)
+            items.extend(response['Items'])
+            last_evaluated_key = response.get('LastEvaluatedKey')
+            if limit or not last_evaluated_key:
+                return items, last_evaluated_key
+            query_kwargs['ExclusiveStartKey'] = last_evaluated_key
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ValidationException' or 'index' not in e.response['Error']['Message']:
+            raise
+        print(f"Index {index_name} is not available, falling back to a table scan.")
+        return scan_templates(attribute, value, limit, last_key_template_id)
+
+
+def scan_templates(attribute, value, limit=None, last_key_template_id=None):
+    """Scans the table for templates where `attribute` equals `value`, following every page unless `limit` is given."""
+    scan_kwargs = {
+        'FilterExpression': boto3.dynamodb.conditions.Attr(attribute).eq(value)
+    }
+    if limit:
+        scan_kwargs['Limit'] = int(limit)
+    if last_key_template_id:
+        scan_kwargs['ExclusiveStartKey'] = {'templateId': last_key_template_id}
+
+    items = []
+    while True:
+        response = table.scan(**scan_kwargs)
+        items.extend(response['Items'])
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if limit or not last_evaluated_key:
+            return items, last_evaluated_key
+        scan_kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+
+def serialize_templates(items, limit, last_evaluated_key):
+    """Serializes a listing: a plain list of templates, or a page with its last evaluated key when paginating."""
+    if limit:
+        return json.dumps({'items': items, 'last_evaluated_key': last_evaluated_key})
+    return json.dumps(items)
+
+def templates_response(body, etag, if_none_match=None):
+    """
+    Builds the response of a listing, with its ETag.
+
+    Clients sending a matching `If-None-Match` get a 304 without the body. Listings are marked
+    `no-cache`, so browsers keep them but revalidate them on every request.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Access-Control-Allow-Origin": "*",  # This allows any origin to access your API. 
+        "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken",
+        "Cache-Control": "private, no-cache",
+        "ETag": etag
+    }
+    if etag_matches(if_none_match, etag):
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    return {'statusCode': 200, 'headers': headers, 'body': body}
+
+def get_templates_by_createdBy(createdBy, limit=None, last_key_template_id=None, last_key_date_created=None, if_none_match=None):
     """
     Retrieves templates from a DynamoDB table based on the 'createdBy' attribute.
 
-    This function performs a DynamoDB scan operation to retrieve all templates where the 'createdBy' attribute matches the provided 'createdBy' parameter. 
+    This function queries the 'createdBy-dateCreated-index' global secondary index to retrieve the templates where the 'createdBy' attribute matches the provided 'createdBy' parameter, newest first.
     
     The function returns a response dictionary with the following structure:
     - 'statusCode': 200 if the operation is successful, 500 if an exception occurs
     - 'headers': A dictionary of HTTP headers, including CORS settings to allow cross-origin access
-    - 'body': A JSON-encoded string containing the list of template items retrieved from the DynamoDB table
+    - 'body': A JSON-encoded string containing the list of template items, or, when 'limit' is provided, an object with the 'items' of the page and the 'last_evaluated_key' for the next one
 
     Args:
         createdBy (str): The value of the 'createdBy' attribute to filter the templates by.
+        limit (int, optional): The maximum number of templates to return in one page.
+        last_key_template_id (str, optional): The 'templateId' of the last evaluated key, used for pagination.
+        last_key_date_created (str, optional): The 'dateCreated' of the last evaluated key, used for pagination.
+        if_none_match (str, optional): The 'If-None-Match' header of the request.
 
     Returns:
-        dict: A response dictionary containing the retrieved templates.
+        dict: A response dictionary containing the retrieved templates, or a 304 response if they did not change.
     """
 
     try:
-        scan_kwargs = {
-            'FilterExpression': boto3.dynamodb.conditions.Attr('createdBy').eq(createdBy)
-        }
-        
-        response = table.scan(**scan_kwargs)
-
-        return {
-            'statusCode': 200, 
-             "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",  # This allows any origin to access your API. 
-                "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken"
-                 },
-            'body': json.dumps(response['Items'])}
+        items, last_evaluated_key = query_templates(CREATED_BY_INDEX, 'createdBy', createdBy, limit, last_key_template_id, last_key_date_created)
+        body = serialize_templates(items, limit, last_evaluated_key)
+        return templates_response(body, etag_for(body), if_none_match)
     except ClientError as e:
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
-def get_templates_by_visibility(visibility):
+def get_templates_by_visibility(visibility, limit=None, last_key_template_id=None, last_key_date_created=None, if_none_match=None):
     """
     Retrieves templates from a DynamoDB table based on the 'visibility' attribute.
 
-    This function performs a DynamoDB scan operation to retrieve all templates where the 'visibility' attribute matches the provided 'visibility' parameter.
+    This function queries the 'visibility-dateCreated-index' global secondary index to retrieve the templates where the 'visibility' attribute matches the provided 'visibility' parameter, newest first.
+
+    Public listings are served from the per-container `listing_cache` when possible: a hit returns the cached body without reading DynamoDB, and a request whose 'If-None-Match' matches the cached ETag gets a 304. Cache hits and misses are logged after every public listing.
 
     The function returns a response dictionary with the following structure:
     - 'statusCode': 200 if the operation is successful, 500 if an exception occurs
     - 'headers': A dictionary of HTTP headers, including CORS settings to allow cross-origin access
-    - 'body': A JSON-encoded string containing the list of template items retrieved from the DynamoDB table
+    - 'body': A JSON-encoded string containing the list of template items, or, when 'limit' is provided, an object with the 'items' of the page and the 'last_evaluated_key' for the next one
 
     Args:
         visibility (str): The value of the 'visibility' attribute to filter the templates by.
+        limit (int, optional): The maximum number of templates to return in one page.
+        last_key_template_id (str, optional): The 'templateId' of the last evaluated key, used for pagination.
+        last_key_date_created (str, optional): The 'dateCreated' of the last evaluated key, used for pagination.
+        if_none_match (str, optional): The 'If-None-Match' header of the request.
 
     Returns:
-        dict: A response dictionary containing the retrieved templates.
+        dict: A response dictionary containing the retrieved templates, or a 304 response if they did not change.
     """
 
     try:
-        # Directly use the string values for filtering
-        scan_kwargs = {
-            'FilterExpression': boto3.dynamodb.conditions.Attr('visibility').eq(visibility)
-        }
+        if visibility not in CACHED_VISIBILITIES:
+            items, last_evaluated_key = query_templates(VISIBILITY_INDEX, 'visibility', visibility, limit, last_key_template_id, last_key_date_created)
+            body = serialize_templates(items, limit, last_evaluated_key)
+            return templates_response(body, etag_for(body), if_none_match)
+
+        cache_key = (visibility, limit, last_key_template_id, last_key_date_created)
+        cached = listing_cache.get(cache_key)
+        if cached:
+            body, etag = cached
+        else:
+            items, last_evaluated_key = query_templates(VISIBILITY_INDEX, 'visibility', visibility, limit, last_key_template_id, last_key_date_created)
+            body = serialize_templates(items, limit, last_evaluated_key)
+            etag = listing_cache.put(cache_key, body)
+
+        response = templates_response(body, etag, if_none_match)
+        if response['statusCode'] == 304:
+            listing_cache.not_modified += 1
+        print(f"Templates listing cache {'hit' if cached else 'miss'}: {json.dumps(listing_cache.stats())}")
+        return response
+    except ClientError as e:
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+
+def build_search_index(version):
+    """Builds the search index from a scan of the templates table, reading only the indexed attributes."""
+    index = TemplateSearchIndex(version)
+    scan_kwargs = {
+        'ProjectionExpression': ', '.join(f'#p{i}' for i in range(len(INDEXED_ATTRIBUTES))),
+        'ExpressionAttributeNames': {f'#p{i}': name for i, name in enumerate(INDEXED_ATTRIBUTES)}
+    }
+    while True:
         response = table.scan(**scan_kwargs)
-        return {
-            'statusCode': 200, 
-             "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",  # This allows any origin to access your API. 
-                "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken"
-                 },
-            'body': json.dumps(response['Items'])}
+        for item in response['Items']:
+            if item['templateId'] != VERSION_MARKER_ID:
+                index.add(item)
+        if 'LastEvaluatedKey' not in response:
+            return index
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def get_search_index():
+    """
+    Returns the search index of this container, at the current templates listing version.
+
+    The index is kept across warm invocations. When it is missing or behind the version marker (another container
+    wrote templates), the newest snapshot is loaded from /tmp or S3 and brought to the current version with the
+    deltas of the writes made since it was saved. Only when there is no snapshot, or a delta is missing, or more than
+    SEARCH_INDEX_MAX_DELTAS are needed, is the index rebuilt from a table scan, and its snapshot saved for the next
+    containers.
+
+    Returns:
+        TemplateSearchIndex: The search index.
+    """
+    global search_index
+    version = listing_cache.current_version()
+    if search_index is not None and search_index.version == version:
+        return search_index
+
+    started = time.perf_counter()
+    s3_client = get_client('s3') if SEARCH_INDEX_BUCKET else None
+    index = load_snapshot(version, SEARCH_INDEX_PATH, s3_client, SEARCH_INDEX_BUCKET, SEARCH_INDEX_KEY)
+    source = 'snapshot'
+    if index is not None and index.version != version:
+        missing = version - index.version
+        deltas = load_deltas(s3_client, SEARCH_INDEX_BUCKET, SEARCH_INDEX_DELTA_PREFIX, index.version + 1, version) \
+            if s3_client and missing <= SEARCH_INDEX_MAX_DELTAS else None
+        if deltas is None:
+            index = None
+        else:
+            for delta in deltas:
+                apply_delta(index, delta)
+            index.version = version
+            source = f'snapshot and {missing} deltas'
+    if index is None:
+        index = build_search_index(version)
+        save_search_index(index)
+        source = 'table scan'
+    print(f"Templates search index loaded from {source}: {len(index)} templates, version {version}, "
+          f"{(time.perf_counter() - started) * 1000:.0f} ms")
+    search_index = index
+    return index
+
+def save_search_index(index):
+    """Saves the snapshot of the index to /tmp and S3, and records when."""
+    global search_index_saved_at
+    s3_client = get_client('s3') if SEARCH_INDEX_BUCKET else None
+    save_snapshot(index, SEARCH_INDEX_PATH, s3_client, SEARCH_INDEX_BUCKET, SEARCH_INDEX_KEY)
+    search_index_saved_at = time.monotonic()
+
+def update_search_index(version, added=(), removed=()):
+    """
+    Records template writes for the search indexes. Called with the version returned by `listing_cache.bump_version()`.
+
+    The writes are stored in S3 as the delta of `version`, a small object, so every other container brings its
+    snapshot up to date without a table scan. The search index of this container, if it has one, applies them too:
+    when `version` is exactly one past the version of the index, no other container wrote in between and the index
+    moves to `version`. Its snapshot is saved at most every SEARCH_INDEX_SAVE_SECONDS, so a burst of writes does not
+    pay a snapshot upload each. Otherwise the next search reloads the index at the current version.
+
+    Args:
+        version (int): The listing version of the writes, None when the version marker could not be updated.
+        added (iterable): The created or updated templates, with their indexed attributes.
+        removed (iterable): The IDs of the deleted templates.
+    """
+    added, removed = list(added), list(removed)
+    if version is not None and SEARCH_INDEX_BUCKET:
+        save_delta(get_client('s3'), SEARCH_INDEX_BUCKET, SEARCH_INDEX_DELTA_PREFIX, version, added, removed)
+    if search_index is None:
+        return
+    for template_id in removed:
+        search_index.remove(template_id)
+    for template in added:
+        search_index.add(template)
+    if search_index.version is not None and version is not None and version == search_index.version + 1:
+        search_index.version = version
+        if search_index_saved_at is None or time.monotonic() - search_index_saved_at >= SEARCH_INDEX_SAVE_SECONDS:
+            save_search_index(search_index)
+
+def search_templates(query, email_from_token, limit=None, offset=None):
+    """
+    Searches the templates visible to the user (public or created by them) by name, description and tags.
+
+    The query is matched against the per-container inverted index (see `search_index.TemplateSearchIndex`): every
+    word must match, the last one also as a prefix, and the results are ranked by relevance. The templates of the
+    page are then read with BatchGetItem, and checked again for visibility in case they changed since indexing.
+
+    The function returns a response dictionary with the following structure:
+    - 'statusCode': 200 if the operation is successful, 400 for an invalid page, 500 if an exception occurs
+    - 'headers': A dictionary of HTTP headers, including CORS settings to allow cross-origin access
+    - 'body': A JSON-encoded object with the 'items' of the page (each with its 'score'), the 'total' number of matches and the 'offset'
+
+    Args:
+        query (str): The search text.
+        email_from_token (str): The email address of the user making the request, extracted from the authorization token.
+        limit (int, optional): The number of results per page, 20 by default and at most SEARCH_MAX_LIMIT.
+        offset (int, optional): The number of results to skip.
+
+    Returns:
+        dict: A response dictionary containing the page of matching templates.
+    """
+    try:
+        limit = min(int(limit or 20), SEARCH_MAX_LIMIT)
+        offset = max(int(offset or 0), 0)
+    except ValueError:
+        return {'statusCode': 400, 'body': json.dumps({'error': 'limit and offset must be integers'})}
+
+    try:
+        started = time.perf_counter()
+        total, results = get_search_index().search(query, email_from_token, limit, offset)
+        searched = time.perf_counter()
+        items = {item['templateId']: item for item in batch_get(table, ({'templateId': template_id} for template_id, _ in results))}
+        templates = [
+            dict(items[template_id], score=score) for template_id, score in results
+            if template_id in items and (items[template_id].get('visibility') == 'public' or items[template_id].get('createdBy') == email_from_token)
+        ]
+        print(f"Templates search: {total} matches, index {(searched - started) * 1000:.1f} ms, "
+              f"read {(time.perf_counter() - searched) * 1000:.1f} ms")
+        return bulk_response({'items': templates, 'total': total, 'offset': offset})
     except ClientError as e:
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
@@ -159,6 +454,7 @@ def create_template(event):
     data['dateCreated'] = str(time.time()) # Add creation date
     try:
         table.put_item(Item=data)
+        update_search_index(listing_cache.bump_version(), added=[data])
         return {
             'statusCode': 201, 
              "headers": {
@@ -175,11 +471,11 @@ def update_template(event, email_from_token):
     """
     Updates an existing template in a DynamoDB table.
 
-    This function takes the 'body' data from the provided 'event' parameter, which is expected to contain the updated template data. It first retrieves the existing template item from the DynamoDB table using the 'templateId' provided in the 'body' data.
+    This function takes the 'body' data from the provided 'event' parameter, which is expected to contain the 'templateId' and the updated template data.
 
-    The function then checks if the existing template item belongs to the user making the request (identified by the 'email_from_token' parameter). If the item does not exist or the requesting user is not the owner, the function returns a 403 Forbidden response.
+    The template is updated with a single conditional `update_item` call: the condition checks that the template exists and belongs to the user making the request (identified by the 'email_from_token' parameter), so ownership is verified atomically with the write. If the condition fails, the function returns a 403 Forbidden response.
 
-    If the requesting user is the owner of the template, the function proceeds to update the template data in the DynamoDB table using the `update_item` method. The updated fields include 'createdBy', 'templateName', 'templateDescription', 'modelversion', 'templatePrompt', 'visibility', 'templateGuidance', and 'systemPrompt'.
+    Only the fields present in the body are updated, among 'createdBy', 'templateName', 'templateDescription', 'modelversion', 'templatePrompt', 'visibility', 'templateGuidance', 'systemPrompt', and 'tags'. The updated template is reindexed for search.
 
     If the update operation is successful, the function returns a response dictionary with the following structure:
     - 'statusCode': 200 (OK)
@@ -198,32 +494,22 @@ def update_template(event, email_from_token):
 
     data = json.loads(event['body'])
     template_id = data['templateId']
-
-    # First, retrieve the item to check ownership
-    response = table.get_item(Key={'templateId': template_id})
-    item = response.get('Item', {})
-
-    # Check if the item exists and if the requesting user is the owner
-    if not item or item.get('createdBy') != email_from_token:
-        return {'statusCode': 403, 'body': json.dumps({'error': 'Access denied'})}
+    fields = [field for field in UPDATABLE_FIELDS if field in data]
 
     try:
-        # Update the item in DynamoDB
+        # Update the item in DynamoDB if it exists and the requesting user is the owner
         response = table.update_item(
             Key={'templateId': template_id},
-            UpdateExpression="set createdBy=:cb, templateName=:tn, templateDescription=:td, modelversion=:mv, templatePrompt=:tp, visibility=:v, templateGuidance=:tg, systemPrompt=:sp",
+            UpdateExpression="set " + ", ".join(f"#{field}=:{field}" for field in fields),
+            ConditionExpression="createdBy = :owner",
+            ExpressionAttributeNames={f"#{field}": field for field in fields},
             ExpressionAttributeValues={
-                ':cb': data['createdBy'],
-                ':tn': data['templateName'],
-                ':td': data['templateDescription'],
-                ':mv': data['modelversion'],
-                ':tp': data['templatePrompt'],
-                ':v': data['visibility'],
-                ':tg': data['templateGuidance'],
-                ':sp': data['systemPrompt']
+                ':owner': email_from_token,
+                **{f":{field}": data[field] for field in fields}
             },
-            ReturnValues="UPDATED_NEW"
+            ReturnValues="ALL_NEW"
         )
+        update_search_index(listing_cache.bump_version(), added=[response['Attributes']])
         return {
             'statusCode': 200, 
              "headers": {
@@ -233,17 +519,17 @@ def update_template(event, email_from_token):
                  },
             'body': json.dumps({'message': 'Template updated successfully'})}
     except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return {'statusCode': 403, 'body': json.dumps({'error': 'Access denied'})}
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
 def delete_template(event, email_from_token):
     """
     Deletes an existing template from a DynamoDB table.
 
-    This function takes the 'body' data from the provided 'event' parameter, which is expected to contain the 'templateId' of the template to be deleted. It first retrieves the existing template item from the DynamoDB table using the provided 'templateId'.
-
-    The function then checks if the existing template item belongs to the user making the request (identified by the 'email_from_token' parameter). If the item does not exist or the requesting user is not the owner, the function returns a 403 Forbidden response.
+    This function takes the 'body' data from the provided 'event' parameter, which is expected to contain the 'templateId' of the template to be deleted.
 
-    If the requesting user is the owner of the template, the function proceeds to delete the template item from the DynamoDB table using the `delete_item` method.
+    The template is deleted with a single conditional `delete_item` call: the condition checks that the template exists and belongs to the user making the request (identified by the 'email_from_token' parameter). If the condition fails, the function returns a 403 Forbidden response.
 
     If the delete operation is successful, the function returns a response dictionary with the following structure:
     - 'statusCode': 200 (OK)
@@ -261,16 +547,14 @@ def delete_template(event, email_from_token):
     """
     template_id = json.loads(event['body'])['templateId']
 
-    # First, retrieve the item to check ownership
-    response = table.get_item(Key={'templateId': template_id})
-    item = response.get('Item', {})
-
-    # Check if the item exists and if the requesting user is the owner
-    if not item or item.get('createdBy') != email_from_token:
-        return {'statusCode': 403, 'body': json.dumps({'error': 'Access denied'})}
-
     try:
-        table.delete_item(Key={'templateId': template_id})
+        # Delete the item only if it exists and the requesting user is the owner
+        table.delete_item(
+            Key={'templateId': template_id},
+            ConditionExpression="createdBy = :owner",
+            ExpressionAttributeValues={':owner': email_from_token}
+        )
+        update_search_index(listing_cache.bump_version(), removed=[template_id])
         return {
             'statusCode': 200, 
              "headers": {
@@ -279,6 +563,132 @@ def delete_template(event, email_from_token):
                 "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken"
                  },
             'body': json.dumps({'message': 'Template deleted successfully'})}
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return {'statusCode': 403, 'body': json.dumps({'error': 'Access denied'})}
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+
+
+def bulk_response(body):
+    return {
+        'statusCode': 200, 
+         "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",  # This allows any origin to access your API. 
+            "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,authorizationtoken"
+             },
+        'body': json.dumps(body)}
+
+def export_templates(email_from_token):
+    """
+    Exports every template of a user in the format accepted by `import_templates`.
+
+    The templates are read from the 'createdBy-dateCreated-index' global secondary index, following every page, and only their
+    editable fields are kept, so an export can be imported again (by the same or another user) as new templates.
+
+    Args:
+        email_from_token (str): The email address of the user making the request, extracted from the authorization token.
+
+    Returns:
+        dict: A response dictionary whose body is an object with the list of 'templates'.
+    """
+    try:
+        items, _ = query_templates(CREATED_BY_INDEX, 'createdBy', email_from_token)
+        templates = [{field: item[field] for field in UPDATABLE_FIELDS if field != 'createdBy' and field in item} for item in items]
+        return bulk_response({'templates': templates})
+    except ClientError as e:
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+def import_templates(body, email_from_token):
+    """
+    Creates many templates at once, for example a template pack such as 'default_templates.json'.
+
+    The body holds a 'templates' list. Every template is owner-checked: a template naming another user in 'createdBy' is rejected,
+    and templates without 'createdBy' are created for the requesting user. Only the editable fields are stored, every template gets
+    a new unique 'templateId' and 'dateCreated', and 'visibility' defaults to 'private' (index keys cannot be empty).
+
+    The templates are written with BatchWriteItem in batches of 25, several batches in parallel, retrying unprocessed items with
+    backoff. Progress is logged while the import runs.
+
+    Args:
+        body (dict): The request body, with 'createdBy' and the 'templates' to import.
+        email_from_token (str): The email address of the user making the request, extracted from the authorization token.
+
+    Returns:
+        dict: A response dictionary with the number of imported templates, and the indexes of the rejected and failed templates.
+    """
+    templates = body['templates']
+    if not isinstance(templates, list) or len(templates) > BULK_MAX_ITEMS:
+        return {'statusCode': 400, 'body': json.dumps({'error': f'templates must be a list of at most {BULK_MAX_ITEMS} items'})}
+
+    now = time.time()
+    rejected = []
+    requests = []
+    for index, template in enumerate(templates):
+        if not isinstance(template, dict) or template.get('createdBy', email_from_token) != email_from_token:
+            rejected.append(index)
+            continue
+        item = {field: template[field] for field in UPDATABLE_FIELDS if field in template}
+        item['createdBy'] = email_from_token
+        item['visibility'] = item.get('visibility') or 'private'
+        # Unique, ordered IDs within the import, based on epoch time like `create_template`
+        item['templateId'] = item['dateCreated'] = f'{now + index / 1e6:.6f}'
+        requests.append({'PutRequest': {'Item': item}})
+
+    try:
+        result = batch_write(table, requests, progress=log_progress(f'Template import for {email_from_token}'))
+        failed = {request['PutRequest']['Item']['templateId'] for request in result['unprocessed']}
+        if result['written']:
+            update_search_index(listing_cache.bump_version(), added=[request['PutRequest']['Item'] for request in requests if request['PutRequest']['Item']['templateId'] not in failed])
+        return bulk_response({
+            'message': 'Templates imported successfully' if not rejected and not failed else 'Templates partially imported',
+            'imported': result['written'],
+            'rejected': rejected,
+            'failed': [index for index, request in enumerate(requests) if request['PutRequest']['Item']['templateId'] in failed]
+        })
     except ClientError as e:
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
+def delete_templates(body, email_from_token):
+    """
+    Deletes many templates of a user at once.
+
+    BatchWriteItem does not support condition expressions, so ownership is checked before the write: the templates are read
+    with BatchGetItem and only the ones created by the requesting user are deleted, the others (including missing templates)
+    are reported as denied. A template cannot change owner (updates require 'createdBy' to be the requesting user), so the
+    check cannot be invalidated between the read and the delete.
+
+    Args:
+        body (dict): The request body, with 'createdBy' and the list of 'templateIds' to delete.
+        email_from_token (str): The email address of the user making the request, extracted from the authorization token.
+
+    Returns:
+        dict: A response dictionary with the number of deleted templates, and the denied and failed template IDs.
+    """
+    template_ids = body['templateIds']
+    if not isinstance(template_ids, list) or len(template_ids) > BULK_MAX_ITEMS:
+        return {'statusCode': 400, 'body': json.dumps({'error': f'templateIds must be a list of at most {BULK_MAX_ITEMS} items'})}
+    # BatchGetItem and BatchWriteItem reject duplicate keys in a batch
+    template_ids = list(dict.fromkeys(template_ids))
+
+    try:
+        items = batch_get(table, ({'templateId': template_id} for template_id in template_ids), ['templateId', 'createdBy'])
+        owned = {item['templateId'] for item in items if item.get('createdBy') == email_from_token}
+        result = batch_write(
+            table,
+            ({'DeleteRequest': {'Key': {'templateId': template_id}}} for template_id in template_ids if template_id in owned),
+            progress=log_progress(f'Template delete for {email_from_token}')
+        )
+        if result['written']:
+            failed = {request['DeleteRequest']['Key']['templateId'] for request in result['unprocessed']}
+            update_search_index(listing_cache.bump_version(), removed=[template_id for template_id in template_ids if template_id in owned and template_id not in failed])
+        denied = [template_id for template_id in template_ids if template_id not in owned]
+        return bulk_response({
+            'message': 'Templates deleted successfully' if not denied and not result['failed'] else 'Templates partially deleted',
+            'deleted': result['written'],
+            'denied': denied,
+            'failed': [request['DeleteRequest']['Key']['templateId'] for request in result['unprocessed']]
+        })
+    except ClientError as e:
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
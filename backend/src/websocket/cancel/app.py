@@ -0,0 +1,31 @@
+import json
+import time
+from assistant_common.connections import connections_table, request_cancel
+
+def handler(event, context):
+    """
+    Handles the cancel action: {"action": "cancel"}.
+
+    Cancels the generations (sendmessage, compare and chat) streaming to the connection the action
+    was sent on. They read the flag at most CANCEL_CHECK_INTERVAL_SECONDS later, close their model
+    stream, store the partial completion marked as truncated and send a final
+    {"endOfMessage": true, "truncated": true, "reason": "cancelled"} frame.
+    """
+    connection_id = event['requestContext']['connectionId']
+    requested_at = int(event['requestContext'].get('requestTimeEpoch', time.time() * 1000))
+
+    table = connections_table()
+    if not table:
+        return {'statusCode': 400, 'body': json.dumps({'error': 'Cancellation is not enabled'})}
+
+    try:
+        active_requests = request_cancel(table, connection_id, requested_at)
+    except Exception as e:
+        print(f"Could not cancel the generations of connection {connection_id}: {e}")
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+    print(f"Cancel requested on connection {connection_id}, generations in flight: {active_requests}")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'cancelled': active_requests})
+    }
@@ -1,43 +1,79 @@
 import json
-import boto3
 import os
-from langchain_aws import ChatBedrock
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.messages import HumanMessage
-from langchain_community.chat_message_histories import DynamoDBChatMessageHistory
-from langchain_core.output_parsers import StrOutputParser
-
-# Function to retrieve and trim session history from DynamoDB
-def get_session_history(session_id, email, table_name, max_length=20, max_words=50000):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(table_name)
-    composite_key = {"SessionId": session_id, "Email": email}
-
-    response = table.get_item(Key=composite_key)
-    messages = response.get('Item', {}).get('History', [])
-    
-    # Trim history based on constraints
-    if len(messages) > max_length:
-        messages = messages[-max_length:]
-
-    total_words = sum(len(msg['data']['content'].split()) for msg in messages)
-    while total_words > max_words and messages:
-        total_words -= len(messages.pop(0)['data']['content'].split())
-
-    # Update the item in DynamoDB if necessary
-    if len(messages) < max_length or total_words <= max_words:
-        table.update_item(
-            Key=composite_key,
-            UpdateExpression='SET History = :val',
-            ExpressionAttributeValues={':val': messages}
-        )
-    
-    return DynamoDBChatMessageHistory(table_name=table_name, session_id=session_id, key=composite_key)
+import time
+from contextlib import closing
+from assistant_common.admission import fallback_model_id, get_admission, status_sender, stream_with_retry
+from assistant_common.clients import get_client, get_management_api, get_table
+from assistant_common.connections import DISCONNECTED, GenerationCancelled, GenerationWatch, connections_table, estimate_output_tokens, max_tokens_avoided
+from assistant_common.delivery import StreamDelivery, ConnectionGoneError
+from assistant_common.pipeline import PipelinedStream, pipeline_enabled
+from assistant_common.tracing import Trace
+from native_engine import NativeChatEngine, history_message, system_blocks
+from session_store import SessionStore
+from windowing import token_budget
+
+# LangChain is imported on first use (see build_chat_chain) instead of at module load, so the
+# cold start of the function only pays for it when a chat request actually needs it
+
+# Dropped turns are collapsed into a summary entry instead of being discarded when enabled
+HISTORY_SUMMARY = os.environ.get('HISTORY_SUMMARY', 'false').lower() == 'true'
+
+def build_chat_chain(modelId, system_prompt, model_kwargs, store):
+    """
+    Builds the `prompt | ChatBedrock | StrOutputParser` chain wrapped with the session history.
+
+    The system prompt and the summary of dropped turns go into a single leading system message, as
+    the native engine does: Anthropic models on Bedrock reject a system message anywhere else.
+
+    The LangChain modules are imported here rather than at module level; Python caches them after
+    the first call, so only the first chat request of a container pays the import cost.
+    """
+    from langchain_aws import ChatBedrock
+    from langchain_core.messages import SystemMessage
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain_core.runnables import RunnablePassthrough
+    from langchain_core.runnables.history import RunnableWithMessageHistory
+    from langchain_core.output_parsers import StrOutputParser
+    from history_store import DynamoDBSessionHistory
+
+    # Configure the Bedrock model
+    chat_model = ChatBedrock(
+        client=get_client('bedrock-runtime'),
+        model_id=modelId,
+        model_kwargs=model_kwargs
+    )
+
+    # The history is loaded by the time the system message is built, see RunnableWithMessageHistory
+    def system_messages(inputs):
+        texts = [block['text'] for block in system_blocks(system_prompt, store.messages or [])]
+        return [SystemMessage(content='\n\n'.join(texts))] if texts else []
+
+    # Define the chat prompt template for interaction
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            MessagesPlaceholder(variable_name="system"),
+            MessagesPlaceholder(variable_name="history"),
+            ("human", "{question}"),
+        ]
+    )
+
+    # Combine the prompt with the Bedrock chat model and parse the output as a string
+    chat_chain = RunnablePassthrough.assign(system=system_messages) | prompt | chat_model | StrOutputParser()
+
+    # Chain with History
+    return RunnableWithMessageHistory(
+        chat_chain,
+        lambda session_id: DynamoDBSessionHistory(store),
+        input_messages_key="question",
+        history_messages_key="history",
+    )
 
 def handler(event, context):
     table_name = os.environ.get('DYNAMODB_TABLE')
 
+    # Stage timings and counters of the turn, logged as one metrics line at the end
+    trace = Trace('chat', event['requestContext'].get('requestId'))
+
     # Extract information from the event
     email = event['requestContext']['authorizer']['principalId']
     domain_name = event['requestContext']['domainName']
@@ -45,7 +81,8 @@ def handler(event, context):
     connection_id = event['requestContext']['connectionId']
 
     # Initialize the API Gateway Management API
-    api_gateway_management_api = boto3.client('apigatewaymanagementapi', endpoint_url=f'https://{domain_name}/{stage}')
+    with trace.span('clientSetup'):
+        api_gateway_management_api = get_management_api(domain_name, stage)
 
     # Parse the incoming message
     body = json.loads(event['body'])
@@ -62,69 +99,139 @@ def handler(event, context):
         top_p = body.get('top_p', 0.999)
         session_id = body.get('session_id')
 
-        my_key = {
-            "SessionId": session_id,
-            "Email": email
-        }
-
-        # Configure the Bedrock model
-        chat_model = ChatBedrock(
-            model_id=modelId,
-            model_kwargs={
-                "temperature": temperature,
-                "max_tokens": max_tokens_to_sample,
-                "top_k": top_k,
-                "top_p": top_p
-            }
-        )
-
-        # Define the chat prompt template for interaction
-        if system_prompt:
-            prompt = ChatPromptTemplate.from_messages(
-                [
-                    ("system", system_prompt),
-                    MessagesPlaceholder(variable_name="history"),
-                    ("human", "{question}"),
-                ]
-            )
-        else:
-             prompt = ChatPromptTemplate.from_messages(
-                [
-                    MessagesPlaceholder(variable_name="history"),
-                    ("human", "{question}"),
-                ]
-            )
-
-        # Combine the prompt with the Bedrock chat model and parse the output as a string
-        chat_chain = prompt | chat_model | StrOutputParser()
-
-        composite_key = {
-            "SessionId": session_id,  # Use your session ID here
-            "Email": email       # Use your user's email here
-        }
-
-        # Chain with History
-        chain_with_history = RunnableWithMessageHistory(
-            chat_chain,
-            lambda session_id: get_session_history(session_id, email, table_name),
-            input_messages_key="question",
-            history_messages_key="history",
+        # The chat engine is either the LangChain chain (default) or the native ConverseStream engine
+        engine = body.get('engine', os.environ.get('CHAT_ENGINE', 'langchain'))
+
+        # Coalesce streamed tokens into fewer WebSocket posts
+        delivery = StreamDelivery(api_gateway_management_api, connection_id, trace=trace)
+        trace.set_dimension('ModelId', modelId)
+        trace.set_property('engine', engine)
+
+        # Both engines read and write the session history through the same incremental store
+        with trace.span('clientSetup'):
+            table = get_table(table_name)
+        store = SessionStore(
+            table,
+            {"SessionId": session_id, "Email": email},
+            token_budget(modelId, max_tokens_to_sample),
+            summarize=HISTORY_SUMMARY
         )
-
-        configuration = {"configurable": {"session_id": session_id}}
+        # Registers the turn on its connection and watches for a cancel action or a disconnection
+        request_id = event['requestContext'].get('requestId')
+        watch = GenerationWatch(connections_table(), connection_id, request_id, int(event['requestContext'].get('requestTimeEpoch', time.time() * 1000)))
+        truncated = None
 
         try:
-            # Stream responses
-            for response in chain_with_history.stream(input={"question": data}, config=configuration):
-                formatted_response = json.dumps({'messages': response})
-                api_gateway_management_api.post_to_connection(ConnectionId=connection_id, Data=formatted_response)
-            
-            final_response = json.dumps({"endOfMessage": True})
-            api_gateway_management_api.post_to_connection(ConnectionId=connection_id, Data=final_response)
+            # Per-user and per-model rate limits, the client is told while the turn is queued. Once admitted,
+            # both engines retry throttling with backoff behind "retrying" frames and may fall back to
+            # FALLBACK_MODEL_ID.
+            notify = status_sender(delivery, trace)
+            admission = get_admission()
+            if admission:
+                with trace.span('admission'):
+                    admitted = admission.admit(email, modelId, notify, fallback_model_id())
+                if admitted is None:
+                    trace.count('rejected')
+                    rejection = {'action': 'error', 'error': 'Too many requests, please try again in a moment.'}
+                    delivery.post(rejection)
+                    return {'statusCode': 429, 'body': json.dumps(rejection)}
+                modelId = admitted
+
+            # Registered before the model is called, throttling retries included
+            watch.start()
+            if engine == 'native':
+                with trace.span('clientSetup'):
+                    bedrock = get_client('bedrock-runtime')
+                native_engine = NativeChatEngine(
+                    bedrock,
+                    store,
+                    modelId,
+                    system_prompt,
+                    {
+                        "maxTokens": max_tokens_to_sample,
+                        "temperature": temperature,
+                        "topP": top_p
+                    },
+                    trace,
+                    notify,
+                    fallback_model_id()
+                )
+                stream = native_engine.stream(data)
+            else:
+                model_kwargs = {
+                    "temperature": temperature,
+                    "max_tokens": max_tokens_to_sample,
+                    "top_k": top_k,
+                    "top_p": top_p
+                }
+                configuration = {"configurable": {"session_id": session_id}}
+                # The chain only calls Bedrock on its first read, a throttled call is retried on a new chain
+                start_chain = lambda model_id: build_chat_chain(model_id, system_prompt, model_kwargs, store).stream(
+                    input={"question": data}, config=configuration
+                )
+                stream = stream_with_retry(start_chain, modelId, notify, fallback_model_id())
+
+            # Stream responses, reading the engine on its own thread in pipeline mode
+            events = PipelinedStream(stream, delivery) if pipeline_enabled() else closing(stream)
+            text_chunks = []
+            try:
+                with trace.span('stream'), events as responses:
+                    for response in responses:
+                        # Stops reading, which closes the model stream, once the client cancelled or left
+                        watch.check()
+                        trace.mark('timeToFirstToken')
+                        text_chunks.append(response)
+                        delivery.send(response)
+            except ConnectionGoneError:
+                truncated = DISCONNECTED
+            except GenerationCancelled as cancelled:
+                truncated = cancelled.reason
+
+            if truncated:
+                # Neither engine stores a turn it did not finish, the partial answer is stored marked as truncated. In
+                # pipeline mode the reader thread may have finished the engine, which then stored the complete turn
+                answer_text = ''.join(text_chunks)
+                answer = history_message('ai', answer_text)
+                answer['data']['response_metadata'] = {'truncated': True, 'truncationReason': truncated}
+                with trace.span('historyWrite'):
+                    if not store.append([history_message('human', data), answer], truncated_turn=True):
+                        print(f"Chat turn {request_id} of session {session_id} was already stored complete")
+                avoided = max_tokens_avoided(max_tokens_to_sample, answer_text)
+                trace.count('cancellations')
+                trace.count('truncatedOutputTokens', estimate_output_tokens(answer_text))
+                trace.count('maxTokensAvoided', avoided)
+                print(f"Chat turn {request_id} of session {session_id} stopped early ({truncated}), at most {avoided} output tokens avoided")
+                if truncated == DISCONNECTED:
+                    return {'statusCode': 410, 'body': 'Client disconnected'}
+                delivery.end({'truncated': True, 'reason': truncated})
+                trace.mark('endOfMessage')
+                return {'statusCode': 200, 'body': 'Chat message processed successfully'}
+
+            # The native engine reports the token usage of the turn, including prompt cache reads and writes
+            usage = native_engine.usage if engine == 'native' else None
+            delivery.end({'usage': usage} if usage else None)
+            trace.mark('endOfMessage')
+            delivery.log_stats(event['requestContext'].get('requestId'))
+            print(f"Chat history DynamoDB calls for session {session_id}: {json.dumps(store.metrics())}")
+
+        except ConnectionGoneError:
+            # The client went away, closing the stream stops the generation
+            print(f"Connection {connection_id} is gone, stopped streaming session {session_id}")
+            trace.count('disconnects')
+            return {'statusCode': 410, 'body': 'Client disconnected'}
 
         except Exception as e:
+            # Deliver the text streamed so far before reporting the error
+            trace.count('errors')
+            delivery.flush()
             error_message = json.dumps({'action': 'error', 'error': str(e)})
             api_gateway_management_api.post_to_connection(ConnectionId=connection_id, Data=error_message)
             return {'statusCode': 500, 'body': error_message}
 
+        finally:
+            watch.stop()
+            trace.count('historyReads', store.reads)
+            trace.count('historyWrites', store.writes)
+            trace.emit()
+
         return {'statusCode': 200, 'body': 'Chat message processed successfully'}
\ No newline at end of file
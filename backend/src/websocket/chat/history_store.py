@@ -0,0 +1,50 @@
+from decimal import Decimal
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import messages_from_dict, messages_to_dict
+from windowing import is_summary
+
+
+def convert_floats(value):
+    """Recursively converts floats to Decimal, the only number type DynamoDB accepts."""
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: convert_floats(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [convert_floats(v) for v in value]
+    return value
+
+
+class DynamoDBSessionHistory(BaseChatMessageHistory):
+    """
+    LangChain chat message history backed by a `SessionStore`.
+
+    This keeps the item shape used by `DynamoDBChatMessageHistory` (`SessionId`, `Email`, `History`)
+    so existing sessions keep working, but only depends on `langchain_core`. The history is read
+    once per turn and the new messages are appended in a single conditional write.
+
+    Args:
+        store (SessionStore): The incremental store of the session.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def messages(self):
+        """
+        Retrieve the messages from DynamoDB, reading the session item only once.
+
+        The summary entry of dropped turns is not a message, the chain adds it to the system message.
+        """
+        if self.store.messages is None:
+            self.store.load()
+        return messages_from_dict([message for message in self.store.messages if not is_summary(message)])
+
+    def add_messages(self, messages):
+        """Append the messages to the record in DynamoDB"""
+        self.store.append(convert_floats(messages_to_dict(messages)))
+
+    def clear(self):
+        """Clear session memory from DynamoDB"""
+        self.store.clear()
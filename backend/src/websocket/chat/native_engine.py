@@ -0,0 +1,131 @@
+from contextlib import closing, nullcontext
+from assistant_common.admission import converse_stream_with_retry
+from assistant_common.prompt_cache import add_cache_points, usage_fields
+from windowing import is_summary, message_text
+
+def history_message(message_type, text):
+    """Builds a history message with the same shape LangChain's `message_to_dict` produces."""
+    data = {
+        'content': text,
+        'additional_kwargs': {},
+        'response_metadata': {},
+        'type': message_type,
+        'name': None,
+        'id': None
+    }
+    if message_type == 'ai':
+        data.update({'tool_calls': [], 'invalid_tool_calls': [], 'usage_metadata': None})
+    return {'type': message_type, 'data': data}
+
+def usage_metadata(usage):
+    """Converts ConverseStream usage to the `usage_metadata` LangChain stores on AI messages."""
+    return {
+        'input_tokens': usage.get('inputTokens', 0),
+        'output_tokens': usage.get('outputTokens', 0),
+        'total_tokens': usage.get('totalTokens', 0),
+        'input_token_details': {
+            'cache_read': usage.get('cacheReadInputTokens', 0),
+            'cache_creation': usage.get('cacheWriteInputTokens', 0)
+        }
+    }
+
+def to_converse_messages(history, question):
+    """
+    Converts stored history messages plus the new question into ConverseStream messages.
+
+    The Converse API requires the conversation to start with a user message and roles to
+    alternate, so leading assistant messages are dropped and consecutive messages of the same
+    role are merged. The summary entry of dropped turns is not a message, see `system_blocks`.
+    """
+    roles = {'human': 'user', 'ai': 'assistant'}
+    messages = []
+    for message in history + [history_message('human', question)]:
+        role = roles.get(message['type'])
+        text = message_text(message)
+        if not role or not text or (not messages and role != 'user'):
+            continue
+        if messages and messages[-1]['role'] == role:
+            messages[-1]['content'][0]['text'] += '\n' + text
+        else:
+            messages.append({'role': role, 'content': [{'text': text}]})
+    return messages
+
+def system_blocks(system_prompt, history):
+    """Returns the ConverseStream `system` blocks: the system prompt and the summary of dropped turns."""
+    texts = [system_prompt] if system_prompt else []
+    texts += [message_text(message) for message in history if is_summary(message)]
+    return [{'text': text} for text in texts]
+
+class NativeChatEngine:
+    """
+    Chat engine talking to `bedrock-runtime.converse_stream` directly, without LangChain.
+
+    A turn costs one DynamoDB read (the history) and one DynamoDB write (the new human/AI message
+    pair), and the model deltas are yielded as they arrive. Cache points close the system prompt
+    and the history on the models supporting prompt caching, see `add_cache_points`; the token
+    usage of the turn, cache reads and writes included, is kept in `usage` and on the AI message.
+    Throttled requests are retried with backoff, then sent to the `fallback` model if there is one;
+    `modelId` is the model that answered once the stream is done.
+
+    Args:
+        bedrock: A `bedrock-runtime` boto3 client.
+        store (SessionStore): The history store of the session.
+        modelId (str): The Bedrock model ID.
+        system_prompt (str, optional): The system prompt of the conversation.
+        inference_config (dict): The ConverseStream `inferenceConfig`.
+        trace (Trace, optional): Request trace receiving the history and model timings and the token usage.
+        notify (callable, optional): Posts the retry and fallback status frames to the client.
+        fallback (str, optional): The model to use when `modelId` keeps being throttled.
+    """
+
+    def __init__(self, bedrock, store, modelId, system_prompt, inference_config, trace=None, notify=None, fallback=None):
+        self.bedrock = bedrock
+        self.store = store
+        self.modelId = modelId
+        self.system_prompt = system_prompt
+        self.inference_config = inference_config
+        self.trace = trace
+        self.notify = notify or (lambda status: None)
+        self.fallback = fallback
+        self.usage = {}
+
+    def span(self, name):
+        return self.trace.span(name) if self.trace else nullcontext()
+
+    def stream(self, question):
+        """Yields the answer text deltas, then persists the turn once the stream is complete."""
+        with self.span('historyLoad'):
+            history = self.store.load()
+        request = {
+            'modelId': self.modelId,
+            'messages': to_converse_messages(history, question),
+            'inferenceConfig': self.inference_config
+        }
+        system = system_blocks(self.system_prompt, history)
+        if system:
+            request['system'] = system
+        cache_points = add_cache_points(request)
+        if self.trace:
+            self.trace.count('cachePoints', cache_points)
+
+        text_chunks = []
+        with self.span('converseStream'):
+            response = converse_stream_with_retry(self.bedrock, request, self.notify, self.fallback)
+        self.modelId = request['modelId']
+        with closing(response['stream']) as events:
+            for chunk in events:
+                if 'contentBlockDelta' in chunk:
+                    text = chunk['contentBlockDelta']['delta'].get('text')
+                    if text:
+                        text_chunks.append(text)
+                        yield text
+                elif 'metadata' in chunk:
+                    self.usage = usage_fields(chunk['metadata'].get('usage', {}))
+                    if self.trace:
+                        self.trace.record_metadata(chunk['metadata'])
+
+        answer = history_message('ai', ''.join(text_chunks))
+        if self.usage:
+            answer['data']['usage_metadata'] = usage_metadata(self.usage)
+        with self.span('historyWrite'):
+            self.store.append([history_message('human', question), answer])
@@ -0,0 +1,170 @@
+import threading
+from botocore.exceptions import ClientError
+from windowing import annotate, trim_to_budget
+
+# Number of times an append is retried when another writer changed the session in the meantime
+MAX_WRITE_ATTEMPTS = 3
+
+class SessionStore:
+    """
+    Incremental store for the history of one chat session.
+
+    The session item keeps the shape used by the LangChain history (`SessionId`, `Email`,
+    `History`) plus running `MessageCount` and `TokenCount` attributes and a `Version` number.
+    Every stored message carries its token estimate in a `tokens` field, so the history is
+    windowed to the model token budget without re-reading the text of the kept messages.
+
+    A turn costs one read and one write: trimming is applied in memory and only written back
+    together with the next append when it actually removed messages, and appends use
+    `list_append` under a `Version` condition so concurrent tabs don't overwrite each other.
+
+    Args:
+        table: The boto3 DynamoDB Table resource holding the chat sessions.
+        key (dict): The composite key of the session item.
+        token_budget (int): Maximum number of history tokens, see `windowing.token_budget`.
+        max_length (int, optional): Maximum number of messages kept in the history.
+        summarize (bool, optional): Collapse dropped turns into a summary entry instead of discarding them.
+    """
+
+    def __init__(self, table, key, token_budget, max_length=20, summarize=False):
+        self.table = table
+        self.key = key
+        self.token_budget = token_budget
+        self.max_length = max_length
+        self.summarize = summarize
+
+        self.messages = None
+        self.token_count = 0
+        self.dropped = 0
+        self.version = None
+        self.needs_rewrite = False
+
+        self.reads = 0
+        self.writes = 0
+        self.conflicts = 0
+
+        # Set once a truncated turn was stored, see `append`
+        self.sealed = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Reads the session item once and returns the trimmed history."""
+        response = self.table.get_item(Key=self.key)
+        self.reads += 1
+        item = response.get('Item', {})
+        stored = item.get('History', [])
+
+        # Messages written before token counts were cached are estimated once, then rewritten
+        annotated = annotate(stored)
+        if annotated or 'TokenCount' not in item:
+            total_tokens = int(sum(msg['tokens'] for msg in stored))
+        else:
+            total_tokens = int(item['TokenCount'])
+
+        self.messages, token_count, self.dropped = trim_to_budget(
+            stored, total_tokens, self.token_budget, self.max_length, self.summarize
+        )
+        self.token_count = int(token_count)
+        self.version = int(item['Version']) if 'Version' in item else None
+        self.needs_rewrite = bool(stored) and (annotated or self.dropped > 0 or 'TokenCount' not in item)
+        return self.messages
+
+    def _version_condition(self):
+        if self.version is None:
+            return 'attribute_not_exists(Version)', {}
+        return 'Version = :version', {':version': self.version}
+
+    def _write(self, new_messages, new_tokens):
+        condition, values = self._version_condition()
+        if self.needs_rewrite:
+            # Trimming removed messages (or counts are missing): write the whole window once
+            messages = self.messages + new_messages
+            self.table.update_item(
+                Key=self.key,
+                UpdateExpression='SET History = :h, MessageCount = :mc, TokenCount = :tc, Version = :next REMOVE WordCount',
+                ConditionExpression=condition,
+                ExpressionAttributeValues={
+                    ':h': messages,
+                    ':mc': len(messages),
+                    ':tc': self.token_count + new_tokens,
+                    ':next': (self.version or 0) + 1,
+                    **values
+                }
+            )
+        else:
+            self.table.update_item(
+                Key=self.key,
+                UpdateExpression=(
+                    'SET History = list_append(if_not_exists(History, :empty), :new), '
+                    'MessageCount = if_not_exists(MessageCount, :zero) + :n, '
+                    'TokenCount = if_not_exists(TokenCount, :zero) + :t, '
+                    'Version = if_not_exists(Version, :zero) + :one'
+                ),
+                ConditionExpression=condition,
+                ExpressionAttributeValues={
+                    ':empty': [],
+                    ':new': new_messages,
+                    ':zero': 0,
+                    ':one': 1,
+                    ':n': len(new_messages),
+                    ':t': new_tokens,
+                    **values
+                }
+            )
+
+    def append(self, new_messages, truncated_turn=False):
+        """
+        Persists new messages in a single conditional write.
+
+        If another writer updated the session since it was loaded, the session is reloaded and the
+        append is retried on top of the new state.
+
+        A stopped turn is stored by the handler with `truncated_turn`, while the engine may still be
+        storing the complete turn on the stream reader thread: the truncated turn is only written
+        when nothing was appended yet, and seals the store so that a later append is skipped. Either
+        way the turn is stored once.
+
+        Returns:
+            bool: True if the messages were written.
+        """
+        with self._lock:
+            if self.sealed or (truncated_turn and self.writes):
+                return False
+            if self.messages is None:
+                self.load()
+            annotate(new_messages)
+            new_tokens = sum(msg['tokens'] for msg in new_messages)
+
+            for attempt in range(MAX_WRITE_ATTEMPTS):
+                try:
+                    self.writes += 1
+                    self._write(new_messages, new_tokens)
+                    break
+                except ClientError as error:
+                    if error.response['Error']['Code'] != 'ConditionalCheckFailedException' or attempt == MAX_WRITE_ATTEMPTS - 1:
+                        raise
+                    self.conflicts += 1
+                    self.load()
+
+            self.messages = self.messages + new_messages
+            self.token_count += new_tokens
+            self.version = (self.version or 0) + 1
+            self.needs_rewrite = False
+            self.sealed = truncated_turn
+            return True
+
+    def clear(self):
+        """Deletes the session item."""
+        self.table.delete_item(Key=self.key)
+        self.writes += 1
+        self.messages, self.token_count, self.version, self.needs_rewrite = [], 0, None, False
+
+    def metrics(self):
+        """Returns the DynamoDB reads, writes and version conflicts of this turn, and the history window size."""
+        return {
+            'reads': self.reads,
+            'writes': self.writes,
+            'conflicts': self.conflicts,
+            'historyTokens': self.token_count,
+            'droppedMessages': self.dropped
+        }
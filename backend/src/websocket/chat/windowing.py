@@ -0,0 +1,144 @@
+import os
+
+# Approximate context windows (in tokens) by model ID prefix, most specific first
+MODEL_CONTEXT_TOKENS = [
+    ('anthropic.claude-instant', 100000),
+    ('anthropic.claude-v2', 100000),
+    ('anthropic.claude', 200000),
+    ('amazon.nova-micro', 128000),
+    ('amazon.nova', 300000),
+    ('amazon.titan-text-premier', 32000),
+    ('amazon.titan', 8000),
+    ('meta.llama3-1', 128000),
+    ('meta.llama3-2', 128000),
+    ('meta.llama3-3', 128000),
+    ('meta.llama3', 8000),
+    ('mistral.mistral-large', 128000),
+    ('mistral', 32000),
+    ('cohere.command-r', 128000),
+    ('ai21.jamba', 256000),
+]
+DEFAULT_CONTEXT_TOKENS = 32000
+
+# Share of the context window the history may use, the rest is left to the system prompt,
+# the question and the answer. Overridable with HISTORY_CONTEXT_FRACTION.
+HISTORY_CONTEXT_FRACTION = float(os.environ.get('HISTORY_CONTEXT_FRACTION', 0.35))
+
+# Maximum size of the summary entry that replaces dropped turns
+SUMMARY_MAX_TOKENS = int(os.environ.get('HISTORY_SUMMARY_MAX_TOKENS', 1000))
+SUMMARY_PREFIX = 'Summary of the earlier conversation:'
+SUMMARY_EXCERPT_CHARS = 300
+
+def estimate_tokens(text):
+    """Cheap token estimate (about four characters per token), good enough for budgeting."""
+    return max(1, (len(text) + 3) // 4) if text else 0
+
+def context_window(modelId):
+    """Returns the context window of a model, ignoring cross-region inference profile prefixes."""
+    model = modelId.split('/')[-1]
+    if model.split('.')[0] in ('us', 'eu', 'apac', 'us-gov', 'global'):
+        model = model.split('.', 1)[1]
+    for prefix, tokens in MODEL_CONTEXT_TOKENS:
+        if model.startswith(prefix):
+            return tokens
+    return DEFAULT_CONTEXT_TOKENS
+
+def token_budget(modelId, max_output_tokens=0):
+    """
+    Returns how many tokens of history can be sent to `modelId`.
+
+    The HISTORY_TOKEN_BUDGET environment variable overrides the model-derived value.
+    """
+    if os.environ.get('HISTORY_TOKEN_BUDGET'):
+        return int(os.environ['HISTORY_TOKEN_BUDGET'])
+    context = context_window(modelId)
+    return max(min(int(context * HISTORY_CONTEXT_FRACTION), context - max_output_tokens), 0)
+
+def message_text(message):
+    """Returns the text content of a stored history message."""
+    content = message['data']['content']
+    if isinstance(content, list):
+        return ''.join(block.get('text', '') for block in content if isinstance(block, dict))
+    return content
+
+def annotate(messages):
+    """
+    Stores a token estimate in the `tokens` field of every message that does not have one yet.
+
+    Returns:
+        bool: True if at least one message was annotated (and therefore needs to be persisted).
+    """
+    changed = False
+    for message in messages:
+        if 'tokens' not in message:
+            message['tokens'] = estimate_tokens(message_text(message))
+            changed = True
+    return changed
+
+def is_summary(message):
+    return message.get('summary', False)
+
+def summary_message(text):
+    """Builds the history entry holding the summary of dropped turns."""
+    return {
+        'type': 'system',
+        'summary': True,
+        'tokens': estimate_tokens(text),
+        'data': {'content': text, 'additional_kwargs': {}, 'response_metadata': {}, 'type': 'system', 'name': None, 'id': None}
+    }
+
+def summarize(previous, dropped):
+    """
+    Collapses dropped messages into the summary entry.
+
+    The summary is extractive (an excerpt of every dropped message appended to the previous
+    summary) so it costs no model call; when it outgrows SUMMARY_MAX_TOKENS the oldest part is cut.
+    """
+    speakers = {'human': 'User', 'ai': 'Assistant'}
+    lines = [message_text(previous)[len(SUMMARY_PREFIX):].strip()] if previous else []
+    for message in dropped:
+        excerpt = ' '.join(message_text(message).split())[:SUMMARY_EXCERPT_CHARS]
+        lines.append(f"{speakers.get(message['type'], message['type'])}: {excerpt}")
+    body = '\n'.join(line for line in lines if line)
+    max_chars = SUMMARY_MAX_TOKENS * 4 - len(SUMMARY_PREFIX) - 1
+    if len(body) > max_chars:
+        body = body[-max_chars:]
+    return summary_message(f"{SUMMARY_PREFIX}\n{body}")
+
+def trim_to_budget(messages, total_tokens, budget, max_length=20, with_summary=False):
+    """
+    Drops the oldest messages until the history fits `budget` tokens and `max_length` messages.
+
+    Every message carries its token estimate, so the cost is proportional to the number of
+    dropped messages rather than to the size of the history. With `with_summary`, dropped
+    messages are collapsed into a summary entry kept at the head of the history.
+
+    Args:
+        messages (list): Annotated history messages, oldest first.
+        total_tokens (int): Sum of the `tokens` of `messages`.
+        budget (int): Token budget of the history.
+        max_length (int, optional): Maximum number of messages to keep.
+        with_summary (bool, optional): Whether to summarize dropped messages instead of discarding them.
+
+    Returns:
+        tuple: The trimmed messages, their token count and the number of dropped messages.
+    """
+    summary = messages[0] if messages and is_summary(messages[0]) else None
+    start = 1 if summary else 0
+    kept_tokens = total_tokens - (summary['tokens'] if summary else 0)
+    # Leave room for the summary entry when it is enabled
+    target = budget - (SUMMARY_MAX_TOKENS if with_summary else 0)
+    limit = max_length - (1 if with_summary else 0)
+
+    drop = start
+    while drop < len(messages) and (kept_tokens > target or len(messages) - drop > limit):
+        kept_tokens -= messages[drop]['tokens']
+        drop += 1
+    if drop == start:
+        return messages, total_tokens, 0
+
+    dropped = messages[start:drop]
+    if with_summary:
+        summary = summarize(summary, dropped)
+        return [summary] + messages[drop:], kept_tokens + summary['tokens'], len(dropped)
+    return messages[drop:], kept_tokens, len(dropped) + start
@@ -1,11 +1,23 @@
 import json
+import time
+from assistant_common.connections import connections_table, register_connection
 
 def handler(event, context):
     # The onConnect event is triggered when a new WebSocket connection is established.
-    # You can perform any connection initialization logic here, such as
-    # logging the connection, storing connection details in a database, etc.
+    # The connection is recorded in the connections table (when CONNECTIONS_TABLE is set), where
+    # the streaming functions register their generations and read the cancellation flag.
 
     connection_id = event['requestContext']['connectionId']
+    email = event['requestContext'].get('authorizer', {}).get('principalId')
+    connected_at = int(event['requestContext'].get('requestTimeEpoch', time.time() * 1000))
+
+    table = connections_table()
+    if table:
+        try:
+            register_connection(table, connection_id, email, connected_at)
+        except Exception as e:
+            # The connection works without its record, only cancellation is unavailable
+            print(f"Could not record connection {connection_id}: {e}")
 
     # Return a successful response
     return {
@@ -1,8 +1,19 @@
 import json
+import time
+from assistant_common.connections import close_connection, connections_table
 
 def handler(event, context):
-    # Simply log the disconnection event
+    # Mark the connection as closed, generations still streaming to it stop at their next flag check
     connection_id = event['requestContext']['connectionId']
+    disconnected_at = int(event['requestContext'].get('requestTimeEpoch', time.time() * 1000))
+
+    table = connections_table()
+    if table:
+        try:
+            close_connection(table, connection_id, disconnected_at)
+        except Exception as e:
+            print(f"Could not close connection {connection_id}: {e}")
+
     # Return a successful response
     return {
         'statusCode': 200,
@@ -0,0 +1,95 @@
+import json
+import time
+from assistant_common.clients import get_management_api
+from assistant_common.connections import DISCONNECTED, GenerationWatch, connections_table
+from assistant_common.delivery import ConnectionGoneError, StreamDelivery
+from assistant_common.stream_buffer import cancel_stream, get_stream_header, mark_resumed, stream_buffer_table, tail_stream
+from assistant_common.tracing import Trace
+
+def handler(event, context):
+    """
+    Handles the resume action: {"action": "resume", "streamId": "...", "offset": 1234}.
+
+    A client whose WebSocket dropped mid-answer reconnects and sends the 'streamId' and the last
+    'offset' it received from the sendmessage frames. The text after that offset is replayed from
+    the stream buffer, then the live tail is followed until the generation ends, with the same
+    {"messages", "offset", "streamId"} frames and the original end-of-message (or error) frame. A
+    cancel action sent on the new connection reaches the generation through the stream buffer.
+
+    Returns 404 when the stream is unknown, expired or belongs to another user.
+    """
+    request_context = event['requestContext']
+    connection_id = request_context['connectionId']
+    request_id = request_context['requestId']
+    requested_at = int(request_context.get('requestTimeEpoch', time.time() * 1000))
+    email = request_context['authorizer']['principalId']
+    trace = Trace('resume', request_id)
+
+    api_client = get_management_api(request_context['domainName'], request_context['stage'])
+    body = json.loads(event.get('body') or '{}')
+    stream_id = body.get('streamId')
+    offset = body.get('offset', 0)
+    delivery = StreamDelivery(api_client, connection_id, trace=trace, tags={'streamId': stream_id}, offset=offset)
+
+    def reject(status_code, error):
+        error_message = {'action': 'error', 'error': error}
+        try:
+            delivery.post(error_message)
+        except ConnectionGoneError:
+            pass
+        return {'statusCode': status_code, 'body': json.dumps(error_message)}
+
+    table = stream_buffer_table()
+    if not table:
+        return reject(400, 'Resuming answers is not enabled')
+    if not isinstance(stream_id, str) or not isinstance(offset, int) or offset < 0:
+        return reject(400, 'streamId and a valid offset are required')
+
+    # Watches the new connection, a cancel action on it is forwarded to the generation
+    watch = GenerationWatch(connections_table(), connection_id, request_id, requested_at)
+    forwarded = []
+
+    def send(text):
+        if watch.cancelled and not forwarded:
+            if watch.reason == DISCONNECTED:
+                raise ConnectionGoneError(connection_id)
+            cancel_stream(table, stream_id, int(time.time() * 1000))
+            forwarded.append(True)
+        trace.mark('timeToFirstToken')
+        trace.count('resumedCharacters', len(text))
+        delivery.send(text)
+        delivery.flush()
+
+    try:
+        header = get_stream_header(table, stream_id)
+        if not header or header.get('email') != email:
+            return reject(404, 'This answer can no longer be resumed')
+        mark_resumed(table, stream_id, connection_id, requested_at)
+        print(f"Resuming stream {stream_id} of connection {header['connectionId']} on {connection_id} from offset {offset}")
+
+        watch.start()
+        with trace.span('stream'):
+            final = tail_stream(table, stream_id, offset, send)
+        delivery.post(final)
+        trace.mark('endOfMessage')
+        delivery.log_stats(request_id)
+
+    except ConnectionGoneError:
+        # The generation keeps going into the buffer, the client can resume again
+        print(f"Connection {connection_id} is gone, stopped resuming stream {stream_id}")
+        trace.count('disconnects')
+        return {'statusCode': 410, 'body': 'Client disconnected'}
+
+    except Exception as e:
+        print(f"Could not resume stream {stream_id}: {e}")
+        trace.count('errors')
+        return reject(500, str(e))
+
+    finally:
+        watch.stop()
+        trace.emit()
+
+    return {
+        'statusCode': 200,
+        'body': 'Stream resumed'
+    }
@@ -1,45 +1,421 @@
 import json
-import boto3
 import botocore
 import os
 import time
 import base64
+import io
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
 from botocore.exceptions import ClientError
+from assistant_common.admission import converse_stream_with_retry, fallback_model_id, get_admission, status_sender, switch_model
+from assistant_common.clients import get_client, get_management_api, get_table
+from assistant_common.connections import DISCONNECTED, GenerationCancelled, GenerationWatch, connections_table, estimate_output_tokens, max_tokens_avoided
+from assistant_common.delivery import StreamDelivery, ConnectionGoneError
+from assistant_common.history_items import request_parameters, store_bodies, summary_fields
+from assistant_common.persistence import WriteBehindQueue, write_behind_enabled
+from assistant_common.pipeline import PipelinedStream, pipeline_enabled
+from assistant_common.prompt_cache import add_cache_points, usage_fields
+from assistant_common.stream_buffer import StreamBuffer, stream_buffer_table
+from assistant_common.tracing import Trace
+from compare import compare_model_ids, compare_models
+from response_cache import CACHEABLE_STOP_REASONS, ResponseCache, cache_key, cache_requested, replay_chunks
+
+# Image fetch limits. Bedrock accepts images up to 3.75 MB each.
+MAX_IMAGES = 6
+IMAGE_FETCH_WORKERS = int(os.environ.get('IMAGE_FETCH_WORKERS', MAX_IMAGES))
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', 3932160))
+MAX_TOTAL_IMAGE_BYTES = int(os.environ.get('MAX_TOTAL_IMAGE_BYTES', 15728640))
+# Images above IMAGE_RESIZE_BYTES are downscaled to IMAGE_MAX_DIMENSION pixels when Pillow is available;
+# sources up to MAX_IMAGE_SOURCE_BYTES are then accepted even if they exceed MAX_IMAGE_BYTES
+IMAGE_RESIZE_BYTES = int(os.environ.get('IMAGE_RESIZE_BYTES', 1048576))
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 1568))
+MAX_IMAGE_SOURCE_BYTES = int(os.environ.get('MAX_IMAGE_SOURCE_BYTES', 20971520))
+
+# History writes queued behind the end-of-message signal, drained before the handler returns
+history_writes = WriteBehindQueue()
+# Number of timestamps tried when other requests of the user were stored in the same second
+MAX_TIMESTAMP_ATTEMPTS = 10
+
+# Model ID prefixes whose Converse API rejects system prompts, they only get the user message
+NO_SYSTEM_PROMPT_MODELS = ('amazon.titan', 'mistral.mistral-7b', 'mistral.mixtral', 'cohere.command-text', 'cohere.command-light', 'ai21.j2')
+
+# Completions of deterministic template runs, created on first use when RESPONSE_CACHE_TABLE is set
+response_cache = None
+
+# Pillow is installed from requirements.txt; without it (e.g. a local run) oversized images are skipped instead of downscaled
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def get_image_format(key):
+    """Returns the image format from the key extension, normalizing jpg to jpeg."""
+    image_format = key.split('.')[-1].lower()
+    if image_format == 'jpg':
+        image_format = 'jpeg'
+    return image_format
+
+def downscale_image(image_data, image_format):
+    """
+    Downscales and re-encodes an image so its longest side is at most IMAGE_MAX_DIMENSION pixels.
+
+    Returns the re-encoded bytes, or the original bytes if Pillow is unavailable, the image is
+    already small enough, or re-encoding does not make it smaller.
+    """
+    if Image is None:
+        return image_data
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            if max(image.size) <= IMAGE_MAX_DIMENSION and len(image_data) <= MAX_IMAGE_BYTES:
+                return image_data
+            image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            if image_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, format=image_format.upper(), quality=85, optimize=True)
+            resized = output.getvalue()
+    except Exception as e:
+        print("Error downscaling image.", str(e))
+        return image_data
+    return resized if len(resized) < len(image_data) else image_data
+
+def plan_image_reads(responses):
+    """
+    Decides, in key order, which fetched objects fit the per-image and total byte budgets.
+
+    The decision only uses the `ContentLength` of each `get_object` response, so oversized bodies
+    are never read. Objects that can be downscaled are charged at most MAX_IMAGE_BYTES.
+
+    Args:
+        responses (list): `get_object` responses, or None for keys that failed.
+
+    Returns:
+        list: One boolean per response telling whether its body should be read.
+    """
+    can_resize = Image is not None
+    remaining = MAX_TOTAL_IMAGE_BYTES
+    plan = []
+    for response in responses:
+        if response is None:
+            plan.append(False)
+            continue
+        size = response['ContentLength']
+        fits = size <= MAX_IMAGE_BYTES or (can_resize and size <= MAX_IMAGE_SOURCE_BYTES)
+        charged = min(size, MAX_IMAGE_BYTES)
+        if fits and charged <= remaining:
+            remaining -= charged
+            plan.append(True)
+        else:
+            print(f"Skipping image of {size} bytes, it exceeds the image byte budget.")
+            plan.append(False)
+    return plan
 
 def get_images_from_s3_as_base64(image_keys):
-    """Download images from S3 and return raw bytes."""
-    s3 = boto3.client('s3')
-    image_data_list = []
-    for key in image_keys:
+    """
+    Download images from S3 concurrently and return raw bytes.
+
+    The objects are requested in parallel through a bounded thread pool. Their sizes are checked
+    against the per-image and total byte budgets before any body is read, and large images are
+    downscaled when Pillow is available. The result keeps the order of `image_keys`, with None for
+    images that could not be retrieved or did not fit the budget.
+    """
+    if not image_keys:
+        return []
+    bucket = os.environ['IMAGE_UPLOAD_BUCKET']
+    s3 = get_client('s3')
+
+    def open_object(key):
+        try:
+            return s3.get_object(Bucket=bucket, Key=key)
+        except Exception as e:
+            print(f"Error getting object {key}.", str(e))
+            return None
+
+    def read_object(args):
+        key, response, should_read = args
+        if response is None:
+            return None
+        if not should_read:
+            response['Body'].close()
+            return None
         try:
-            response = s3.get_object(Bucket=os.environ['IMAGE_UPLOAD_BUCKET'], Key=key)
             image_data = response['Body'].read()  # Get raw bytes
-            # Get the file extension and normalize jpg to jpeg
-            image_format = key.split('.')[-1].lower()
-            if image_format == 'jpg':
-                image_format = 'jpeg'
-            
+            image_format = get_image_format(key)
+            if len(image_data) > IMAGE_RESIZE_BYTES:
+                image_data = downscale_image(image_data, image_format)
+            if len(image_data) > MAX_IMAGE_BYTES:
+                print(f"Skipping object {key}, it is still too large after downscaling.")
+                return None
             # Store both the raw bytes and the normalized format
-            image_data_list.append({
+            return {
                 'data': image_data,  # Store raw bytes instead of base64
-                'format': image_format
-            })
+                'format': image_format,
+                # Identifies the image version in the response cache key
+                'etag': response.get('ETag')
+            }
         except Exception as e:
-            print(f"Error getting object {key}.", str(e))
-            image_data_list.append(None)
-    return image_data_list
+            print(f"Error reading object {key}.", str(e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(IMAGE_FETCH_WORKERS, len(image_keys))) as executor:
+        responses = list(executor.map(open_object, image_keys))
+        plan = plan_image_reads(responses)
+        return list(executor.map(read_object, zip(image_keys, responses, plan)))
+
+def discard_body(s3_client, body_bucket, item):
+    """
+    Deletes the offloaded body object written for a history item that could not be stored under its timestamp.
+
+    A failed delete only leaves an unreferenced object in the bucket: it is logged and never stops the item from
+    being stored under the next timestamp.
+    """
+    key = item.get('bodyS3Key')
+    if not key:
+        return
+    try:
+        s3_client.delete_object(Bucket=body_bucket, Key=key)
+    except Exception as e:
+        print(f"Could not delete body object {key} of request {item['requestId']}: {e}")
+
+def persist_history(table, item, body_bucket=None, trace=None):
+    """
+    Stores the history item of a request, idempotently on its 'requestId'.
+
+    The item timestamp comes from the API Gateway request time, so a retried request maps to the same key, and the
+    write is conditional on the key being new or holding the same request ID: retries overwrite their own item and
+    never create duplicates. When another request of the user was stored in the same second, the timestamp gets a
+    '.1', '.2'... suffix instead of overwriting it. Large prompts and completions are compressed, or moved to S3
+    past the offload threshold, see `store_bodies`. The time spent is added to the 'historyWrite' span of `trace`.
+
+    Returns:
+        str: The timestamp the item was stored under.
+    """
+    s3_client = get_client('s3') if body_bucket else None
+    with trace.span('historyWrite') if trace else nullcontext():
+        for attempt in range(MAX_TIMESTAMP_ATTEMPTS):
+            candidate = dict(item, timestamp=item['timestamp'] if attempt == 0 else f"{item['timestamp']}.{attempt}")
+            store_bodies(candidate, s3_client, body_bucket)
+            try:
+                table.put_item(
+                    Item=candidate,
+                    ConditionExpression='attribute_not_exists(#ts) OR requestId = :requestId',
+                    ExpressionAttributeNames={'#ts': 'timestamp'},
+                    ExpressionAttributeValues={':requestId': candidate['requestId']}
+                )
+                return candidate['timestamp']
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                # The timestamp belongs to another request, drop the body object written for it
+                discard_body(s3_client, body_bucket, candidate)
+        raise RuntimeError(f"No free timestamp to store request {item['requestId']}")
+
+def persist_history_batch(table, items, body_bucket=None):
+    """
+    Stores the history items of a compare request in a single write.
+
+    The items get the request timestamp, then '.1', '.2'... suffixes, and are written in one
+    TransactWriteItems call with the same condition as `persist_history`, so a retried request
+    overwrites its own items. If another request already holds one of the timestamps, the transaction
+    is cancelled and each item is stored with `persist_history` instead.
+
+    Returns:
+        list: The timestamps the items were stored under.
+    """
+    s3_client = get_client('s3') if body_bucket else None
+    candidates = []
+    for index, item in enumerate(items):
+        candidate = dict(item, timestamp=item['timestamp'] if index == 0 else f"{item['timestamp']}.{index}")
+        store_bodies(candidate, s3_client, body_bucket)
+        candidates.append(candidate)
+    try:
+        table.meta.client.transact_write_items(TransactItems=[{
+            'Put': {
+                'TableName': table.name,
+                'Item': candidate,
+                'ConditionExpression': 'attribute_not_exists(#ts) OR requestId = :requestId',
+                'ExpressionAttributeNames': {'#ts': 'timestamp'},
+                'ExpressionAttributeValues': {':requestId': candidate['requestId']}
+            }
+        } for candidate in candidates])
+        return [candidate['timestamp'] for candidate in candidates]
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+    # Drop the body objects written for the cancelled transaction before storing the items one by one
+    for candidate in candidates:
+        discard_body(s3_client, body_bucket, candidate)
+    return [persist_history(table, item, body_bucket) for item in items]
+
+def build_message_content(data, images):
+    """Returns the content blocks of the user message: the prompt text, then the images that could be fetched."""
+    messages_content = []
+
+    if data:
+        messages_content.append({"text": data})
+
+    for image_info in images:
+        if image_info:  # Check if image was successfully retrieved
+            messages_content.append({
+                "image": {
+                    "format": image_info['format'],
+                    "source": {
+                        "bytes": image_info['data']  # Raw bytes
+                    }
+                }
+            })
+    return messages_content
+
+def system_blocks(model_id, system_prompt):
+    """Returns the ConverseStream `system` blocks of a request, none for models rejecting system prompts."""
+    if system_prompt and not model_id.split('/')[-1].startswith(NO_SYSTEM_PROMPT_MODELS):
+        return [{'text': system_prompt}]
+    return None
+
+def get_response_cache():
+    """Returns the response cache of the container, or None when RESPONSE_CACHE_TABLE is not set."""
+    global response_cache
+    table_name = os.environ.get('RESPONSE_CACHE_TABLE')
+    if response_cache is None and table_name:
+        response_cache = ResponseCache(get_table(table_name))
+    return response_cache
+
+def handle_compare(event, body, table, api_client, bedrock, messages_content, image_s3_keys, trace):
+    """
+    Answers a compare request: the prompt is streamed from every model of 'modelIds' concurrently (see `compare`).
+
+    Each successful model gets its own history item, linked by 'compareId', and all of them are stored in one
+    write behind the final end-of-message signal. Every model is traced separately with its ModelId dimension,
+    and `trace` records the request as a whole.
+    """
+    request_context = event['requestContext']
+    connection_id = request_context['connectionId']
+    request_id = request_context['requestId']
+    trace.set_dimension('Route', 'compare')
+    # Every model stops once the client cancels or goes away
+    watch = GenerationWatch(connections_table(), connection_id, request_id, int(request_context.get('requestTimeEpoch', time.time() * 1000)))
+
+    model_ids = compare_model_ids(body)
+    if not model_ids:
+        error_message = json.dumps({'action': 'error', 'error': 'modelIds must list the models to compare'})
+        api_client.post_to_connection(ConnectionId=connection_id, Data=error_message)
+        return {'statusCode': 400, 'body': error_message}
+
+    system_prompt = body.get('system')
+    inference_config = {
+        "maxTokens": body.get('max_tokens_to_sample', 4000),
+        "temperature": body.get('temperature', 0),
+        "topP": body.get('top_p', 0.999)
+    }
+    requests = []
+    traces = []
+    for model_id in model_ids:
+        request = {
+            'modelId': model_id,
+            'messages': [{'role': 'user', 'content': list(messages_content)}],
+            'inferenceConfig': inference_config
+        }
+        system = system_blocks(model_id, system_prompt)
+        if system:
+            request['system'] = system
+        add_cache_points(request)
+        requests.append(request)
+        model_trace = Trace('compare', request_id)
+        model_trace.set_dimension('ModelId', model_id)
+        traces.append(model_trace)
+
+    try:
+        watch.start()
+        with trace.span('stream'):
+            results = compare_models(bedrock, api_client, connection_id, requests, traces, watch, request_context['authorizer']['principalId'])
+        stats = [result['stats'] for result in results]
+        print(f"Compared {len(results)} models for request {request_id} in {trace.spans['stream']:.0f} ms: {json.dumps(stats)}")
+
+        timestamp = str(int(request_context.get('requestTimeEpoch', time.time() * 1000)) // 1000)
+        items = []
+        for index, result in enumerate(results):
+            if result['error']:
+                continue
+            item = {
+                'email': request_context['authorizer']['principalId'],
+                'timestamp': timestamp,
+                # One item per model, stable across retries of the request
+                'requestId': f'{request_id}#{index}',
+                'compareId': request_id,
+                'promptData': body.get('data', ''),
+                'modelId': result['modelId'],
+                'sourceIp': request_context['identity']['sourceIp'],
+                'requestBody': json.dumps(request_parameters(body)),
+                'userAgent': request_context['identity']['userAgent'],
+                'completion': result['text'],
+                **summary_fields(body.get('data', ''), result['text'])
+            }
+            if image_s3_keys:
+                item['imageS3Keys'] = image_s3_keys
+            if system_prompt:
+                item['systemPrompt'] = system_prompt
+            if result['usage']:
+                item['usage'] = result['usage']
+            if result['truncated']:
+                item['truncated'] = True
+                item['truncationReason'] = result['truncated']
+                avoided = max_tokens_avoided(inference_config['maxTokens'], result['text'])
+                trace.count('cancellations')
+                trace.count('truncatedOutputTokens', estimate_output_tokens(result['text']))
+                trace.count('maxTokensAvoided', avoided)
+                print(f"Model {result['modelId']} of request {request_id} stopped early ({result['truncated']}), at most {avoided} output tokens avoided")
+            items.append(item)
+
+        if items:
+            body_bucket = os.environ.get('HISTORY_BODY_BUCKET')
+            if write_behind_enabled():
+                history_writes.submit(request_id, persist_history_batch, table, items, body_bucket)
+            else:
+                with trace.span('historyWrite'):
+                    persist_history_batch(table, items, body_bucket)
+
+        if watch.reason == DISCONNECTED:
+            print(f"Connection {connection_id} is gone, stopped comparing models for request {request_id}")
+            trace.count('disconnects')
+            return {'statusCode': 410, 'body': 'Client disconnected'}
+
+        end = {'stats': stats}
+        if watch.cancelled:
+            end.update({'truncated': True, 'reason': watch.reason})
+        StreamDelivery(api_client, connection_id, trace=trace).end(end)
+        trace.mark('endOfMessage')
+        trace.count('models', len(results))
+
+    except ConnectionGoneError:
+        print(f"Connection {connection_id} is gone, stopped comparing models for request {request_id}")
+        trace.count('disconnects')
+        return {'statusCode': 410, 'body': 'Client disconnected'}
+
+    finally:
+        # Lambda freezes the container after returning, queued writes must complete within the invocation
+        watch.stop()
+        history_writes.drain()
+        for model_trace in traces:
+            model_trace.emit()
+        trace.emit()
+
+    return {'statusCode': 200, 'body': 'Message processed'}
 
 def handler(event, context):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(os.environ.get('DYNAMODB_TABLE'))
+    # Stage timings and counters of the request, logged as one metrics line at the end
+    trace = Trace('sendmessage', event['requestContext'].get('requestId'))
 
     # Extract information from the event
     domain_name = event['requestContext']['domainName']
     stage = event['requestContext']['stage']
     connection_id = event['requestContext']['connectionId']
 
-    # Initialize the API Gateway Management API
-    api_gateway_management_api = boto3.client('apigatewaymanagementapi', endpoint_url=f'https://{domain_name}/{stage}')
+    # Clients are created once per container and reused by warm invocations
+    with trace.span('clientSetup'):
+        table = get_table(os.environ.get('DYNAMODB_TABLE'))
+
+        # Initialize the API Gateway Management API
+        api_gateway_management_api = get_management_api(domain_name, stage)
 
     # Parse the incoming message
     body = json.loads(event['body'])
@@ -59,7 +435,8 @@ def handler(event, context):
     request_id = event['requestContext']['requestId']
     user_agent = event['requestContext']['identity']['userAgent']
     prompt_data = body.get('data', '')
-    current_timestamp = str(int(time.time()))
+    # Derived from the request time so a retried request is stored under the same key
+    current_timestamp = str(int(event['requestContext'].get('requestTimeEpoch', time.time() * 1000)) // 1000)
 
     # Retrieves 'system' if provided, else None
     system_prompt = body.get('system', None)  
@@ -70,32 +447,23 @@ def handler(event, context):
     # Only attempt to process the image is provided
     if image_s3_keys:
         # Make sure the list does not exceed 6 items
-        image_s3_keys = image_s3_keys[:6]
+        image_s3_keys = image_s3_keys[:MAX_IMAGES]
         
-        images_base64 = get_images_from_s3_as_base64(image_s3_keys)
+        with trace.span('imageFetch'):
+            images_base64 = get_images_from_s3_as_base64(image_s3_keys)
+        trace.count('images', sum(1 for image in images_base64 if image))
 
     # Initialize Bedrock client
-    boto3_bedrock = boto3.client('bedrock-runtime')
+    with trace.span('clientSetup'):
+        boto3_bedrock = get_client('bedrock-runtime')
 
     # Prepare the request for Bedrock
-    if action == 'sendmessage':
-        messages_content = []
-
-        if data:
-            messages_content.append({"text": data})
-
-        if image_s3_keys:
-            for image_info in images_base64:
-                if image_info:  # Check if image was successfully retrieved
-                    messages_content.append({
-                        "image": {
-                            "format": image_info['format'],
-                            "source": {
-                                "bytes": image_info['data']  # Raw bytes
-                            }
-                        }
-                    })
+    messages_content = build_message_content(data, images_base64 if image_s3_keys else [])
+
+    if action == 'compare':
+        return handle_compare(event, body, table, api_gateway_management_api, boto3_bedrock, messages_content, image_s3_keys, trace)
 
+    if action == 'sendmessage':
         message = [
             {
                 "role": "user",
@@ -106,35 +474,120 @@ def handler(event, context):
         # Initialize a list to collect text chunks
         text_chunks = []
 
-        # Invoke Bedrock model using ConverseStream
+        # Keeps the deltas in DynamoDB so a client reconnecting mid-answer can resume from its last offset
+        stream_buffer = StreamBuffer(stream_buffer_table(), request_id, connection_id, email, int(event['requestContext'].get('requestTimeEpoch', time.time() * 1000)))
+
+        # Coalesce deltas into fewer WebSocket posts, the frames carry the stream ID the client resumes with
+        delivery = StreamDelivery(api_gateway_management_api, connection_id, trace=trace,
+                                  tags={'streamId': request_id} if stream_buffer.enabled else None, buffer=stream_buffer)
+        trace.set_dimension('ModelId', modelId)
+
+        inference_config = {
+            "maxTokens": max_tokens_to_sample,
+            "temperature": temperature,
+            "topP": top_p
+        }
+
+        # Deterministic template runs can be answered from the response cache
+        response_key = None
+        cached = None
+        if cache_requested(body, temperature) and get_response_cache():
+            image_etags = [image['etag'] if image else None for image in images_base64] if image_s3_keys else []
+            response_key = cache_key(modelId, system_prompt, data, image_etags, inference_config)
+            with trace.span('cacheLookup'):
+                cached = response_cache.get(response_key)
+            trace.count('cacheHits' if cached else 'cacheMisses')
+
+        stop_reason = None
+        usage = {}
+        # Set when the generation stopped early: 'cancelled' by the client, or 'disconnected'
+        truncated = None
+        # Registers the generation on its connection and watches for a cancel action or a disconnection
+        watch = GenerationWatch(connections_table(), connection_id, request_id, int(event['requestContext'].get('requestTimeEpoch', time.time() * 1000)))
+
         try:
-            response = boto3_bedrock.converse_stream(
-                modelId=modelId,
-                messages=message,  # Pass the message directly
-                inferenceConfig={
-                    "maxTokens": max_tokens_to_sample,
-                    "temperature": temperature,
-                    "topP": top_p
+            stream_buffer.open()
+            if cached:
+                # Replay the cached completion in chunks, the client receives the same messages as from the model
+                with trace.span('stream'):
+                    for text in replay_chunks(cached['completion']):
+                        trace.mark('timeToFirstToken')
+                        text_chunks.append(text)
+                        delivery.send(text)
+                    delivery.flush()
+                trace.count('cacheSavedTokens', cached['inputTokens'] + cached['outputTokens'])
+            else:
+                request = {
+                    'modelId': modelId,
+                    'messages': message,  # Pass the message directly
+                    'inferenceConfig': inference_config
                 }
-            )
-            stream = response.get('stream')
-            if stream:
-                for chunk in stream:
-                    if "contentBlockDelta" in chunk:
-                        text = chunk["contentBlockDelta"]["delta"]["text"]
-                        if text:
-                            # Append text to the list
-                            text_chunks.append(text)
-
-                            # Wrap text in JSON structure
-                            response_message = json.dumps({"messages": text})
-                            api_gateway_management_api.post_to_connection(
-                                ConnectionId=connection_id,
-                                Data=response_message
-                            )
+                system = system_blocks(modelId, system_prompt)
+                if system:
+                    request['system'] = system
+                # Long system prompts are cached by Bedrock across requests on the models supporting it
+                trace.count('cachePoints', add_cache_points(request))
+
+                # Per-user and per-model rate limits, the client is told while the request is queued
+                notify = status_sender(delivery, trace)
+                admission = get_admission()
+                if admission:
+                    with trace.span('admission'):
+                        admitted = admission.admit(email, modelId, notify, fallback_model_id())
+                    if admitted is None:
+                        trace.count('rejected')
+                        rejection = {'action': 'error', 'error': 'Too many requests, please try again in a moment.'}
+                        delivery.post(rejection)
+                        stream_buffer.close(rejection)
+                        return {'statusCode': 429, 'body': json.dumps(rejection)}
+                    if admitted != modelId:
+                        switch_model(request, admitted)
+
+                # Invoke Bedrock model using ConverseStream, throttling is retried with backoff and may fall back
+                watch.start()
+                with trace.span('converseStream'):
+                    response = converse_stream_with_retry(boto3_bedrock, request, notify, fallback_model_id())
+                stream = response.get('stream')
+                if stream:
+                    # In pipeline mode the model stream is read on its own thread so slow posts don't stall it
+                    events = PipelinedStream(stream, delivery) if pipeline_enabled() else closing(stream)
+                    try:
+                        with trace.span('stream'), events as chunks:
+                            for chunk in chunks:
+                                # Stops reading, which closes the model stream, once the client cancelled, or left
+                                # and did not resume within the grace period of the stream buffer
+                                if watch.cancelled and (watch.reason != DISCONNECTED or not stream_buffer.detach()):
+                                    watch.check()
+                                stream_buffer.check()
+                                if "contentBlockDelta" in chunk:
+                                    text = chunk["contentBlockDelta"]["delta"]["text"]
+                                    if text:
+                                        trace.mark('timeToFirstToken')
+
+                                        # Append text to the list
+                                        text_chunks.append(text)
+
+                                        # Buffer the text, it is posted once a flush threshold is hit
+                                        delivery.send(text)
+                                elif "messageStop" in chunk:
+                                    stop_reason = chunk["messageStop"].get("stopReason")
+                                elif "metadata" in chunk:
+                                    # Token usage and model latency reported by Bedrock at the end of the stream
+                                    usage = usage_fields(chunk["metadata"].get("usage", {}))
+                                    trace.record_metadata(chunk["metadata"])
+
+                            # Post whatever is still buffered before persisting the completion
+                            delivery.flush()
+                    except ConnectionGoneError:
+                        # The partial completion is still stored below, marked as truncated
+                        truncated = DISCONNECTED
+                    except GenerationCancelled as cancelled:
+                        truncated = cancelled.reason
 
             # Join all text chunks into a single string
             complete_text = ''.join(text_chunks)
+            # The model that actually answered, the fallback model when the requested one was rate limited or throttled
+            answered_by = modelId if cached else request['modelId']
             
             
             # Prepare the item to insert into DynamoDB
@@ -143,11 +596,14 @@ def handler(event, context):
                 'timestamp': current_timestamp,
                 'requestId': request_id,
                 'promptData': prompt_data,
-                'modelId': modelId,
+                'modelId': answered_by,
                 'sourceIp': source_ip,
-                'requestBody': json.dumps(body),
+                # Only the parameters not already stored in the other attributes
+                'requestBody': json.dumps(request_parameters(body)),
                 'userAgent': user_agent,
-                'completion': complete_text
+                'completion': complete_text,
+                # Previews served by the history list view
+                **summary_fields(prompt_data, complete_text)
             }
 
             # Add the imageS3Key to the item if it exists
@@ -157,19 +613,67 @@ def handler(event, context):
             if system_prompt:
                 item_to_insert['systemPrompt'] = system_prompt
 
-            # Insert the data into DynamoDB
-            response = table.put_item(Item=item_to_insert)
+            if cached:
+                item_to_insert['cached'] = True
+
+            if truncated:
+                item_to_insert['truncated'] = True
+                item_to_insert['truncationReason'] = truncated
+                avoided = max_tokens_avoided(max_tokens_to_sample, complete_text)
+                trace.count('cancellations')
+                trace.count('truncatedOutputTokens', estimate_output_tokens(complete_text))
+                trace.count('maxTokensAvoided', avoided)
+                print(f"Request {request_id} stopped early ({truncated}) after {len(complete_text)} characters, at most {avoided} output tokens avoided")
+
+            # Token usage reported by Bedrock, including the prompt cache reads and writes
+            if usage:
+                item_to_insert['usage'] = usage
+
+            body_bucket = os.environ.get('HISTORY_BODY_BUCKET')
+            if write_behind_enabled():
+                # The history write runs in the background while the client is unlocked, it is drained below
+                history_writes.submit(request_id, persist_history, table, item_to_insert, body_bucket, trace)
+            else:
+                persist_history(table, item_to_insert, body_bucket, trace)
+
+            if response_key and not cached and stop_reason in CACHEABLE_STOP_REASONS and answered_by == modelId:
+                # Stored behind the end-of-message signal like the history item
+                history_writes.submit(f'{request_id} response', response_cache.put, response_key, complete_text, modelId, usage)
+
+            if truncated == DISCONNECTED:
+                if delivery.detached:
+                    # Nothing is posted anymore, the partial answer is kept for a client resuming after the grace period
+                    delivery.end({'truncated': True, 'reason': truncated})
+                delivery.log_stats(request_id)
+                return {
+                    'statusCode': 410,
+                    'body': 'Client disconnected'
+                }
 
             # After sending all chunks, send the end-of-message signal
-            end_of_message_signal = json.dumps({"endOfMessage": True})
-            api_gateway_management_api.post_to_connection(
-                ConnectionId=connection_id,
-                Data=end_of_message_signal
-            )
+            if truncated:
+                delivery.end({'truncated': True, 'reason': truncated})
+            else:
+                delivery.end({'usage': usage} if usage else None)
+            trace.mark('endOfMessage')
+            delivery.log_stats(request_id)
+            if response_key:
+                print(f"Response cache for request {request_id}: {'hit' if cached else 'miss'}, {json.dumps(response_cache.stats())}")
+
+        except ConnectionGoneError:
+            # The client went away, the model stream has been closed so generation stops here
+            print(f"Connection {connection_id} is gone, stopped streaming request {request_id}")
+            trace.count('disconnects')
+            delivery.log_stats(request_id)
+            return {
+                'statusCode': 410,
+                'body': 'Client disconnected'
+            }
 
         except botocore.exceptions.ClientError as error:
             error_message = error.response['Error']['Message']
             print(f"Error: {error_message}")
+            trace.count('errors')
     
             # Construct an error message
             errorMessage = {
@@ -177,6 +681,8 @@ def handler(event, context):
                 'error': error_message
             }
     
+            stream_buffer.close(errorMessage)
+
             # Send the error message to the client
             try:
                 api_gateway_management_api.post_to_connection(
@@ -192,6 +698,18 @@ def handler(event, context):
                 'body': f'Error: {error_message}'
             }
 
+        finally:
+            # Lambda freezes the container after returning, queued writes must complete within the invocation
+            stream_buffer.close()
+            if stream_buffer.enabled:
+                print(f"Stream buffer of request {request_id}: {json.dumps(stream_buffer.stats())}")
+            if stream_buffer.detached:
+                trace.count('detachedStreams')
+                trace.count('resumedStreams', int(stream_buffer.resumed))
+            watch.stop()
+            history_writes.drain()
+            trace.emit()
+
     return {
         'statusCode': 200,
         'body': 'Message processed'
@@ -0,0 +1,145 @@
+"""
+Compare mode: one prompt streamed from several models at once over the same WebSocket connection.
+
+The client sends {"action": "compare", "modelIds": [...], "data": ..., ...} with the usual sendmessage
+fields. Every model streams on its own thread, and its frames carry its model ID:
+
+    {"messages": "...", "modelId": "<model>"}                     text deltas, interleaved across models
+    {"action": "status", "modelId": "<model>", "status": ...}     the model is queued or retried, see `admission`
+    {"modelEnd": true, "modelId": "<model>", "stats": {...}}       the model is done (with "error" if it failed)
+    {"endOfMessage": true, "stats": [...]}                         every model is done
+
+The wall time is the slowest model's, not the sum of all of them. A cancel action, or the client
+going away, stops every model; their partial answers are returned marked as truncated.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from assistant_common.admission import converse_stream_with_retry, get_admission
+from assistant_common.connections import DISCONNECTED, GenerationCancelled
+from assistant_common.delivery import ConnectionGoneError, StreamDelivery
+from assistant_common.prompt_cache import usage_fields
+
+# Models a compare request may fan out to
+MAX_COMPARE_MODELS = int(os.environ.get('COMPARE_MAX_MODELS', 4))
+
+
+def compare_model_ids(body):
+    """Returns the distinct model IDs of a compare request, in request order and at most MAX_COMPARE_MODELS."""
+    model_ids = []
+    for model_id in body.get('modelIds') or []:
+        if isinstance(model_id, str) and model_id and model_id not in model_ids:
+            model_ids.append(model_id)
+    return model_ids[:MAX_COMPARE_MODELS]
+
+
+def stream_model(bedrock, api_client, connection_id, request, watch, trace, user=None):
+    """
+    Streams the answer of one model to the connection, its frames tagged with its model ID.
+
+    A model error is reported in its 'modelEnd' frame and does not affect the other models. Once
+    `watch` is cancelled every model stops reading its stream and returns its partial answer with
+    'truncated' set to the reason; a gone connection cancels `watch` for the other models. Every
+    model goes through the rate limits of `user` and is retried when throttled, without falling back
+    to another model: the client asked for these ones.
+
+    Args:
+        bedrock: A `bedrock-runtime` boto3 client.
+        api_client: An `apigatewaymanagementapi` boto3 client.
+        connection_id (str): The WebSocket connection to post to.
+        request (dict): The ConverseStream keyword arguments of the model.
+        watch (GenerationWatch): The cancellation flag of the compare request.
+        trace (Trace): The trace of the model, started when the model starts.
+        user (str, optional): The email address of the user, for the rate limits.
+
+    Returns:
+        dict: 'modelId', 'text', 'usage', 'stopReason', 'error', 'truncated' and 'stats' of the model.
+    """
+    model_id = request['modelId']
+    delivery = StreamDelivery(api_client, connection_id, trace=trace, tags={'modelId': model_id})
+    result = {'modelId': model_id, 'text': '', 'usage': {}, 'stopReason': None, 'error': None, 'truncated': None}
+    text_chunks = []
+
+    def notify(status):
+        trace.count(status['status'])
+        delivery.post({'action': 'status', 'modelId': model_id, **status})
+
+    try:
+        admission = get_admission()
+        if admission and user:
+            with trace.span('admission'):
+                if admission.admit(user, model_id, notify) is None:
+                    trace.count('rejected')
+                    raise RuntimeError('Too many requests, please try again in a moment.')
+        with trace.span('converseStream'):
+            response = converse_stream_with_retry(bedrock, request, notify)
+        with trace.span('stream'), closing(response['stream']) as events:
+            for chunk in events:
+                watch.check()
+                if 'contentBlockDelta' in chunk:
+                    text = chunk['contentBlockDelta']['delta'].get('text')
+                    if text:
+                        trace.mark('timeToFirstToken')
+                        text_chunks.append(text)
+                        delivery.send(text)
+                elif 'messageStop' in chunk:
+                    result['stopReason'] = chunk['messageStop'].get('stopReason')
+                elif 'metadata' in chunk:
+                    result['usage'] = usage_fields(chunk['metadata'].get('usage', {}))
+                    trace.record_metadata(chunk['metadata'])
+            delivery.flush()
+    except ConnectionGoneError:
+        watch.cancel(DISCONNECTED)
+        result['truncated'] = DISCONNECTED
+    except GenerationCancelled as cancelled:
+        result['truncated'] = cancelled.reason
+    except Exception as e:
+        print(f"Error streaming model {model_id}: {e}")
+        trace.count('errors')
+        result['error'] = str(e)
+
+    metrics = trace.metrics()
+    result['text'] = ''.join(text_chunks)
+    result['stats'] = {
+        'modelId': model_id,
+        'latencyMs': metrics['durationMs'],
+        'timeToFirstTokenMs': metrics.get('timeToFirstTokenMs'),
+        'outputTokensPerSecond': metrics.get('outputTokensPerSecond'),
+        'posts': metrics.get('posts', 0),
+        **result['usage']
+    }
+    if result['truncated'] == DISCONNECTED:
+        return result
+    frame = {'modelEnd': True, 'modelId': model_id, 'stats': result['stats']}
+    if result['error']:
+        frame['error'] = result['error']
+    if result['truncated']:
+        frame['truncated'] = True
+    try:
+        delivery.flush()
+        delivery.post(frame)
+    except ConnectionGoneError:
+        watch.cancel(DISCONNECTED)
+    return result
+
+
+def compare_models(bedrock, api_client, connection_id, requests, traces, watch, user=None):
+    """
+    Streams every request of `requests` concurrently, one thread per model.
+
+    Args:
+        requests (list): The ConverseStream keyword arguments of each model.
+        traces (list): One trace per request.
+        watch (GenerationWatch): The cancellation flag of the compare request, cancelled when the client went away.
+        user (str, optional): The email address of the user, for the rate limits.
+
+    Returns:
+        list: The result of each model (see `stream_model`), in request order, once every model has stopped.
+    """
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        futures = [
+            executor.submit(stream_model, bedrock, api_client, connection_id, request, watch, trace, user)
+            for request, trace in zip(requests, traces)
+        ]
+    return [future.result() for future in futures]
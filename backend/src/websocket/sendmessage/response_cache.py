@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+# Time a cached completion is served, enforced on read and used as the DynamoDB TTL of the entry
+CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 86400))
+# Number of completions kept in memory per container in front of the table
+CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 128))
+# Size of the chunks a cached completion is replayed in over the WebSocket
+REPLAY_CHUNK_CHARS = int(os.environ.get('RESPONSE_CACHE_REPLAY_CHARS', 256))
+
+# DynamoDB items are limited to 400 KB, larger completions are not cached
+MAX_CACHED_BYTES = 300 * 1024
+# Only completions the model finished on its own (or at the token limit) are cached
+CACHEABLE_STOP_REASONS = {'end_turn', 'stop_sequence', 'max_tokens'}
+
+
+def cache_requested(body, temperature):
+    """
+    Whether a request may be served from and stored in the response cache.
+
+    The cache is opt-in per request ('cache': true, sent by the client for template runs) and only
+    applies to deterministic runs, at temperature 0.
+    """
+    return bool(body.get('cache')) and float(temperature) == 0
+
+
+def cache_key(model_id, system_prompt, content, image_etags, inference_config):
+    """
+    Returns the cache key of a request: a SHA-256 of everything that determines the completion.
+
+    Images are identified by the ETag of their S3 object rather than their bytes, so the key
+    changes when an image is replaced under the same key.
+    """
+    payload = json.dumps({
+        'modelId': model_id,
+        'system': system_prompt or '',
+        'content': content or '',
+        'images': image_etags,
+        'inferenceConfig': inference_config
+    }, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def replay_chunks(text, size=REPLAY_CHUNK_CHARS):
+    """Splits a cached completion into the chunks replayed to the client."""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+class ResponseCache:
+    """
+    Cache of model completions in a DynamoDB table, with a per-container LRU in front of it.
+
+    Entries are keyed by `cache_key` and expire after `ttl_seconds`: the table removes them through
+    its TTL attribute ('expiresAt'), and since TTL deletion can lag, expired entries are also ignored
+    on read. Each entry keeps the token usage of the invocation that produced it, which is what a
+    hit saves.
+
+    Args:
+        table: The boto3 DynamoDB Table resource of the cache.
+        max_entries (int, optional): Maximum number of completions kept in memory.
+        ttl_seconds (int, optional): Lifetime of an entry.
+        clock (callable, optional): Wall clock in seconds, replaceable in benchmarks.
+    """
+
+    def __init__(self, table, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS, clock=time.time):
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+
+        self.entries = OrderedDict()
+
+        self.memory_hits = 0
+        self.table_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.saved_input_tokens = 0
+        self.saved_output_tokens = 0
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry['expiresAt'] > self.clock():
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry
+            del self.entries[key]
+
+        item = self.table.get_item(Key={'cacheKey': key}).get('Item')
+        if item is None or int(item['expiresAt']) <= self.clock():
+            return None
+        entry = {
+            'completion': item['completion'],
+            'modelId': item.get('modelId'),
+            'inputTokens': int(item.get('inputTokens', 0)),
+            'outputTokens': int(item.get('outputTokens', 0)),
+            'expiresAt': int(item['expiresAt'])
+        }
+        self._remember(key, entry)
+        self.table_hits += 1
+        return entry
+
+    def get(self, key):
+        """
+        Returns the cached entry of `key` ('completion', 'modelId', 'inputTokens', 'outputTokens'), or None.
+
+        A failed table read counts as a miss, the request then simply goes to the model.
+        """
+        try:
+            entry = self._lookup(key)
+        except Exception as e:
+            print(f"Could not read the response cache: {e}")
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.saved_input_tokens += entry['inputTokens']
+        self.saved_output_tokens += entry['outputTokens']
+        return entry
+
+    def put(self, key, completion, model_id, usage):
+        """
+        Stores a completion and the token usage of the invocation that produced it.
+
+        Returns:
+            bool: Whether the completion was stored, completions above MAX_CACHED_BYTES are not.
+        """
+        if not completion or len(completion.encode('utf-8')) > MAX_CACHED_BYTES:
+            return False
+        entry = {
+            'completion': completion,
+            'modelId': model_id,
+            'inputTokens': int(usage.get('inputTokens', 0)),
+            'outputTokens': int(usage.get('outputTokens', 0)),
+            'expiresAt': int(self.clock()) + self.ttl_seconds
+        }
+        self.table.put_item(Item={'cacheKey': key, **entry})
+        self._remember(key, entry)
+        self.stores += 1
+        return True
+
+    def stats(self):
+        hits = self.memory_hits + self.table_hits
+        lookups = hits + self.misses
+        return {
+            'memoryHits': self.memory_hits,
+            'tableHits': self.table_hits,
+            'misses': self.misses,
+            'hitRate': round(hits / lookups, 3) if lookups else None,
+            'stores': self.stores,
+            'savedInputTokens': self.saved_input_tokens,
+            'savedOutputTokens': self.saved_output_tokens,
+            'entries': len(self.entries)
+        }
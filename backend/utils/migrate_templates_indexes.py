@@ -0,0 +1,72 @@
+"""
+Prepares existing template items for the createdBy/visibility global secondary indexes.
+
+DynamoDB only indexes items that carry every key attribute of an index with a non-empty value,
+so templates created before the indexes existed without 'dateCreated' or 'visibility' would
+silently disappear from the listings. This script scans the Templates table and backfills:
+- 'dateCreated' from the 'templateId' (both are epoch timestamps) when it is missing or empty
+- 'visibility' as 'private' when it is missing or empty
+Items with an empty 'createdBy' cannot be indexed by owner and are reported.
+
+CloudFormation can only create one global secondary index per table update. deploy.sh runs this
+script and then deploys twice when the stack has a Templates table without indexes: first with the
+TemplatesIndexes parameter set to 'owner', then with 'all' (see "How to Deploy Locally" in the
+README). The templates function falls back to a scan until the indexes are active.
+
+Usage:
+    python backend/utils/migrate_templates_indexes.py --table <TemplatesTableName> [--region us-east-1] [--dry-run]
+"""
+import argparse
+import time
+import boto3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', required=True, help='Name of the Templates DynamoDB table')
+    parser.add_argument('--region', help='AWS region of the table')
+    parser.add_argument('--dry-run', action='store_true', help='Only report the items that would be updated')
+    args = parser.parse_args()
+
+    table = boto3.resource('dynamodb', region_name=args.region).Table(args.table)
+
+    scanned = updated = unowned = 0
+    scan_kwargs = {'ProjectionExpression': 'templateId, dateCreated, visibility, createdBy'}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response['Items']:
+            # The listing cache version marker is deliberately kept out of the indexes
+            if item['templateId'] == '__listing_version__':
+                continue
+            scanned += 1
+            updates = {}
+            if not item.get('dateCreated'):
+                updates['dateCreated'] = item['templateId'] if item['templateId'].replace('.', '', 1).isdigit() else str(time.time())
+            if not item.get('visibility'):
+                updates['visibility'] = 'private'
+            if not item.get('createdBy'):
+                unowned += 1
+                print(f"Template {item['templateId']} has no createdBy and cannot be listed by owner.")
+            if not updates:
+                continue
+
+            updated += 1
+            print(f"Template {item['templateId']}: setting {updates}")
+            if not args.dry_run:
+                table.update_item(
+                    Key={'templateId': item['templateId']},
+                    UpdateExpression='SET ' + ', '.join(f'#{name} = :{name}' for name in updates),
+                    ExpressionAttributeNames={f'#{name}': name for name in updates},
+                    ExpressionAttributeValues={f':{name}': value for name, value in updates.items()}
+                )
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    action = 'would be updated' if args.dry_run else 'updated'
+    print(f"Scanned {scanned} templates, {updated} {action}, {unowned} without createdBy.")
+
+
+if __name__ == '__main__':
+    main()
@@ -249,8 +249,25 @@ if [ "$RUN_BACKEND" = true ] || { [ "$RUN_BACKEND" = false ] && [ "$RUN_FRONTEND
     # Grab the Arn of WAFv2 WebACL from the stack
     WAFv2_WEB_ACL_ARN=$(aws cloudformation describe-stacks --region "us-east-1" --stack-name "$WAF_STACK_NAME" --query "Stacks[0].Outputs[?OutputKey=='WAFv2WebACL'].OutputValue" --output text)
 
+    # CloudFormation creates at most one global secondary index per table update: a stack deployed before the Templates
+    # table had its two indexes first gets the owner index, then the main deployment below adds the visibility index
+    EXISTING_TEMPLATES_TABLE=$(aws cloudformation describe-stacks --region "$AWS_REGION" --stack-name "$STACK_NAME" --query "Stacks[0].Outputs[?OutputKey=='TemplatesTableName'].OutputValue" --output text 2>/dev/null || true)
+    if [ -n "$EXISTING_TEMPLATES_TABLE" ] && [ "$EXISTING_TEMPLATES_TABLE" != "None" ]; then
+        TEMPLATES_INDEX_COUNT=$(aws dynamodb describe-table --table-name "$EXISTING_TEMPLATES_TABLE" --region "$AWS_REGION" --query "length(Table.GlobalSecondaryIndexes || \`[]\`)" --output text)
+        if [ "$TEMPLATES_INDEX_COUNT" = "0" ]; then
+            echo "Step 5 (Backend). Preparing the templates of $EXISTING_TEMPLATES_TABLE for the new indexes..."
+            if python3 -c "import boto3" 2>/dev/null; then
+                python3 backend/utils/migrate_templates_indexes.py --table "$EXISTING_TEMPLATES_TABLE" --region "$AWS_REGION"
+            else
+                echo "boto3 is not installed, run backend/utils/migrate_templates_indexes.py --table $EXISTING_TEMPLATES_TABLE once the deployment is done."
+            fi
+            echo "Step 5 (Backend). Creating the Templates owner index (first of two table updates)..."
+            sam deploy --stack-name "$STACK_NAME" --no-confirm-changeset --no-fail-on-empty-changeset --region "$AWS_REGION" --resolve-s3 --parameter-overrides DummyParameter="$DUMMY_VALUE" WAFv2WebACL="$WAFv2_WEB_ACL_ARN" TemplatesIndexes="owner"  --capabilities CAPABILITY_IAM
+        fi
+    fi
+
     # Deploys main SAM template in the region of choice of the user
-    sam deploy --stack-name "$STACK_NAME" --no-confirm-changeset --no-fail-on-empty-changeset --region "$AWS_REGION" --resolve-s3 --parameter-overrides DummyParameter="$DUMMY_VALUE" WAFv2WebACL="$WAFv2_WEB_ACL_ARN"  --capabilities CAPABILITY_IAM
+    sam deploy --stack-name "$STACK_NAME" --no-confirm-changeset --no-fail-on-empty-changeset --region "$AWS_REGION" --resolve-s3 --parameter-overrides DummyParameter="$DUMMY_VALUE" WAFv2WebACL="$WAFv2_WEB_ACL_ARN" TemplatesIndexes="all"  --capabilities CAPABILITY_IAM
 
     # Steps to deploy API Gateway to Prod Stage
     # Step 1: Get the RestApiId of your deployed API Gateway
@@ -2,6 +2,8 @@ import React, { useState, useEffect, useRef } from 'react';
 import { Form, Slider, Input, InputNumber, Button, Select, Switch, Row, Col, Tooltip, message, Upload } from 'antd';
 import { EyeOutlined, EyeInvisibleOutlined, UploadOutlined, CloseCircleOutlined, CopyOutlined } from '@ant-design/icons';
 import { fetchTokenIfExpired } from './utils/authHelpers';
+import { isStreamStatus, showStreamStatus } from './utils/streamStatus';
+import { createStreamPosition, trackStreamPosition, canResume, resumeDelayMs, resumePayload } from './utils/resumableStream';
 import ReactMarkdown from 'react-markdown';
 import rehypeHighlight from 'rehype-highlight';
 import 'highlight.js/styles/github.css'; // or any other style you prefer
@@ -90,6 +92,8 @@ const Activity = ({ user }) => {
   const email = user?.email;
   const [filteredTemplates, setFilteredTemplates] = useState([]);
   const wsRef = useRef(null);
+  // Stream ID and last offset of the answer in flight, used to resume it after a reconnect
+  const streamRef = useRef(createStreamPosition());
   const [selectedTemplateData, setSelectedTemplateData] = useState(null);
   const [combinedData, setCombinedData] = useState('');
   const [showFullPrompt, setShowFullPrompt] = useState(false);
@@ -179,6 +183,13 @@ const Activity = ({ user }) => {
     }
   };
 
+  // Asks the backend to stop the generation, it stores the partial answer and ends the stream with endOfMessage
+  const handleStop = () => {
+    if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
+      wsRef.current.send(JSON.stringify({ action: 'cancel' }));
+    }
+  };
+
   const handleEndOfTransmission = () => {
     if (wsRef.current) {
       wsRef.current.close();
@@ -197,22 +208,31 @@ const Activity = ({ user }) => {
       return;
     }
 
+    streamRef.current = createStreamPosition();
+    connect(() => sendWebSocketMessage(values));
+  };
+
+  // Opens a connection and sends the request from `onOpen`; a connection dropped mid-answer is reopened to resume it
+  const connect = async (onOpen) => {
     const authorizationToken = await fetchTokenIfExpired();
     const wsUrl = `${websocketUrl}?Authorization=${encodeURIComponent(authorizationToken)}`;
-    wsRef.current = new WebSocket(wsUrl);
+    const socket = new WebSocket(wsUrl);
+    wsRef.current = socket;
 
-    wsRef.current.onopen = () => {
-      sendWebSocketMessage(values);
-    };
+    socket.onopen = () => onOpen(socket);
 
-    wsRef.current.onerror = (error) => {
+    socket.onerror = (error) => {
       console.error('WebSocket error:', error);
-      handleEndOfTransmission();
     };
 
-    wsRef.current.onmessage = (event) => {
+    socket.onmessage = (event) => {
       try {
         const messageData = JSON.parse(event.data);
+        trackStreamPosition(streamRef.current, messageData);
+        if (isStreamStatus(messageData)) {
+          showStreamStatus(messageData);
+          return;
+        }
         if (messageData.action === 'error') {
           // Display error message using Ant Design's message component
           message.error(messageData.error, 10); // 10 seconds duration
@@ -232,7 +252,20 @@ const Activity = ({ user }) => {
       }
     };
 
-    wsRef.current.onclose = () => {
+    socket.onclose = () => {
+      // handleEndOfTransmission clears wsRef before closing, so only unexpected closes are resumed
+      if (wsRef.current === socket && canResume(streamRef.current)) {
+        const delay = resumeDelayMs(streamRef.current);
+        streamRef.current.attempts += 1;
+        setTimeout(() => connect((resumed) => resumed.send(JSON.stringify(resumePayload(streamRef.current)))), delay);
+        return;
+      }
+      if (wsRef.current === socket) {
+        wsRef.current = null;
+        if (streamRef.current.streamId) {
+          message.error('The connection was lost before the answer was complete.', 10);
+        }
+      }
       setIsLoading(false);
     };
   };
@@ -258,6 +291,11 @@ const Activity = ({ user }) => {
       messagePayload.system = systemPrompt; // Include the system message
     }
 
+    // Deterministic template runs may be answered from the response cache
+    if (selectedTemplateData && messagePayload.temperature === 0) {
+      messagePayload.cache = true;
+    }
+
     if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
       wsRef.current.send(JSON.stringify(messagePayload));
     } else {
@@ -665,6 +703,11 @@ const Activity = ({ user }) => {
         <Button type="primary" htmlType="submit" loading={isLoading}>
           Submit
         </Button>
+        {isLoading && (
+          <Button onClick={handleStop} style={{ marginLeft: 8 }}>
+            Stop
+          </Button>
+        )}
       </Form.Item>
       <Form.Item label="Output">
         <div className="output-container" style={{ width: '100%' }}>
@@ -18,6 +18,7 @@ import {
 import { UserOutlined, RobotOutlined, CopyOutlined } from "@ant-design/icons";
 import "./App.css";
 import { fetchTokenIfExpired } from "./utils/authHelpers";
+import { isStreamStatus, showStreamStatus } from "./utils/streamStatus";
 import { v4 as uuidv4 } from 'uuid';
 import ReactMarkdown from 'react-markdown';
 import rehypeHighlight from 'rehype-highlight';
@@ -235,6 +236,11 @@ const Chat = ({ user }) => {
         try {
           const messageData = JSON.parse(event.data);
 
+          if (isStreamStatus(messageData)) {
+            showStreamStatus(messageData);
+            return;
+          }
+
           if (messageData.action === "error") {
             console.error(messageData.error);
             message.error(messageData.error);
@@ -279,6 +285,11 @@ const Chat = ({ user }) => {
           if (messageData.endOfMessage) {
             ongoingBotMessageId.current = null; // Reset for the next bot message
             setIsLoading(false);
+            if (messageData.truncated) {
+              // Stopped before any text arrived, drop the temporary loading message
+              setIsWaitingForMessage(false);
+              setMessages((prevMessages) => prevMessages.filter((msg) => msg.id !== thinkingMessageId));
+            }
           }
         } catch (error) {
           console.error("Error processing WebSocket message:", error);
@@ -390,6 +401,13 @@ const Chat = ({ user }) => {
     }
   };
 
+  // Asks the backend to stop the generation, it stores the partial answer and ends the stream with endOfMessage
+  const handleStop = () => {
+    if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
+      wsRef.current.send(JSON.stringify({ action: "cancel" }));
+    }
+  };
+
   const handleSend = () => {
     if (inputValue.trim()) {
       // Check if WebSocket is connected
@@ -596,6 +614,11 @@ const Chat = ({ user }) => {
               <Button type="primary" onClick={handleSend} loading={isLoading}>
                 Send
               </Button>
+              {isLoading && (
+                <Button onClick={handleStop} style={{ marginLeft: 8 }}>
+                  Stop
+                </Button>
+              )}
             </div>
 
             {/* Add Prompt Template Select Dropdown */}
@@ -133,8 +133,31 @@ const History = ({ user }) => {
     }
   };
 
-  const handleView = (recordId) => {
-    const record = historyData.find((item) => item.requestId === recordId);
+  const handleView = async (recordId) => {
+    let record = historyData.find((item) => item.requestId === recordId);
+    // Long prompts and completions are only listed as previews, fetch the full item
+    if (record.bodyTruncated) {
+      try {
+        const authorizationToken = await fetchTokenIfExpired();
+        const response = await fetch(
+          `${apiUrl}/history?email=${encodeURIComponent(record.email)}&timestamp=${record.timestamp}`,
+          {
+            method: "GET",
+            headers: {
+              "Content-Type": "application/json",
+              authorizationToken: authorizationToken,
+            },
+          }
+        );
+        if (!response.ok) {
+          throw new Error('Failed to fetch history entry');
+        }
+        record = await response.json();
+      } catch (error) {
+        console.error("Error fetching history entry:", error);
+        message.error("Failed to load the full history entry");
+      }
+    }
     // Process imageS3Keys to extract just the file names, ignoring the UUIDs
     if (record.imageS3Keys) {
       record.imageNames = record.imageS3Keys.map(key => {
@@ -311,7 +334,10 @@ const History = ({ user }) => {
           {/* nosemgrep: jsx-not-internationalized */}
           <b>Model:</b>
         </p>
-        <Input value={currentRecord.modelId} readOnly />
+        <Input
+          value={currentRecord.cached ? `${currentRecord.modelId} (cached response)` : currentRecord.modelId}
+          readOnly
+        />
          {/* Conditionally render System Prompt if it exists */}
           {currentRecord.systemPrompt && (
             <>
@@ -1,6 +1,8 @@
 import React, { useState, useRef } from 'react';
 import { Form, Slider, Input, InputNumber, Button, Select, Switch, Row, Col, message, Upload, Tooltip } from 'antd';
 import { fetchTokenIfExpired } from './utils/authHelpers';
+import { isStreamStatus, showStreamStatus } from './utils/streamStatus';
+import { createStreamPosition, trackStreamPosition, canResume, resumeDelayMs, resumePayload } from './utils/resumableStream';
 import { UploadOutlined, CloseCircleOutlined, CopyOutlined } from '@ant-design/icons';
 import ReactMarkdown from 'react-markdown';
 import rehypeHighlight from 'rehype-highlight';
@@ -89,6 +91,8 @@ const Playground = ({ user }) => {
   const email = user?.email;
   const websocketUrl = process.env.REACT_APP_WEBSOCKET_URL;
   const wsRef = useRef(null);
+  // Stream ID and last offset of the answer in flight, used to resume it after a reconnect
+  const streamRef = useRef(createStreamPosition());
   const [wordCount, setWordCount] = useState(0);
   const [byteCount, setByteCount] = useState(0);
   const [uploadedImages, setUploadedImages] = useState([]);
@@ -99,6 +103,13 @@ const Playground = ({ user }) => {
 
   const [systemMessage, setSystemMessage] = useState(''); // State for storing the system message
 
+  // Asks the backend to stop the generation, it stores the partial answer and ends the stream with endOfMessage
+  const handleStop = () => {
+    if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
+      wsRef.current.send(JSON.stringify({ action: 'cancel' }));
+    }
+  };
+
   const handleEndOfTransmission = () => {
     if (wsRef.current) {
       wsRef.current.close();
@@ -111,22 +122,31 @@ const Playground = ({ user }) => {
     setIsLoading(true);
     setOutput('');
 
+    streamRef.current = createStreamPosition();
+    connect(() => sendWebSocketMessage(values));
+  };
+
+  // Opens a connection and sends the request from `onOpen`; a connection dropped mid-answer is reopened to resume it
+  const connect = async (onOpen) => {
     const authorizationToken = await fetchTokenIfExpired();
     const wsUrl = `${websocketUrl}?Authorization=${encodeURIComponent(authorizationToken)}`;
-    wsRef.current = new WebSocket(wsUrl);
+    const socket = new WebSocket(wsUrl);
+    wsRef.current = socket;
 
-    wsRef.current.onopen = () => {
-      sendWebSocketMessage(values);
-    };
+    socket.onopen = () => onOpen(socket);
 
-    wsRef.current.onerror = (error) => {
+    socket.onerror = (error) => {
       console.error('WebSocket error:', error);
-      handleEndOfTransmission();
     };
 
-    wsRef.current.onmessage = (event) => {
+    socket.onmessage = (event) => {
       try {
         const messageData = JSON.parse(event.data);
+        trackStreamPosition(streamRef.current, messageData);
+        if (isStreamStatus(messageData)) {
+          showStreamStatus(messageData);
+          return;
+        }
         if (messageData.action === 'error') {
           message.error(messageData.error, 6);
           handleEndOfTransmission();
@@ -143,7 +163,20 @@ const Playground = ({ user }) => {
       }
     };
 
-    wsRef.current.onclose = () => {
+    socket.onclose = () => {
+      // handleEndOfTransmission clears wsRef before closing, so only unexpected closes are resumed
+      if (wsRef.current === socket && canResume(streamRef.current)) {
+        const delay = resumeDelayMs(streamRef.current);
+        streamRef.current.attempts += 1;
+        setTimeout(() => connect((resumed) => resumed.send(JSON.stringify(resumePayload(streamRef.current)))), delay);
+        return;
+      }
+      if (wsRef.current === socket) {
+        wsRef.current = null;
+        if (streamRef.current.streamId) {
+          message.error('The connection was lost before the answer was complete.', 10);
+        }
+      }
       setIsLoading(false);
     };
   };
@@ -421,6 +454,11 @@ const Playground = ({ user }) => {
         <Button type="primary" htmlType="submit" loading={isLoading}>
           Submit
         </Button>
+        {isLoading && (
+          <Button onClick={handleStop} style={{ marginLeft: 8 }}>
+            Stop
+          </Button>
+        )}
       </Form.Item>
 
       <Form.Item label="Output" style={{ marginBottom: 0 }}>
@@ -0,0 +1,28 @@
+// Answers of the sendmessage action can be resumed after the WebSocket drops: every frame carries
+// {"streamId", "offset"}, and a new connection sends {"action": "resume", "streamId", "offset"}
+// to receive the rest of the answer from that offset.
+const MAX_RESUME_ATTEMPTS = 3;
+
+export const createStreamPosition = () => ({ streamId: null, offset: 0, attempts: 0 });
+
+// Records the last offset received, frames without one (status, errors) leave the position as is
+export const trackStreamPosition = (position, messageData) => {
+    if (messageData.streamId) {
+        position.streamId = messageData.streamId;
+    }
+    if (typeof messageData.offset === 'number') {
+        position.offset = messageData.offset;
+        position.attempts = 0;
+    }
+};
+
+export const canResume = (position) => Boolean(position.streamId) && position.attempts < MAX_RESUME_ATTEMPTS;
+
+// Waits a bit longer before every new attempt: 0.5s, 1s, 2s
+export const resumeDelayMs = (position) => 500 * 2 ** position.attempts;
+
+export const resumePayload = (position) => ({
+    action: 'resume',
+    streamId: position.streamId,
+    offset: position.offset
+});
@@ -0,0 +1,28 @@
+import { message } from 'antd';
+
+// Status frames sent by the backend while a request waits for a model:
+// {"action": "status", "status": "queued" | "retrying" | "fallback", ...}
+export const isStreamStatus = (messageData) => messageData.action === 'status';
+
+export const describeStreamStatus = (messageData) => {
+    const seconds = Math.max(1, Math.round((messageData.retryAfterMs || 0) / 1000));
+    const model = messageData.modelId ? ` (${messageData.modelId})` : '';
+    switch (messageData.status) {
+        case 'queued':
+            return `Too many requests right now, your request is queued for about ${seconds}s...`;
+        case 'retrying':
+            return `The model is busy${model}, retrying in about ${seconds}s (attempt ${messageData.attempt})...`;
+        case 'fallback':
+            return `The requested model is busy, answering with ${messageData.modelId} instead.`;
+        default:
+            return null;
+    }
+};
+
+// Shows the status as a single message, replaced by the next status of the same request
+export const showStreamStatus = (messageData) => {
+    const content = describeStreamStatus(messageData);
+    if (content) {
+        message.info({ content, key: 'stream-status', duration: messageData.status === 'fallback' ? 6 : 3 });
+    }
+};